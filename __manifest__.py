@@ -9,16 +9,34 @@
     'category': 'CRM',
     'author': 'Odoo',
     'website': 'https://www.odoo.com',
-    'depends': ['crm', 'web'],
+    'depends': ['crm', 'web', 'bus'],
     'data': [
         'security/ir.model.access.csv',
+        'security/crm_campaign_analysis_security.xml',
+        'data/ir_config_parameter_data.xml',
+        'data/ir_cron_data.xml',
+        'data/crm_campaign_analysis_highlight_rule_data.xml',
+        'report/crm_campaign_analysis_report_view.xml',
+        'report/campaign_analysis_html_report.xml',
+        'report/campaign_analysis_html_report_action.xml',
         'report/export_wizard_view.xml',
         'report/export_wizard_action.xml',
         'report/report_campaign_analysis_template.xml',
         'report/pdf_report.xml',
         'views/campaign_analysis_web_template.xml',
         'views/menu_views.xml',
+        'views/dashboard_views.xml',
+        'views/profile_views.xml',
+        'views/highlight_rule_views.xml',
     ],
+    'assets': {
+        'web.assets_backend': [
+            'crm_campaign_analysis/static/src/js/*.js',
+            'crm_campaign_analysis/static/src/xml/*.xml',
+            'crm_campaign_analysis/static/src/css/*.css',
+        ],
+    },
+    'uninstall_hook': 'uninstall_hook',
     'installable': True,
     'application': False,
     'auto_install': False,
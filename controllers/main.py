@@ -1,11 +1,66 @@
-from odoo import http
-from odoo.http import request
+from odoo import api, http
+from odoo.http import content_disposition, request
 from datetime import datetime, timedelta
+import hashlib
+import time
+
+from ..models.campaign_analysis_cache import CACHE_TTL, get_cache
+from ..models.campaign_analysis_profiler import phase, profile, record_cache
 
 
 class CampaignAnalysisController(http.Controller):
     @http.route('/crm/campaign/analysis', type='http', auth='user', website=True)
     def campaign_analysis(self, date_from=None, date_to=None, **kw):
+        with profile(request.env, 'web_report') as active:
+            response = self._render_campaign_analysis(date_from, date_to)
+        if active is not None and active.name == 'web_report':
+            response.headers['Server-Timing'] = active.server_timing()
+        return response
+
+    def _render_campaign_analysis(self, date_from=None, date_to=None):
+        date_from_dt, date_to_dt = self._parse_range(date_from, date_to)
+        date_from = date_from_dt.strftime('%Y-%m-%d')
+        date_to = date_to_dt.strftime('%Y-%m-%d')
+
+        key, generation, etag = self._table_etag(date_from_dt, date_to_dt)
+        if request.httprequest.if_none_match.contains(etag):
+            return self._not_modified(etag)
+
+        values = {
+            'date_from': date_from_dt,
+            'date_to': date_to_dt,
+            'date_from_str': date_from,
+            'date_to_str': date_to,
+            'table_html': self._render_table(key, generation, date_from_dt, date_to_dt),
+        }
+        response = request.render('crm_campaign_analysis.campaign_analysis_web_template', values)
+        with phase('render'):
+            # Render now rather than lazily, so that QWeb is measured
+            response.flatten()
+        self._set_validators(response, etag)
+        return response
+
+    @http.route('/crm/campaign/analysis/fragment', type='http', auth='user')
+    def campaign_analysis_fragment(self, date_from=None, date_to=None, **kw):
+        """Table of the web report alone, as JSON, to refresh it without reloading the page"""
+        with profile(request.env, 'web_fragment') as active:
+            date_from_dt, date_to_dt = self._parse_range(date_from, date_to)
+            key, generation, etag = self._table_etag(date_from_dt, date_to_dt)
+            if request.httprequest.if_none_match.contains(etag):
+                response = self._not_modified(etag)
+            else:
+                response = request.make_json_response({
+                    'date_from': date_from_dt.strftime('%Y-%m-%d'),
+                    'date_to': date_to_dt.strftime('%Y-%m-%d'),
+                    'html': self._render_table(key, generation, date_from_dt, date_to_dt),
+                })
+                self._set_validators(response, etag)
+        if active is not None and active.name == 'web_fragment':
+            response.headers['Server-Timing'] = active.server_timing()
+        return response
+
+    def _parse_range(self, date_from=None, date_to=None):
+        """Dates of the web report, the last 30 days by default or when invalid"""
         # Default dates if not provided (30 days ago to today)
         if not date_from:
             date_from = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
@@ -20,27 +75,46 @@ class CampaignAnalysisController(http.Controller):
             # Handle invalid dates
             date_from_dt = (datetime.now() - timedelta(days=30)).date()
             date_to_dt = datetime.now().date()
-            date_from = date_from_dt.strftime('%Y-%m-%d')
-            date_to = date_to_dt.strftime('%Y-%m-%d')
-        
+        return date_from_dt, date_to_dt
+
+    def _table_etag(self, date_from_dt, date_to_dt):
+        """
+        Cache key, data generation and ETag of the table of a date range.
+        The key covers the range, the access scope, the language and the
+        highlight rules, so the ETag changes with any of them or the data.
+        The ETag also changes every CACHE_TTL seconds, like the cached
+        fragment expires: a table read while a write was committing does
+        not stay in the browser longer than in the server cache.
+        """
+        report_model = request.env['crm.campaign.analysis.report']
+        key = report_model._get_cache_key(
+            date_from_dt, date_to_dt, 'web_table',
+            request.env['crm.campaign.analysis.highlight.rule']._get_rules())
+        generation = report_model._get_data_generation()
+        etag = hashlib.sha1(repr((key, generation, int(time.time() // CACHE_TTL))).encode()).hexdigest()
+        return key, generation, etag
+
+    def _render_table(self, key, generation, date_from_dt, date_to_dt):
+        """Rendered table and legend of the web report, from the fragment cache if possible"""
+        cache = get_cache(request.env.cr.dbname)
+        html = cache.get(key, generation)
+        record_cache(html is not None)
+        if html is not None:
+            return html
+
         # Convert to datetime format for the analysis
         date_from_datetime = datetime.combine(date_from_dt, datetime.min.time())
         date_to_datetime = datetime.combine(date_to_dt, datetime.max.time())
         
-        # Force refresh the materialized view
-        request.env['crm.campaign.analysis.report'].sudo().refresh_materialized_view()
-        
         # Get report data
-        report_data = request.env['crm.campaign.analysis.report'].sudo().get_campaign_stage_analysis(
-            date_from=date_from_datetime, 
-            date_to=date_to_datetime
-        )
+        with phase('analysis'):
+            # No sudo: the analysis is restricted to the leads of the user
+            report_data = request.env['crm.campaign.analysis.report'].get_campaign_stage_analysis(
+                date_from=date_from_datetime, 
+                date_to=date_to_datetime
+            )
         
         values = {
-            'date_from': date_from_dt,
-            'date_to': date_to_dt,
-            'date_from_str': date_from,
-            'date_to_str': date_to,
             'campaigns': list(report_data.get('campaigns', {}).keys()),
             'campaign_names': {campaign_id: report_data['campaigns'][campaign_id]['name'] 
                              for campaign_id in report_data.get('campaigns', {})},
@@ -50,5 +124,49 @@ class CampaignAnalysisController(http.Controller):
                              for campaign_id in report_data.get('campaigns', {})},
             'isinstance': isinstance,  # Needed for type checking in template
         }
-        
-        return request.render('crm_campaign_analysis.campaign_analysis_web_template', values)
+        values.update(request.env['crm.campaign.analysis.highlight.rule']._get_template_values(values['stage_names']))
+        with phase('render_table'):
+            html = request.env['ir.qweb']._render('crm_campaign_analysis.campaign_analysis_web_table', values)
+        request.env['crm.campaign.analysis.report']._cache_result(cache, key, generation, html)
+        return html
+
+    def _set_validators(self, response, etag):
+        # Always revalidated: a matching ETag costs a 304 without any rendering
+        response.headers['ETag'] = '"%s"' % etag
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.headers['Vary'] = 'Cookie'
+
+    def _not_modified(self, etag):
+        response = request.make_response('', status=304)
+        self._set_validators(response, etag)
+        return response
+
+    @http.route('/crm/campaign/analysis/export/csv', type='http', auth='user')
+    def campaign_analysis_export_csv(self, date_from=None, date_to=None, counts=None, **kw):
+        # Same whole-day range as the XLSX and PDF exports of the wizard
+        try:
+            date_from_datetime, date_to_datetime = request.env[
+                'crm.campaign.analysis.export.wizard']._normalize_range(date_from, date_to)
+        except ValueError:
+            return request.not_found()
+        include_counts = counts in ('1', 'true', 'True')
+
+        # The body is generated after this method returns and the request
+        # cursor is closed, so the generator works on a cursor of its own
+        registry = request.env.registry
+        uid = request.env.uid
+        context = dict(request.env.context)
+
+        def generate():
+            with registry.cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                with profile(env, 'export_csv'), phase('csv'):
+                    yield from env['crm.campaign.analysis.export.wizard']._iter_csv(
+                        date_from_datetime, date_to_datetime, include_counts)
+
+        filename = f'campaign_analysis_{datetime.now().strftime("%Y%m%d")}.csv'
+        return request.make_response(generate(), headers=[
+            ('Content-Type', 'text/csv; charset=utf-8'),
+            ('Content-Disposition', content_disposition(filename)),
+            ('X-Accel-Buffering', 'no'),
+        ])
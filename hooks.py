@@ -0,0 +1,6 @@
+def uninstall_hook(env):
+    # The rollup and generation triggers live on crm tables, which outlive this module
+    env['crm.campaign.analysis.rollup']._drop_rollup()
+    env['crm.campaign.analysis.report']._drop_generation_triggers()
+    env['crm.campaign.analysis.funnel']._drop_transitions()
+    env['crm.campaign.analysis.snapshot']._drop_snapshots()
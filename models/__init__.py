@@ -1 +1,11 @@
+from . import crm_campaign_analysis_rollup
 from . import crm_campaign_analysis_report
+from . import crm_campaign_analysis_funnel
+from . import crm_campaign_analysis_benchmark
+from . import crm_campaign_analysis_profile
+from . import crm_campaign_analysis_highlight_rule
+from . import crm_campaign_analysis_snapshot
+from . import crm_lead
+from . import ir_websocket
+from . import crm_stage
+from . import utm_campaign
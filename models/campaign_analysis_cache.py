@@ -0,0 +1,80 @@
+from collections import OrderedDict
+import threading
+import time
+
+# Defaults for the per-database analysis result cache
+CACHE_MAX_ENTRIES = 128
+CACHE_TTL = 300  # seconds
+
+
+class AnalysisCache(object):
+    """
+    Small thread-safe LRU cache with a time to live.
+
+    Every entry is stored with the data generation it was computed for; a
+    lookup with another generation is a miss and drops the entry, so bumping
+    the generation invalidates the whole cache without having to reach the
+    other workers. The TTL bounds the lifetime of an entry computed by a
+    transaction that raced with a concurrent write.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires_at, value = entry
+                if entry_generation == generation and expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def set(self, key, generation, value):
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(dbname):
+    """Return the analysis cache of the given database, creating it on first use"""
+    with _caches_lock:
+        cache = _caches.get(dbname)
+        if cache is None:
+            cache = _caches[dbname] = AnalysisCache()
+        return cache
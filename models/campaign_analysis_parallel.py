@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+
+from odoo import sql_db
+
+_logger = logging.getLogger(__name__)
+
+# PostgreSQL parallel workers per shard statement: the shards already use
+# one connection per worker, letting every shard start its own gather
+# workers on top would oversubscribe the cores
+SHARD_PARALLEL_WORKERS_PER_GATHER = 0
+
+
+def split_evenly(items, count):
+    """Split a list into at most ``count`` contiguous chunks of similar sizes"""
+    count = max(min(count, len(items)), 1)
+    size, extra = divmod(len(items), count)
+    chunks = []
+    start = 0
+    for index in range(count):
+        end = start + size + (1 if index < extra else 0)
+        if end > start:
+            chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def split_range(low, high, count):
+    """Split the inclusive range [low, high] into at most ``count`` inclusive ranges"""
+    count = max(min(count, high - low + 1), 1)
+    size = (high - low + 1) / count
+    bounds = [low + int(size * index) for index in range(count)] + [high + 1]
+    return [(bounds[index], bounds[index + 1] - 1) for index in range(count)]
+
+
+def has_pending_writes(cr):
+    """True when the transaction of ``cr`` wrote something not committed yet"""
+    # A transaction id is only assigned on the first write
+    cr.execute("SELECT txid_current_if_assigned() IS NOT NULL")
+    return cr.fetchone()[0]
+
+
+def run_shards(cr, queries, workers, read_own_writes=True):
+    """
+    Execute read-only (query, params) shards concurrently, each on its own
+    connection, and yield (index, rows) as they complete.
+
+    The shards import the snapshot of a separate coordinator transaction,
+    so they all read the same committed data. It is not exported from
+    ``cr`` itself: pg_export_snapshot() is refused in a subtransaction
+    (e.g. within a savepoint), and an exported snapshot would not include
+    the writes of ``cr`` anyway. When ``cr`` has pending writes that the
+    queries may depend on (``read_own_writes``), or with a single worker,
+    the shards run one after the other on ``cr`` instead. psycopg2
+    releases the GIL while waiting for PostgreSQL, so threads are enough
+    to keep one backend busy per worker.
+    """
+    if workers <= 1 or (read_own_writes and has_pending_writes(cr)):
+        for index, (query, params) in enumerate(queries):
+            cr.execute(query, params)
+            yield index, cr.fetchall()
+        return
+
+    db = sql_db.db_connect(cr.dbname)
+    with db.cursor() as coordinator_cr:
+        # The snapshot stays importable while the coordinator is open
+        coordinator_cr.execute("SELECT pg_export_snapshot()")
+        snapshot = coordinator_cr.fetchone()[0]
+
+        def run(query, params):
+            with db.cursor() as shard_cr:
+                # Must be the first statement of the shard transaction
+                shard_cr.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+                shard_cr.execute("SET LOCAL max_parallel_workers_per_gather = %s",
+                                 (SHARD_PARALLEL_WORKERS_PER_GATHER,))
+                shard_cr.execute(query, params)
+                rows = shard_cr.fetchall()
+                shard_cr.rollback()
+                return rows
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='campaign_analysis_shard') as executor:
+            futures = {executor.submit(run, query, params): index for index, (query, params) in enumerate(queries)}
+            try:
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
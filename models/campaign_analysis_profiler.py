@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+from odoo import SUPERUSER_ID, api
+
+_logger = logging.getLogger(__name__)
+
+# Context key enabling profiling for one call, the system parameter below
+# enables it for every call
+PROFILE_CONTEXT_KEY = 'campaign_analysis_profile'
+PROFILE_PARAMETER = 'crm_campaign_analysis.profiling'
+
+_local = threading.local()
+
+
+class Profile(object):
+    """
+    Timings of one invocation of the analysis (a page, a report, an
+    export). Phases may nest, e.g. 'sql' runs inside 'analysis'.
+    """
+
+    def __init__(self, name, cr):
+        self.name = name
+        self.cr = cr
+        self.started = time.perf_counter()
+        self.sql_start = cr.sql_log_count
+        self.phases = []
+        self.rows = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.duration = None
+        self.sql_count = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        self.sql_count = self.cr.sql_log_count - self.sql_start
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'duration': self.duration,
+            'sql_count': self.sql_count,
+            'rows': self.rows,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'phases': self.phases,
+        }
+
+    def server_timing(self):
+        """Value of a Server-Timing header, phases of the same name are summed"""
+        durations = {}
+        for entry in self.phases:
+            durations[entry['name']] = durations.get(entry['name'], 0.0) + entry['duration']
+        metrics = ['%s;dur=%.1f' % (name, duration * 1000) for name, duration in durations.items()]
+        metrics.append('total;dur=%.1f;desc="%s queries"' % ((self.duration or 0.0) * 1000, self.sql_count or 0))
+        return ', '.join(metrics)
+
+
+def is_profiling_enabled(env):
+    if env.context.get(PROFILE_CONTEXT_KEY):
+        return True
+    value = env['ir.config_parameter'].sudo().get_param(PROFILE_PARAMETER)
+    return value in ('1', 'True', 'true')
+
+
+def current_profile():
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def profile(env, name):
+    """
+    Profile the enclosed block when profiling is enabled, yielding the
+    Profile (or None when disabled). Nested calls join the outer profile.
+    On exit the profile is logged as a structured line and stored in
+    crm.campaign.analysis.profile.
+    """
+    active = current_profile()
+    if active is not None or not is_profiling_enabled(env):
+        yield active
+        return
+
+    active = _local.profile = Profile(name, env.cr)
+    try:
+        yield active
+    finally:
+        _local.profile = None
+        active.finish()
+        _logger.info("campaign_analysis_profile %s", json.dumps(active.to_dict()))
+        _store_profile(env, active)
+
+
+@contextmanager
+def phase(name):
+    """Record the duration and SQL statements of a phase of the current profile"""
+    active = current_profile()
+    if active is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    sql_start = active.cr.sql_log_count
+    try:
+        yield
+    finally:
+        active.phases.append({
+            'name': name,
+            'duration': time.perf_counter() - started,
+            'sql_count': active.cr.sql_log_count - sql_start,
+        })
+
+
+def record_rows(count):
+    active = current_profile()
+    if active is not None:
+        active.rows += count
+
+
+def record_cache(hit):
+    active = current_profile()
+    if active is not None:
+        if hit:
+            active.cache_hits += 1
+        else:
+            active.cache_misses += 1
+
+
+def _store_profile(env, active):
+    # On a cursor of its own: kept even if the profiled transaction rolls
+    # back, and usable after the request cursor is closed (streaming)
+    try:
+        with env.registry.cursor() as cr:
+            api.Environment(cr, SUPERUSER_ID, {})['crm.campaign.analysis.profile']._record(active, env.uid)
+    except Exception:
+        _logger.exception("Could not store campaign analysis profile %s", active.name)
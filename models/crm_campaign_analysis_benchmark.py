@@ -0,0 +1,361 @@
+from odoo import _, api, fields, models
+from odoo.exceptions import AccessError
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import tempfile
+import time
+
+from .crm_campaign_analysis_highlight_rule import stage_label
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_logger = logging.getLogger(__name__)
+
+# Leads inserted per statement while seeding
+SEED_BATCH_SIZE = 100000
+
+# Relative slowdown of a phase over the baseline reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# Phases whose duration is compared with the baseline
+PHASES = (
+    'seed', 'refresh', 'analysis_sql', 'analysis_matrix', 'analysis_nested',
+    'page_exact', 'page_estimate', 'comparison', 'json_matrix', 'json_compact', 'csv', 'xlsx', 'pdf_render', 'pdf_encode',
+)
+
+
+class CrmCampaignAnalysisBenchmark(models.AbstractModel):
+    """
+    Benchmark of the campaign analysis pipeline on synthetic leads.
+
+    Seeds campaigns, stages and leads with a skewed distribution straight
+    in SQL, then times every step of the pipeline (view refresh, analysis
+    SQL, Python reshaping, CSV/XLSX encoding, PDF rendering) and records
+    the query plans and the memory of the worker. The seeded data is
+    committed in a scratch transaction before the measurements, so that
+    they also cover the parallel shards (which only see committed data),
+    and deleted at the end unless ``keep_data`` is set. Meant to be run
+    from a shell on a local database, never in production, through
+    run_benchmark() which also handles the result and baseline files::
+
+        from odoo.addons.crm_campaign_analysis.models.crm_campaign_analysis_benchmark import run_benchmark
+        run_benchmark(env, leads=1000000, output_path='bench.json', baseline_path='baseline.json')
+    """
+    _name = 'crm.campaign.analysis.benchmark'
+    _description = 'CRM Campaign Analysis Benchmark'
+
+    @api.model
+    def _run_benchmark(self, leads=10000, campaigns=50, stages=None, skew=1.5, days=365,
+                       inactive_ratio=0.05, keep_data=False, include_pdf=True,
+                       baseline=None, tolerance=DEFAULT_TOLERANCE):
+        """
+        :param leads: number of leads to seed
+        :param campaigns: number of campaigns to seed
+        :param stages: minimum number of stages, missing ones are created
+        :param skew: >1 concentrates the leads on few campaigns and stages,
+                     1 spreads them uniformly
+        :param days: the leads are created over the last ``days`` days
+        :param inactive_ratio: share of archived leads
+        :param baseline: results of a previous run to compare the
+                         durations with
+        :return: dict with the parameters, ``timings`` (seconds per phase),
+                 ``peak_rss_kb`` (peak RSS of the whole process so far,
+                 after each phase), ``rss_growth_kb`` (how much that peak
+                 grew during each phase, 0 when the phase stayed below an
+                 earlier peak), ``sizes`` (bytes), ``pdf_chunks`` (rows and
+                 duration of each PDF chunk), ``plans`` and ``regressions``
+        """
+        if not self.env.is_superuser() and not self.env.is_system():
+            raise AccessError(_("Only administrators can run the campaign analysis benchmark."))
+        result = {
+            'params': {
+                'leads': leads,
+                'campaigns': campaigns,
+                'stages': stages,
+                'skew': skew,
+                'days': days,
+                'inactive_ratio': inactive_ratio,
+            },
+            'started_at': fields.Datetime.to_string(fields.Datetime.now()),
+            'timings': {},
+            'peak_rss_kb': {},
+            'rss_growth_kb': {},
+            'sizes': {},
+            'plans': {},
+            'errors': {},
+        }
+
+        registry = self.env.registry
+        with self._phase(result, 'seed'):
+            with registry.cursor() as seed_cr:
+                seeded = self.with_env(self.env(cr=seed_cr))._seed(
+                    leads, campaigns, stages, skew, days, inactive_ratio)
+        try:
+            with registry.cursor() as run_cr:
+                try:
+                    self.with_env(self.env(cr=run_cr))._run_phases(result, include_pdf)
+                finally:
+                    # Drop the side effects of the measurements (view refresh...)
+                    run_cr.rollback()
+        finally:
+            if not keep_data:
+                with registry.cursor() as cleanup_cr:
+                    self.with_env(self.env(cr=cleanup_cr))._unseed(seeded)
+
+        if baseline:
+            result['regressions'] = self._compare_baseline(result, baseline, tolerance)
+        return result
+
+    # ------------------------------------------------------------------
+    # Seeding
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _seed(self, leads, campaigns, stages, skew, days, inactive_ratio):
+        """
+        Create the campaigns and stages with the ORM and the leads in SQL
+        :return: dict with the ``campaign_ids`` and ``stage_ids`` created
+                 and the ``lead_id_range`` (first, last) of the leads
+        """
+        stage_model = self.env['crm.stage']
+        existing_stages = stage_model.search([], order='sequence')
+        missing = max((stages or 0) - len(existing_stages), 0)
+        new_stages = stage_model.create([
+            {'name': 'Benchmark stage %s' % index, 'sequence': 1000 + index}
+            for index in range(missing)
+        ])
+        stage_ids = (existing_stages | new_stages).ids
+
+        campaign_ids = self.env['utm.campaign'].create([
+            {'name': 'Benchmark campaign %s' % index}
+            for index in range(campaigns)
+        ]).ids
+        self.env.flush_all()
+
+        # random()^skew is biased towards 0, so the first campaigns and
+        # stages get most of the leads
+        now = datetime.utcnow()
+        first_id = last_id = None
+        for offset in range(0, leads, SEED_BATCH_SIZE):
+            self.env.cr.execute("""
+                WITH inserted AS (
+                INSERT INTO crm_lead (
+                    name, type, active, campaign_id, stage_id, company_id,
+                    create_date, write_date, create_uid, write_uid
+                )
+                SELECT
+                    'Benchmark lead ' || d.n,
+                    'opportunity',
+                    random() >= %(inactive_ratio)s,
+                    (%(campaign_ids)s::int[])[1 + floor(power(random(), %(skew)s) * %(campaign_count)s)::int],
+                    (%(stage_ids)s::int[])[1 + floor(power(random(), %(skew)s) * %(stage_count)s)::int],
+                    %(company_id)s,
+                    d.create_date,
+                    d.create_date,
+                    %(uid)s,
+                    %(uid)s
+                FROM (
+                    SELECT n, %(now)s - random() * %(days)s * interval '1 day' AS create_date
+                    FROM generate_series(%(first)s, %(last)s) n
+                ) d
+                RETURNING id
+                )
+                SELECT MIN(id), MAX(id) FROM inserted
+            """, {
+                'inactive_ratio': inactive_ratio,
+                'campaign_ids': campaign_ids,
+                'campaign_count': len(campaign_ids),
+                'stage_ids': stage_ids,
+                'stage_count': len(stage_ids),
+                'skew': skew,
+                'company_id': self.env.company.id,
+                'now': now,
+                'days': days,
+                'uid': self.env.uid,
+                'first': offset + 1,
+                'last': min(offset + SEED_BATCH_SIZE, leads),
+            })
+            batch_first, batch_last = self.env.cr.fetchone()
+            first_id = min(first_id or batch_first, batch_first)
+            last_id = max(last_id or batch_last, batch_last)
+            _logger.info("Benchmark: seeded %s/%s leads", min(offset + SEED_BATCH_SIZE, leads), leads)
+
+        self.env.cr.execute("ANALYZE crm_lead")
+        self.env.cr.execute("ANALYZE %s" % self.env['crm.campaign.analysis.rollup']._rollup_table)
+        return {
+            'campaign_ids': campaign_ids,
+            'stage_ids': new_stages.ids,
+            'lead_id_range': (first_id, last_id),
+        }
+
+    @api.model
+    def _unseed(self, seeded):
+        """Delete the data created by _seed()"""
+        first_id, last_id = seeded['lead_id_range']
+        if first_id is not None:
+            self.env.cr.execute("""
+                DELETE FROM crm_lead WHERE id BETWEEN %s AND %s AND campaign_id = ANY(%s)
+            """, (first_id, last_id, seeded['campaign_ids']))
+        self.env['utm.campaign'].browse(seeded['campaign_ids']).unlink()
+        self.env['crm.stage'].browse(seeded['stage_ids']).unlink()
+        _logger.info("Benchmark: deleted the seeded data")
+
+    # ------------------------------------------------------------------
+    # Measurements
+    # ------------------------------------------------------------------
+
+    def _phase(self, result, name):
+        return _Phase(result, name)
+
+    @api.model
+    def _run_phases(self, result, include_pdf):
+        report_model = self.env['crm.campaign.analysis.report'].with_context(campaign_analysis_no_cache=True)
+        wizard_model = self.env['crm.campaign.analysis.export.wizard']
+        cr = self.env.cr
+
+        with self._phase(result, 'refresh'):
+            report_model._refresh_view()
+
+        query, params = report_model._stage_distribution_query()
+        with self._phase(result, 'analysis_sql'):
+            cr.execute(query, params)
+            cr.fetchall()
+        result['plans']['stage_distribution'] = self._explain(query, params)
+        result['plans']['lead_index'] = self.env['crm.campaign.analysis.rollup']._check_lead_index_plan()
+
+        with self._phase(result, 'analysis_matrix'):
+            report_model._compute_stage_matrix()
+        with self._phase(result, 'analysis_nested'):
+            data = report_model.get_campaign_stage_analysis()
+        with self._phase(result, 'page_exact'):
+            report_model._compute_stage_page(None, None, 0, 100, 'total', None, True, None)
+        with self._phase(result, 'page_estimate'):
+            report_model._compute_stage_page(None, None, 0, 100, 'total', None, True, None, approximate=True)
+        # Last 30 days, the 30 days before and the same 30 days a year earlier
+        now = datetime.now()
+        ranges = [(now - timedelta(days=offset + 30), now - timedelta(days=offset)) for offset in (0, 30, 365)]
+        with self._phase(result, 'comparison'):
+            report_model._compute_stage_comparison(ranges, None)
+
+        matrix = report_model.get_campaign_stage_matrix()
+        with self._phase(result, 'json_matrix'):
+            result['sizes']['json_matrix'] = len(json.dumps(matrix))
+        with self._phase(result, 'json_compact'):
+            result['sizes']['json_compact'] = len(json.dumps(report_model._compact_payload(matrix)))
+
+        with self._phase(result, 'csv'):
+            result['sizes']['csv'] = sum(len(chunk) for chunk in wizard_model._iter_csv(include_counts=True))
+
+        stage_ids, stage_names = report_model._get_stages()
+        fd, path = tempfile.mkstemp(prefix='campaign_analysis_benchmark_', suffix='.xlsx')
+        os.close(fd)
+        try:
+            with self._phase(result, 'xlsx'):
+                wizard_model._write_xlsx(path, stage_ids, stage_names)
+            result['sizes']['xlsx'] = os.path.getsize(path)
+        finally:
+            os.unlink(path)
+
+        if include_pdf:
+            report = self.env.ref('crm_campaign_analysis.action_report_campaign_analysis')
+            stage_labels = [stage_label(stage_name) for stage_name in matrix['stage_names']]
+            values = wizard_model._pdf_chunk_values(
+                matrix, 0, len(matrix['campaign_ids']), stage_labels,
+                self.env['crm.campaign.analysis.highlight.rule']._compile(matrix['stage_names']))
+            values.update(date_from=None, date_to=None, chunk_index=0, chunk_count=1)
+            try:
+                # QWeb alone, on the whole report as a single chunk
+                with self._phase(result, 'pdf_render'):
+                    html = report._render_qweb_html(report.report_name, [], data=values)[0]
+                result['sizes']['html'] = len(html)
+                # The chunked pipeline of the PDF export
+                with self._phase(result, 'pdf_encode'):
+                    pdf, result['pdf_chunks'] = wizard_model._render_pdf(matrix)
+                result['sizes']['pdf'] = len(pdf)
+            except Exception as e:
+                # e.g. wkhtmltopdf missing on the benchmark host
+                result['errors']['pdf'] = str(e)
+
+    @api.model
+    def _explain(self, query, params):
+        """Actual plan of a query, with buffer usage"""
+        self.env.cr.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        plan = self.env.cr.fetchone()[0]
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    @api.model
+    def _compare_baseline(self, result, baseline, tolerance):
+        """Phases slower than the baseline by more than ``tolerance``"""
+        if baseline.get('params') != result['params']:
+            _logger.warning("Benchmark: the baseline was run with other parameters")
+
+        regressions = []
+        for phase in PHASES:
+            before = baseline.get('timings', {}).get(phase)
+            after = result['timings'].get(phase)
+            if before and after and after > before * (1 + tolerance):
+                regressions.append({'phase': phase, 'baseline': before, 'duration': after,
+                                    'ratio': after / before})
+        for regression in regressions:
+            _logger.warning("Benchmark: %(phase)s took %(duration).3fs, baseline %(baseline).3fs", regression)
+        return regressions
+
+
+def run_benchmark(env, output_path=None, baseline_path=None, **params):
+    """
+    Run the benchmark from an Odoo shell: compare it with the results
+    stored in ``baseline_path`` and write its results to ``output_path``
+    (JSON). The files are only handled here, never through RPC.
+    :param params: see CrmCampaignAnalysisBenchmark._run_benchmark()
+    :return: the results
+    """
+    if baseline_path:
+        try:
+            with open(baseline_path) as baseline_file:
+                params['baseline'] = json.load(baseline_file)
+        except (OSError, ValueError) as e:
+            _logger.warning("Benchmark: cannot read baseline %s: %s", baseline_path, e)
+    result = env['crm.campaign.analysis.benchmark']._run_benchmark(**params)
+    if output_path:
+        with open(output_path, 'w') as output:
+            json.dump(result, output, indent=2, default=str)
+    return result
+
+
+def _peak_rss_kb():
+    """
+    Peak resident set size of this process since it started in KB (not of
+    the current phase), None if unknown
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _Phase(object):
+    """
+    Context manager recording the duration of a phase, the peak RSS of the
+    process after it and how much the phase raised that peak
+    """
+
+    def __init__(self, result, name):
+        self.result = result
+        self.name = name
+
+    def __enter__(self):
+        self.peak_before = _peak_rss_kb()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.started
+        self.result['timings'][self.name] = duration
+        peak = _peak_rss_kb()
+        self.result['peak_rss_kb'][self.name] = peak
+        self.result['rss_growth_kb'][self.name] = peak - self.peak_before if peak is not None else None
+        _logger.info("Benchmark: %s took %.3fs", self.name, duration)
@@ -0,0 +1,326 @@
+from odoo import api, fields, models
+import logging
+
+from .campaign_analysis_cache import get_cache
+from .campaign_analysis_profiler import phase, profile, record_cache, record_rows
+
+_logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the transition table changes: init() rebuilds it
+TRANSITION_VERSION = '2'
+
+# Highlight rule (XML id or database id) matching the stages counted as
+# Admission by the funnel
+ADMISSION_RULE_PARAMETER = 'crm_campaign_analysis.admission_rule'
+DEFAULT_ADMISSION_RULE = 'crm_campaign_analysis.highlight_rule_admission'
+
+
+class CrmCampaignAnalysisFunnel(models.AbstractModel):
+    """
+    Conversion funnel and time in stage per campaign.
+
+    Stage changes of leads are copied from mail.tracking.value into a
+    compact append-only table (one row per change) by a trigger, in the
+    transaction that tracks the change, so that an analysis only reads
+    the history of the leads of its date range and no change is missed
+    whatever the order in which transactions commit.
+    """
+    _name = 'crm.campaign.analysis.funnel'
+    _description = 'CRM Campaign Analysis Funnel'
+
+    _transition_table = 'crm_campaign_analysis_transition'
+
+    def init(self):
+        cr = self.env.cr
+        table = self._transition_table
+        cr.execute("SELECT obj_description(to_regclass(%s), 'pg_class')", (table,))
+        if cr.fetchone()[0] == TRANSITION_VERSION:
+            self._create_transition_trigger()
+            return
+
+        cr.execute("DROP TABLE IF EXISTS %s CASCADE" % table)
+        cr.execute("""
+            CREATE TABLE %(table)s (
+                tracking_id integer PRIMARY KEY,
+                lead_id integer NOT NULL,
+                old_stage_id integer NOT NULL DEFAULT 0,
+                new_stage_id integer NOT NULL DEFAULT 0,
+                changed_at timestamp NOT NULL
+            );
+            CREATE INDEX %(table)s_lead_idx ON %(table)s (lead_id, changed_at);
+            COMMENT ON TABLE %(table)s IS '%(version)s';
+        """ % {'table': table, 'version': TRANSITION_VERSION})
+        # Trigger first: it blocks the new tracking values until the copy of
+        # the existing ones commits
+        self._create_transition_trigger()
+        self._backfill_transitions()
+
+    @api.model
+    def _drop_transitions(self):
+        """Remove the trigger, function and transition table (used on uninstall)"""
+        self.env.cr.execute("""
+            DROP TRIGGER IF EXISTS %(table)s_ins ON mail_tracking_value;
+            DROP FUNCTION IF EXISTS %(table)s_ins();
+            DROP TABLE IF EXISTS %(table)s CASCADE;
+        """ % {'table': self._transition_table})
+
+    # ------------------------------------------------------------------
+    # Maintenance
+    # ------------------------------------------------------------------
+
+    def _transitions_sql(self, source):
+        """SELECT of the transitions of the lead stage tracking values of ``source``"""
+        return """
+            SELECT v.id, m.res_id, COALESCE(v.old_value_integer, 0), COALESCE(v.new_value_integer, 0), m.date
+            FROM %s v
+            JOIN mail_message m ON m.id = v.mail_message_id
+            JOIN ir_model_fields f ON f.id = v.field_id
+            WHERE m.model = 'crm.lead' AND f.model = 'crm.lead' AND f.name = 'stage_id'
+        """ % source
+
+    def _create_transition_trigger(self):
+        """Copy the lead stage tracking values as they are inserted"""
+        self.env.cr.execute("""
+            CREATE OR REPLACE FUNCTION %(table)s_ins() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO %(table)s (tracking_id, lead_id, old_stage_id, new_stage_id, changed_at)
+                %(select)s
+                ON CONFLICT (tracking_id) DO NOTHING;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS %(table)s_ins ON mail_tracking_value;
+            CREATE TRIGGER %(table)s_ins
+                AFTER INSERT ON mail_tracking_value
+                REFERENCING NEW TABLE AS new_values
+                FOR EACH STATEMENT EXECUTE FUNCTION %(table)s_ins();
+        """ % {'table': self._transition_table, 'select': self._transitions_sql('new_values')})
+
+    @api.model
+    def _backfill_transitions(self):
+        """Copy the lead stage changes tracked before the trigger existed"""
+        cr = self.env.cr
+        cr.execute("""
+            INSERT INTO %s (tracking_id, lead_id, old_stage_id, new_stage_id, changed_at)
+        """ % self._transition_table + self._transitions_sql('mail_tracking_value') + """
+            ON CONFLICT (tracking_id) DO NOTHING
+        """)
+        _logger.info("Copied %s lead stage transitions", cr.rowcount)
+
+    # ------------------------------------------------------------------
+    # Funnel
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _get_admission_stage_ids(self):
+        """
+        Stages counted as Admission: the stages matched by the highlight
+        rule set in the crm_campaign_analysis.admission_rule parameter
+        """
+        value = self.env['ir.config_parameter'].sudo().get_param(ADMISSION_RULE_PARAMETER, DEFAULT_ADMISSION_RULE)
+        rule_model = self.env['crm.campaign.analysis.highlight.rule'].sudo()
+        if str(value).isdigit():
+            rule = rule_model.browse(int(value)).exists()
+        else:
+            rule = self.env.ref(value, raise_if_not_found=False)
+        if not rule or rule._name != rule_model._name:
+            _logger.warning("No highlight rule %s for the Admission stages of the funnel", value)
+            return []
+        return [stage.id for stage in self.env['crm.stage'].search([]) if rule._match_stage(stage.name)]
+
+    @api.model
+    def get_campaign_funnel(self, date_from=None, date_to=None):
+        """
+        Funnel of the leads created within the range, per campaign
+        :return: dict with parallel lists ``campaign_ids``/``campaign_names``/
+                 ``totals`` (leads of the cohort), ``stage_ids``/``stage_names``,
+                 per campaign and stage matrices ``visited`` (leads that have
+                 been in the stage), ``conversions`` (share of the leads
+                 that have been in the previous stage which have also been
+                 in the stage, in any order, so never above 1: leads can
+                 skip stages or go back; None for the first stage),
+                 ``avg_days_in_stage`` and
+                 ``median_days_in_stage`` (completed stays only), and
+                 ``median_days_to_admission`` per campaign
+        """
+        with profile(self.env, 'funnel'):
+            report_model = self.env['crm.campaign.analysis.report']
+            cache = get_cache(self.env.cr.dbname)
+            key = report_model._get_cache_key(date_from, date_to, 'funnel')
+            generation = report_model._get_data_generation()
+            result = cache.get(key, generation)
+            record_cache(result is not None)
+            if result is None:
+                result = self._compute_funnel(date_from, date_to)
+                report_model._cache_result(cache, key, generation, result)
+            return result
+
+    @api.model
+    def _cohort_query(self, date_from=None, date_to=None):
+        """
+        CTEs ``cohort`` (leads created within the range and visible to the
+        user), ``history`` (their transitions, with the time each stage
+        was entered) and ``visited`` (stages each lead has been in)
+        :return: tuple (query, params)
+        """
+        rollup_model = self.env['crm.campaign.analysis.rollup']
+        scope_conditions, params = rollup_model._scope_conditions(
+            self.env['crm.campaign.analysis.report']._get_access_scope(), raw=True, alias='l')
+        conditions = list(scope_conditions)
+        if date_from:
+            conditions.append("l.create_date >= %s")
+            params.append(fields.Datetime.to_datetime(date_from))
+        if date_to:
+            conditions.append("l.create_date <= %s")
+            params.append(fields.Datetime.to_datetime(date_to))
+
+        query = """
+            WITH cohort AS (
+                SELECT l.id, l.campaign_id, COALESCE(l.stage_id, 0) AS stage_id, l.create_date
+                FROM crm_lead l
+                JOIN utm_campaign c ON c.id = l.campaign_id AND c.active = True
+                WHERE l.campaign_id IS NOT NULL AND l.active
+                """ + "".join(" AND " + condition for condition in conditions) + """
+            ),
+            history AS (
+                SELECT
+                    t.lead_id,
+                    t.old_stage_id,
+                    t.new_stage_id,
+                    t.changed_at,
+                    COALESCE(LAG(t.changed_at) OVER (PARTITION BY t.lead_id ORDER BY t.changed_at, t.tracking_id),
+                             cohort.create_date) AS entered_at
+                FROM """ + self._transition_table + """ t
+                JOIN cohort ON cohort.id = t.lead_id
+            ),
+            visited AS (
+                SELECT lead_id, old_stage_id AS stage_id FROM history
+                UNION
+                SELECT lead_id, new_stage_id FROM history
+                UNION
+                SELECT id, stage_id FROM cohort
+            )
+        """
+        return query, params
+
+    @api.model
+    def _compute_funnel(self, date_from=None, date_to=None):
+        cr = self.env.cr
+        stage_ids, stage_names = self.env['crm.campaign.analysis.report']._get_stages()
+        stage_index = {stage_id: index for index, stage_id in enumerate(stage_ids)}
+        cohort_query, params = self._cohort_query(date_from, date_to)
+
+        # One statement for all the figures: the cohort and history CTEs
+        # are referenced several times, so PostgreSQL computes them once
+        # instead of scanning crm_lead and the transitions for each figure
+        with phase('sql'):
+            cr.execute(cohort_query + """
+                SELECT 'total', c.id, NULL::integer, COUNT(*), NULL::float8, NULL::float8, c.name
+                FROM cohort
+                JOIN utm_campaign c ON c.id = cohort.campaign_id
+                GROUP BY c.id, c.name
+                UNION ALL
+                SELECT 'visited', cohort.campaign_id, visited.stage_id, COUNT(*), NULL, NULL, NULL
+                FROM visited
+                JOIN cohort ON cohort.id = visited.lead_id
+                GROUP BY 2, 3
+                UNION ALL
+                SELECT
+                    'stay',
+                    cohort.campaign_id,
+                    h.old_stage_id,
+                    NULL,
+                    AVG(EXTRACT(EPOCH FROM h.changed_at - h.entered_at)) / 86400,
+                    percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM h.changed_at - h.entered_at)) / 86400,
+                    NULL
+                FROM history h
+                JOIN cohort ON cohort.id = h.lead_id
+                GROUP BY 2, 3
+                UNION ALL
+                SELECT
+                    'admission',
+                    cohort.campaign_id,
+                    NULL,
+                    NULL,
+                    NULL,
+                    percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM a.admitted_at - cohort.create_date)) / 86400,
+                    NULL
+                FROM (
+                    SELECT lead_id, MIN(changed_at) AS admitted_at
+                    FROM history
+                    WHERE new_stage_id = ANY(%s)
+                    GROUP BY lead_id
+                ) a
+                JOIN cohort ON cohort.id = a.lead_id
+                GROUP BY 2
+                UNION ALL
+                SELECT 'both', cohort.campaign_id, p.next_stage_id, COUNT(*), NULL, NULL, NULL
+                FROM unnest(%s::integer[], %s::integer[]) AS p(stage_id, next_stage_id)
+                JOIN visited v ON v.stage_id = p.stage_id
+                JOIN visited next_v ON next_v.lead_id = v.lead_id AND next_v.stage_id = p.next_stage_id
+                JOIN cohort ON cohort.id = v.lead_id
+                GROUP BY 2, 3
+            """, params + [self._get_admission_stage_ids(), stage_ids[:-1], stage_ids[1:]])
+            rows = cr.fetchall()
+        record_rows(len(rows))
+
+        campaigns = sorted(
+            ((campaign_id, name, count) for kind, campaign_id, _stage_id, count, _average, _median, name in rows
+             if kind == 'total'),
+            key=lambda campaign: (campaign[1], campaign[0]),
+        )
+        visited_rows = [(campaign_id, stage_id, count)
+                        for kind, campaign_id, stage_id, count, _average, _median, _name in rows
+                        if kind == 'visited']
+        stay_rows = [(campaign_id, stage_id, average, median)
+                     for kind, campaign_id, stage_id, _count, average, median, _name in rows
+                     if kind == 'stay']
+        both_rows = [(campaign_id, stage_id, count)
+                     for kind, campaign_id, stage_id, count, _average, _median, _name in rows
+                     if kind == 'both']
+        admission_rows = {campaign_id: median
+                          for kind, campaign_id, _stage_id, _count, _average, median, _name in rows
+                          if kind == 'admission'}
+
+        with phase('reshape'):
+            row_index = {campaign_id: row for row, (campaign_id, name, total) in enumerate(campaigns)}
+            visited = [[0] * len(stage_ids) for _campaign in campaigns]
+            avg_days = [[None] * len(stage_ids) for _campaign in campaigns]
+            median_days = [[None] * len(stage_ids) for _campaign in campaigns]
+            # Leads that have been in both a stage and the previous one,
+            # indexed by the column of the stage
+            both = [[0] * len(stage_ids) for _campaign in campaigns]
+            for campaign_id, stage_id, count in visited_rows:
+                if stage_id in stage_index:
+                    visited[row_index[campaign_id]][stage_index[stage_id]] = count
+            for campaign_id, stage_id, count in both_rows:
+                both[row_index[campaign_id]][stage_index[stage_id]] = count
+            for campaign_id, stage_id, average, median in stay_rows:
+                if stage_id in stage_index:
+                    avg_days[row_index[campaign_id]][stage_index[stage_id]] = float(average)
+                    median_days[row_index[campaign_id]][stage_index[stage_id]] = float(median)
+
+            conversions = [
+                [None] + [
+                    both[row][col] / counts[col - 1] if counts[col - 1] else None
+                    for col in range(1, len(stage_ids))
+                ] if stage_ids else []
+                for row, counts in enumerate(visited)
+            ]
+
+            return {
+                'campaign_ids': [campaign[0] for campaign in campaigns],
+                'campaign_names': [campaign[1] for campaign in campaigns],
+                'totals': [campaign[2] for campaign in campaigns],
+                'stage_ids': stage_ids,
+                'stage_names': stage_names,
+                'visited': visited,
+                'conversions': conversions,
+                'avg_days_in_stage': avg_days,
+                'median_days_in_stage': median_days,
+                'median_days_to_admission': [
+                    float(admission_rows[campaign[0]]) if admission_rows.get(campaign[0]) is not None else None
+                    for campaign in campaigns
+                ],
+            }
@@ -0,0 +1,122 @@
+from odoo import api, fields, models, tools
+import math
+
+
+def stage_label(stage_name):
+    """Plain stage label, also when the name comes as a translation dict"""
+    if isinstance(stage_name, dict):
+        # Use the first value in the dict or a default value if empty
+        return next(iter(stage_name.values()), "Unknown")
+    return stage_name
+
+
+def _split_names(value):
+    return tuple(name.strip().upper() for name in (value or '').split(',') if name.strip())
+
+
+class CrmCampaignAnalysisHighlightRule(models.Model):
+    """
+    Red highlight of stage percentages, e.g. JUNK above 20%.
+
+    Rules match stages by name and are compiled once per request into
+    (low, high) bounds per stage column: every output (web page, dashboard,
+    HTML/PDF reports, XLSX) then flags a cell with two comparisons.
+    """
+    _name = 'crm.campaign.analysis.highlight.rule'
+    _description = 'CRM Campaign Analysis Highlight Rule'
+    _order = 'sequence, id'
+
+    name = fields.Char('Stages', required=True, translate=True,
+                       help="Label of the stages in the legend, e.g. Admission (A)")
+    sequence = fields.Integer(default=10)
+    active = fields.Boolean(default=True)
+    stage_keywords = fields.Char('Stage Name Contains',
+                                 help="Comma-separated words, a stage matches when its name contains one of them")
+    stage_codes = fields.Char('Stage Name Is',
+                              help="Comma-separated names, a stage matches when its name is one of them")
+    comparator = fields.Selection([
+        ('>', 'Above'),
+        ('<', 'Below'),
+    ], string='Highlight When', required=True, default='>')
+    threshold = fields.Float('Threshold (%)', required=True)
+
+    _sql_constraints = [
+        ('threshold_range', 'CHECK(threshold >= 0 AND threshold <= 100)',
+         'The threshold is a percentage, between 0 and 100.'),
+    ]
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env.registry.clear_cache()
+        return records
+
+    def write(self, vals):
+        result = super().write(vals)
+        self.env.registry.clear_cache()
+        return result
+
+    def unlink(self):
+        result = super().unlink()
+        self.env.registry.clear_cache()
+        return result
+
+    @api.model
+    @tools.ormcache('self.env.lang')
+    def _get_rules(self):
+        """Active rules as (keywords, codes, comparator, threshold, legend) tuples"""
+        return tuple(
+            (_split_names(rule.stage_keywords), _split_names(rule.stage_codes), rule.comparator, rule.threshold,
+             '%s %s %g%%' % (rule.name, rule.comparator, rule.threshold))
+            for rule in self.sudo().search([])
+        )
+
+    def _match_stage(self, stage_name):
+        """Whether the rule applies to the stage with this name"""
+        self.ensure_one()
+        name = str(stage_label(stage_name) or '').upper()
+        return name in _split_names(self.stage_codes) or any(
+            keyword in name for keyword in _split_names(self.stage_keywords))
+
+    @api.model
+    def _compile(self, stage_names):
+        """
+        Compile the rules for the given stage columns
+        :return: list of (low, high) per stage, a percentage is highlighted
+                 when it is below low or above high
+        """
+        rules = self._get_rules()
+        bounds = []
+        for stage_name in stage_names:
+            name = str(stage_label(stage_name) or '').upper()
+            low, high = -math.inf, math.inf
+            for keywords, codes, comparator, threshold, _legend in rules:
+                if name in codes or any(keyword in name for keyword in keywords):
+                    if comparator == '>':
+                        high = min(high, threshold)
+                    else:
+                        low = max(low, threshold)
+            bounds.append((low, high))
+        return bounds
+
+    @api.model
+    def _get_legend(self):
+        return [legend for _keywords, _codes, _comparator, _threshold, legend in self._get_rules()]
+
+    @api.model
+    def _get_payload(self, stage_names):
+        """Compiled rules for RPC clients, None standing for no bound"""
+        bounds = self._compile(stage_names)
+        return {
+            'highlight_low': [low if low != -math.inf else None for low, high in bounds],
+            'highlight_high': [high if high != math.inf else None for low, high in bounds],
+            'highlight_legend': self._get_legend(),
+        }
+
+    @api.model
+    def _get_template_values(self, stage_names):
+        """Compiled rules for QWeb templates, from a {stage_id: name} dict"""
+        return {
+            'highlight_bounds': dict(zip(stage_names, self._compile(list(stage_names.values())))),
+            'highlight_legend': self._get_legend(),
+        }
@@ -0,0 +1,45 @@
+from odoo import api, fields, models
+from datetime import timedelta
+import json
+
+# Profiles older than this are removed by the autovacuum
+PROFILE_RETENTION_DAYS = 7
+
+# Number of recent profiles kept, the slowest ones first
+MAX_PROFILES = 200
+
+
+class CrmCampaignAnalysisProfile(models.Model):
+    """Slowest recent invocations of the analysis, see campaign_analysis_profiler"""
+    _name = 'crm.campaign.analysis.profile'
+    _description = 'CRM Campaign Analysis Profile'
+    _order = 'duration desc'
+
+    name = fields.Char('Invocation', readonly=True)
+    user_id = fields.Many2one('res.users', string='User', readonly=True)
+    duration = fields.Float('Duration (s)', readonly=True, digits=(16, 3))
+    sql_count = fields.Integer('SQL Statements', readonly=True)
+    row_count = fields.Integer('Rows', readonly=True)
+    cache_hits = fields.Integer('Cache Hits', readonly=True)
+    cache_misses = fields.Integer('Cache Misses', readonly=True)
+    phases = fields.Text('Phases', readonly=True)
+
+    @api.model
+    def _record(self, profile, uid):
+        return self.create({
+            'name': profile.name,
+            'user_id': uid,
+            'duration': profile.duration,
+            'sql_count': profile.sql_count,
+            'row_count': profile.rows,
+            'cache_hits': profile.cache_hits,
+            'cache_misses': profile.cache_misses,
+            'phases': json.dumps(profile.phases, indent=1),
+        })
+
+    @api.autovacuum
+    def _gc_profiles(self):
+        """Drop old profiles and keep only the slowest recent ones"""
+        limit_date = fields.Datetime.now() - timedelta(days=PROFILE_RETENTION_DAYS)
+        self.search([('create_date', '<', limit_date)]).unlink()
+        self.search([], offset=MAX_PROFILES).unlink()
@@ -1,11 +1,49 @@
-from odoo import api, fields, models, tools
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError
+from odoo.osv import expression
 from psycopg2 import sql
 import datetime
 import logging
 
+from .campaign_analysis_cache import get_cache
+from .campaign_analysis_parallel import has_pending_writes, run_shards, split_evenly
+from .campaign_analysis_profiler import phase, profile, record_cache, record_rows
+
 _logger = logging.getLogger(__name__)
 
+# Default upper bound, in minutes, on how old the materialized view may get
+# before a read schedules a background refresh
+DEFAULT_MAX_STALENESS = 15
+
+# Sequence bumped whenever data shown by the analysis changes
+GENERATION_SEQUENCE = 'crm_campaign_analysis_generation_seq'
+
+# Number of rows fetched per round trip when streaming analysis rows
+FETCH_SIZE = 2000
+
+# Campaign rows per page of the paginated analysis
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Below this number of campaigns a parallel analysis is not worth the
+# extra connections
+PARALLEL_MIN_CAMPAIGNS = 200
+
+# Time buckets available for the report rows
+REPORT_GRAINS = ('day', 'week', 'month')
+DEFAULT_REPORT_GRAIN = 'day'
+
+# Time buckets available for the trend series
+TREND_GRAINS = ('week', 'month')
+
+# Date ranges compared at most in one call, each adds two aggregates per row
+MAX_COMPARISON_RANGES = 12
+
+# Per campaign and stage matrices of the payloads, flattened or left out by
+# _compact_payload()
+COUNT_MATRICES = ('counts', 'counts_low', 'counts_high')
+PERCENTAGE_MATRICES = ('percentages', 'percentages_low', 'percentages_high')
+
 class CrmCampaignAnalysisReport(models.Model):
     _name = 'crm.campaign.analysis.report'
     _description = 'CRM Campaign Analysis Report'
@@ -15,51 +53,183 @@ class CrmCampaignAnalysisReport(models.Model):
 
     campaign_id = fields.Many2one('utm.campaign', string='Campaign', readonly=True)
     stage_id = fields.Many2one('crm.stage', string='Stage', readonly=True)
+    company_id = fields.Many2one('res.company', string='Company', readonly=True)
+    team_id = fields.Many2one('crm.team', string='Sales Team', readonly=True)
+    user_id = fields.Many2one('res.users', string='Salesperson', readonly=True)
     create_date = fields.Datetime(string='Created On', readonly=True)
     lead_count = fields.Integer(string='Lead Count', readonly=True)
     total_leads = fields.Integer(string='Total Campaign Leads', readonly=True)
-    percentage = fields.Float(string='Percentage', readonly=True, group_operator="avg", digits=(16, 2))
+    # Aggregated as a weighted ratio of lead counts, see read_group()
+    percentage = fields.Float(string='Percentage', readonly=True, digits=(16, 2))
 
     def init(self):
-        # First check if the table exists
-        self.env.cr.execute("SELECT to_regclass(%s)", (self._table,))
-        exists = self.env.cr.fetchone()[0]
-        
         # Handle the case where it might be a regular view first
         tools.drop_view_if_exists(self.env.cr, self._table)
-        
+
+        self._create_view(self._get_report_grain())
+
+        # Keep track of when the view was last refreshed, shared by all workers
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS crm_campaign_analysis_refresh (
+                view_name varchar PRIMARY KEY,
+                refreshed_at timestamp NOT NULL
+            )
+        """)
+        self.env.cr.execute("""
+            INSERT INTO crm_campaign_analysis_refresh (view_name, refreshed_at)
+            VALUES (%s, now() at time zone 'UTC')
+            ON CONFLICT (view_name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at
+        """, (self._table,))
+
+        self._create_generation_triggers()
+
+    def _create_generation_triggers(self):
+        """
+        Bump the data generation whenever leads, stages or campaigns change.
+        A sequence is used on purpose: nextval() is non-transactional and
+        takes no row lock, so concurrent lead writes never queue on it.
+        Being non-transactional, the bump of a trigger is visible before
+        the write commits: ORM writes bump the generation again after
+        their commit (see _bump_generation_after_commit()), the triggers
+        catch the writes done in SQL.
+        """
+        cr = self.env.cr
+        cr.execute("CREATE SEQUENCE IF NOT EXISTS %s" % GENERATION_SEQUENCE)
+        cr.execute("""
+            CREATE OR REPLACE FUNCTION crm_campaign_analysis_bump_generation() RETURNS trigger AS $$
+            BEGIN
+                PERFORM nextval('%s');
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """ % GENERATION_SEQUENCE)
+        cr.execute("""
+            DROP TRIGGER IF EXISTS crm_campaign_analysis_generation ON crm_lead;
+            CREATE TRIGGER crm_campaign_analysis_generation
+                AFTER INSERT OR DELETE OR UPDATE OF campaign_id, stage_id, active, create_date,
+                    company_id, team_id, user_id ON crm_lead
+                FOR EACH STATEMENT EXECUTE FUNCTION crm_campaign_analysis_bump_generation();
+
+            DROP TRIGGER IF EXISTS crm_campaign_analysis_generation ON crm_stage;
+            CREATE TRIGGER crm_campaign_analysis_generation
+                AFTER INSERT OR DELETE OR UPDATE ON crm_stage
+                FOR EACH STATEMENT EXECUTE FUNCTION crm_campaign_analysis_bump_generation();
+
+            DROP TRIGGER IF EXISTS crm_campaign_analysis_generation ON utm_campaign;
+            CREATE TRIGGER crm_campaign_analysis_generation
+                AFTER INSERT OR DELETE OR UPDATE OF name, active ON utm_campaign
+                FOR EACH STATEMENT EXECUTE FUNCTION crm_campaign_analysis_bump_generation();
+        """)
+
+    @api.model
+    def _drop_generation_triggers(self):
+        """Remove the generation triggers (used on uninstall)"""
+        self.env.cr.execute("""
+            DROP TRIGGER IF EXISTS crm_campaign_analysis_generation ON crm_lead;
+            DROP TRIGGER IF EXISTS crm_campaign_analysis_generation ON crm_stage;
+            DROP TRIGGER IF EXISTS crm_campaign_analysis_generation ON utm_campaign;
+            DROP FUNCTION IF EXISTS crm_campaign_analysis_bump_generation();
+            DROP SEQUENCE IF EXISTS %s;
+        """ % GENERATION_SEQUENCE)
+
+    @api.model
+    def _get_data_generation(self):
+        """Current data generation, shared by all workers"""
+        # A new sequence reports last_value 1, like after its first nextval()
+        self.env.cr.execute("SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM %s" % GENERATION_SEQUENCE)
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _bump_generation_after_commit(self):
+        """
+        Bump the data generation once the current transaction commits.
+        Results computed by concurrent readers before the commit, from
+        the data before the write, then never match the generation again.
+        """
+        data = self.env.cr.postcommit.data
+        if data.get('crm_campaign_analysis.bump_generation'):
+            return
+        data['crm_campaign_analysis.bump_generation'] = True
+        registry = self.env.registry
+
+        @self.env.cr.postcommit.add
+        def bump_generation():
+            with registry.cursor() as cr:
+                cr.execute("SELECT nextval(%s)", (GENERATION_SEQUENCE,))
+
+    @api.model
+    def _cache_result(self, cache, key, generation, value):
+        """
+        Store a result computed for ``generation``, unless the generation
+        moved meanwhile: the result may then mix data before and after the
+        change, and would be served under the new generation. Nothing is
+        stored either when the transaction has uncommitted writes: the
+        result may include them and they can still be rolled back.
+        """
+        if has_pending_writes(self.env.cr):
+            return
+        if self._get_data_generation() == generation:
+            cache.set(key, generation, value)
+
+    @api.model
+    def _get_report_grain(self):
+        """Time bucket of the report rows: 'day', 'week' or 'month'"""
+        grain = self.env['ir.config_parameter'].sudo().get_param(
+            'crm_campaign_analysis.report_grain', DEFAULT_REPORT_GRAIN)
+        return grain if grain in REPORT_GRAINS else DEFAULT_REPORT_GRAIN
+
+    @api.model
+    def _get_view_grain(self):
+        """Grain the materialized view was built with, None if it does not exist"""
+        self.env.cr.execute("SELECT obj_description(to_regclass(%s), 'pg_class')", (self._table,))
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _create_view(self, grain):
+        """
+        (Re)create the materialized view at the given time grain.
+        The view holds one row per (campaign, stage, bucket) and access
+        scope (company, sales team, salesperson), so the pivot and graph
+        views group a number of rows independent of the number of leads,
+        and the record rules of the report apply to it.
+        """
         # Now try to drop it if it's a materialized view (should only happen on re-install)
         try:
-            self.env.cr.execute("DROP MATERIALIZED VIEW IF EXISTS %s CASCADE" % self._table)
+            with self.env.cr.savepoint():
+                self.env.cr.execute("DROP MATERIALIZED VIEW IF EXISTS %s CASCADE" % self._table)
         except Exception:
             # If this fails, it's ok - the view doesn't exist or is already dropped
             pass
-            
-        # Create a materialized view for better performance
+
+        # Create a materialized view for better performance. It reads the
+        # buckets of the trigger-maintained rollup, so a refresh never scans
+        # the crm_lead table. total_leads is the campaign total within the
+        # same bucket and company.
+        rollup_table = self.env['crm.campaign.analysis.rollup']._rollup_table
         self.env.cr.execute("""
             CREATE MATERIALIZED VIEW %s AS (
                 SELECT
-                    row_number() OVER () AS id,
-                    l.campaign_id,
-                    l.stage_id,
-                    l.create_date,
-                    COUNT(l.id) AS lead_count,
-                    camp_total.total_count AS total_leads,
-                    (COUNT(l.id) * 100.0 / NULLIF(camp_total.total_count, 0)) AS percentage
+                    row_number() OVER (ORDER BY r.campaign_id, r.stage_id, r.period,
+                                       r.company_id, r.team_id, r.user_id) AS id,
+                    r.campaign_id,
+                    NULLIF(r.stage_id, 0) AS stage_id,
+                    NULLIF(r.company_id, 0) AS company_id,
+                    NULLIF(r.team_id, 0) AS team_id,
+                    NULLIF(r.user_id, 0) AS user_id,
+                    r.period::timestamp AS create_date,
+                    r.lead_count,
+                    SUM(r.lead_count) OVER w AS total_leads,
+                    (r.lead_count * 100.0 / NULLIF(SUM(r.lead_count) OVER w, 0)) AS percentage
                 FROM
-                    crm_lead l
-                JOIN
-                    (SELECT campaign_id, COUNT(id) AS total_count
-                     FROM crm_lead
-                     WHERE campaign_id IS NOT NULL
-                     GROUP BY campaign_id) AS camp_total ON camp_total.campaign_id = l.campaign_id
+                    %s r
                 WHERE
-                    l.campaign_id IS NOT NULL
-                GROUP BY
-                    l.campaign_id, l.stage_id, l.create_date, camp_total.total_count
+                    r.grain = %%s
+                    AND r.lead_count > 0
+                WINDOW w AS (PARTITION BY r.campaign_id, r.period, r.company_id)
             ) WITH DATA
-        """ % self._table)
-        
+        """ % (self._table, rollup_table), (grain,))
+        self.env.cr.execute("COMMENT ON MATERIALIZED VIEW %s IS %%s" % self._table, (grain,))
+
         # Create indexes for better performance - using IF NOT EXISTS to be safe
         try:
             self.env.cr.execute("""
@@ -73,135 +243,831 @@ class CrmCampaignAnalysisReport(models.Model):
             self.env.cr.execute("""
                 CREATE INDEX IF NOT EXISTS %s_stage_idx ON %s (stage_id)
             """ % (self._table, self._table))
+
+            self.env.cr.execute("""
+                CREATE INDEX IF NOT EXISTS %s_company_idx ON %s (company_id)
+            """ % (self._table, self._table))
         except Exception as e:
             # Log the error but continue - indexes are optional
             _logger.warning("Failed to create indexes on %s: %s", self._table, str(e))
 
     @api.model
-    def get_campaign_stage_analysis(self, date_from=None, date_to=None):
+    def get_campaign_stage_matrix(self, date_from=None, date_to=None, compact=False):
         """
-        Get campaign analysis data with stage distribution
+        Get campaign analysis data as a compact columnar payload, served
+        from the result cache when the data did not change since it was
+        computed. The returned dict is shared and must not be modified.
         :param date_from: optional filter for leads created from this date
         :param date_to: optional filter for leads created until this date
-        :return: dict with campaign data and stage distribution
+        :param compact: return the flat payload of _compact_payload()
+        :return: see _compute_stage_matrix()
+        """
+        with profile(self.env, 'matrix'):
+            if self.env.context.get('campaign_analysis_no_cache'):
+                result = self._compute_stage_matrix(date_from, date_to)
+                return self._compact_payload(result) if compact else result
+
+            cache = get_cache(self.env.cr.dbname)
+            key = self._get_cache_key(date_from, date_to, 'compact' if compact else 'matrix')
+            generation = self._get_data_generation()
+            result = cache.get(key, generation)
+            record_cache(result is not None)
+            if result is None:
+                result = self._compute_stage_matrix(date_from, date_to)
+                if compact:
+                    result = self._compact_payload(result)
+                self._cache_result(cache, key, generation, result)
+            return result
+
+    @api.model
+    def _compact_payload(self, payload):
+        """
+        Smallest form of a columnar payload for RPC clients: ``counts`` is
+        flattened row-major (the count of campaign ``row`` and stage ``col``
+        is at ``row * len(stage_ids) + col``) and the percentages are left
+        out, clients derive them as count * 100 / ``totals[row]``. The
+        count bounds of an estimate are flattened the same way.
+        """
+        compact = {key: value for key, value in payload.items()
+                   if key not in COUNT_MATRICES and key not in PERCENTAGE_MATRICES}
+        for key in COUNT_MATRICES:
+            if key in payload:
+                compact[key] = [count for row_counts in payload[key] for count in row_counts]
+        return compact
+
+    @api.model
+    def _get_cache_key(self, date_from=None, date_to=None, *extra):
+        """Cache key of an analysis: normalized date range, access scope and language"""
+        scope = self._get_access_scope()
+        return (
+            str(fields.Datetime.to_datetime(date_from)) if date_from else None,
+            str(fields.Datetime.to_datetime(date_to)) if date_to else None,
+            tuple(
+                tuple(sorted(scope[key])) if scope[key] is not None else None
+                for key in ('company_ids', 'team_ids', 'user_ids')
+            ),
+            self.env.lang,
+        ) + extra
+
+    @api.model
+    def _get_access_scope(self):
+        """
+        Leads visible to the current user, as restrictions pushed down
+        into the analysis SQL. They mirror the standard crm.lead record
+        rules: leads of the allowed companies or without company, and only
+        own or unassigned leads for salespeople without access to all
+        leads. The ``campaign_analysis_team_ids`` context key further
+        restricts the analysis to some sales teams.
+        :return: dict of ``company_ids``, ``team_ids`` and ``user_ids``
+                 lists, None meaning unrestricted (see _scope_conditions)
+        """
+        team_ids = self.env.context.get('campaign_analysis_team_ids')
+        scope = {
+            'company_ids': None,
+            'team_ids': list(team_ids) if team_ids else None,
+            'user_ids': None,
+        }
+        if self.env.su:
+            return scope
+        scope['company_ids'] = self.env.companies.ids + [0]
+        if not self.env.user.has_group('sales_team.group_sale_salesman_all_leads'):
+            scope['user_ids'] = [self.env.uid, 0]
+        return scope
+
+    @api.model
+    def get_live_update_scope(self):
+        """
+        Access scope of the current user (see _get_access_scope()), used by
+        the dashboard to filter the lead count deltas sent on the bus
+        (see crm.lead._campaign_analysis_publish_deltas())
+        """
+        return self._get_access_scope()
+
+    @api.model
+    def get_cache_stats(self):
+        """Hit/miss counters of the analysis result cache of this worker"""
+        stats = get_cache(self.env.cr.dbname).stats()
+        stats['generation'] = self._get_data_generation()
+        return stats
+
+    @api.model
+    def _compute_stage_matrix(self, date_from=None, date_to=None):
+        """
+        Compute campaign analysis data as a compact columnar payload
+        :param date_from: optional filter for leads created from this date
+        :param date_to: optional filter for leads created until this date
+        :return: dict with parallel lists ``campaign_ids``/``campaign_names``/
+                 ``totals``, ``stage_ids``/``stage_names`` and the
+                 ``counts``/``percentages`` matrices (one row per campaign,
+                 one column per stage)
+        """
+        with phase('stages'):
+            stage_ids, stage_names = self._get_stages()
+
+        campaign_ids, campaign_names, totals, counts, percentages = [], [], [], [], []
+        workers = self._get_parallel_workers()
+        if workers > 1:
+            campaign_rows = self._iter_campaign_rows_parallel(stage_ids, date_from, date_to, workers)
+        else:
+            campaign_rows = self._iter_campaign_rows(self.env.cr, stage_ids, date_from, date_to)
+        # Rows are reshaped while they are fetched, the phase covers both
+        with phase('sql'):
+            for campaign_id, campaign_name, total, row_counts, row_percentages in campaign_rows:
+                campaign_ids.append(campaign_id)
+                campaign_names.append(campaign_name)
+                totals.append(total)
+                counts.append(row_counts)
+                percentages.append(row_percentages)
+        record_rows(len(campaign_ids))
+
+        return {
+            'campaign_ids': campaign_ids,
+            'campaign_names': campaign_names,
+            'totals': totals,
+            'stage_ids': stage_ids,
+            'stage_names': stage_names,
+            'counts': counts,
+            'percentages': percentages,
+        }
+
+    @api.model
+    def _get_stages(self):
+        """
+        Stages shown as analysis columns, in sequence order
+        :return: tuple (stage_ids, stage_names)
         """
-        # Refresh the materialized view to get the most up-to-date data
-        try:
-            self._cr.execute("REFRESH MATERIALIZED VIEW %s" % self._table)
-        except Exception as e:
-            _logger.warning("Failed to refresh materialized view: %s", str(e))
-            
         # Get all stages - use orm instead of raw query to handle translations properly
         stages = self.env['crm.stage'].search([], order='sequence')
-        stages_result = []
-        for stage in stages:
-            # Get the user's language-specific name by accessing the display_name
-            stages_result.append({
-                'id': stage.id,
-                'name': stage.display_name or stage.name  # Use display_name or fallback to name
-            })
-        
-        # For each campaign, get the total leads count with date filter
-        date_condition = ""
-        params = []
-        if date_from:
-            date_condition += " AND l.create_date >= %s"
-            params.append(date_from)
-        if date_to:
-            date_condition += " AND l.create_date <= %s"
-            params.append(date_to)
-            
-        # Use a direct query to get the stage distributions accurately
-        # We will get lead counts per stage per campaign
-        stage_distribution_query = """
-            WITH campaign_leads AS (
-                SELECT 
-                    c.id AS campaign_id,
-                    c.name AS campaign_name,
-                    l.stage_id,
-                    COUNT(l.id) AS lead_count
-                FROM utm_campaign c
-                JOIN crm_lead l ON l.campaign_id = c.id
-                WHERE c.active = True
-                AND l.active = True
-                """ + date_condition + """
-                GROUP BY c.id, c.name, l.stage_id
-            ),
-            campaign_totals AS (
-                SELECT 
-                    campaign_id,
-                    campaign_name,
-                    SUM(lead_count) AS total_leads
-                FROM campaign_leads
-                GROUP BY campaign_id, campaign_name
-            )
-            SELECT 
-                cl.campaign_id,
-                ct.campaign_name,
-                cl.stage_id,
-                cl.lead_count,
-                ct.total_leads,
-                (cl.lead_count * 100.0 / ct.total_leads) AS percentage
-            FROM campaign_leads cl
-            JOIN campaign_totals ct ON cl.campaign_id = ct.campaign_id
-            ORDER BY ct.campaign_name, cl.stage_id
-        """
-        self.env.cr.execute(stage_distribution_query, params)
-        stage_results = self.env.cr.dictfetchall()
-        
-        # Get campaign totals
-        campaign_totals_query = """
-            SELECT 
+        return stages.ids, [stage.display_name or stage.name for stage in stages]
+
+    @api.model
+    def _stage_distribution_query(self, date_from=None, date_to=None, campaign_ids=None, count_query=None):
+        """
+        Query returning one row per (campaign, stage) with the lead count,
+        the campaign total and the stage percentage, ordered by campaign.
+        :param campaign_ids: optional list of campaigns to restrict to
+        :param count_query: optional (query, params) of the counted rows
+                            instead of the leads of the range, e.g. a
+                            snapshot (see crm.campaign.analysis.snapshot)
+        :return: tuple (query, params)
+        """
+        # Lead counts come from the pre-aggregated rollup buckets, only the
+        # partial boundary days of the range are counted from crm_lead
+        count_query, params = count_query or self.env['crm.campaign.analysis.rollup']._count_query(
+            date_from, date_to, self._get_access_scope(), campaign_ids)
+
+        # One pass: per-stage counts, with the campaign totals and
+        # percentages derived by window functions over the same groups
+        query = """
+            SELECT
                 c.id AS campaign_id,
                 c.name AS campaign_name,
-                COUNT(l.id) AS total_leads
+                NULLIF(l.stage_id, 0) AS stage_id,
+                SUM(l.lead_count) AS lead_count,
+                SUM(SUM(l.lead_count)) OVER w AS total_leads,
+                SUM(l.lead_count) * 100.0 / NULLIF(SUM(SUM(l.lead_count)) OVER w, 0) AS percentage
             FROM utm_campaign c
-            JOIN crm_lead l ON l.campaign_id = c.id
+            JOIN (""" + count_query + """) l ON l.campaign_id = c.id
             WHERE c.active = True
-            AND l.active = True
-            """ + date_condition + """
-            GROUP BY c.id, c.name
-            ORDER BY c.name
-        """
-        self.env.cr.execute(campaign_totals_query, params)
-        campaigns_result = self.env.cr.dictfetchall()
-        
-        # Organize the data
+            GROUP BY c.id, c.name, l.stage_id
+            HAVING SUM(l.lead_count) > 0
+            WINDOW w AS (PARTITION BY c.id)
+            ORDER BY c.name, c.id
+        """
+        return query, params
+
+    @api.model
+    def _count_campaigns(self, date_from=None, date_to=None):
+        """Number of campaigns with leads in the range, e.g. to report progress"""
+        count_query, params = self.env['crm.campaign.analysis.rollup']._count_query(
+            date_from, date_to, self._get_access_scope())
+        self.env.cr.execute("""
+            SELECT COUNT(DISTINCT l.campaign_id)
+            FROM (""" + count_query + """) l
+            JOIN utm_campaign c ON c.id = l.campaign_id
+            WHERE c.active = True
+        """, params)
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _iter_campaign_rows(self, cursor, stage_ids, date_from=None, date_to=None):
+        """
+        Run the stage distribution query on ``cursor`` and yield one
+        (campaign_id, campaign_name, total_leads, counts, percentages) tuple
+        per campaign, the two lists being aligned on ``stage_ids``. Rows are
+        consumed as they are fetched, so a server-side cursor streams them.
+        """
+        query, params = self._stage_distribution_query(date_from, date_to)
+        cursor.execute(query, params)
+
+        def fetch():
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+
+        return self._group_campaign_rows(fetch(), stage_ids)
+
+    @api.model
+    def _group_campaign_rows(self, rows, stage_ids):
+        """Group stage distribution rows (ordered by campaign) into campaign tuples"""
+        stage_index = {stage_id: index for index, stage_id in enumerate(stage_ids)}
+        current = None
+        for campaign_id, campaign_name, stage_id, lead_count, total_leads, percentage in rows:
+            if current is None or current[0] != campaign_id:
+                if current is not None:
+                    yield current
+                current = (campaign_id, campaign_name, int(total_leads),
+                           [0] * len(stage_ids), [0.0] * len(stage_ids))
+            index = stage_index.get(stage_id)
+            if index is not None:
+                current[3][index] = int(lead_count)
+                current[4][index] = float(percentage or 0.0)
+        if current is not None:
+            yield current
+
+    @api.model
+    def _iter_campaign_rows_parallel(self, stage_ids, date_from=None, date_to=None, workers=2):
+        """
+        Same rows as _iter_campaign_rows(), computed by ``workers``
+        concurrent shards of campaigns. The shards are contiguous slices of
+        the campaigns in (name, id) order, so concatenating their results
+        in shard order gives the order of the serial query without
+        re-sorting (and without depending on the Python collation).
+        """
+        self.env.cr.execute("SELECT id FROM utm_campaign WHERE active = True ORDER BY name, id")
+        campaign_ids = [row[0] for row in self.env.cr.fetchall()]
+        if len(campaign_ids) < PARALLEL_MIN_CAMPAIGNS:
+            return self._iter_campaign_rows(self.env.cr, stage_ids, date_from, date_to)
+
+        shards = [
+            self._stage_distribution_query(date_from, date_to, shard)
+            for shard in split_evenly(campaign_ids, workers)
+        ]
+        results = [None] * len(shards)
+        with phase('shards'):
+            for index, rows in run_shards(self.env.cr, shards, workers):
+                results[index] = rows
+        return self._group_campaign_rows((row for rows in results for row in rows), stage_ids)
+
+    @api.model
+    def get_campaign_stage_page(self, date_from=None, date_to=None, offset=0, limit=DEFAULT_PAGE_SIZE,
+                                sort='total', sort_stage_id=None, descending=True, search=None, compact=False,
+                                snapshot_date=None, approximate=False):
+        """
+        Get one page of the campaign analysis, sorted, filtered and sliced
+        in SQL so that only the requested campaign rows are transferred.
+        :param offset: index of the first campaign of the page
+        :param limit: maximum number of campaigns in the page
+        :param sort: 'total' (total leads), 'stage' (percentage of
+                     ``sort_stage_id``) or 'name'
+        :param descending: sort direction
+        :param search: optional case-insensitive filter on the campaign name
+        :param compact: return the flat payload of _compact_payload()
+        :param snapshot_date: read the latest snapshot taken on or before
+                              this day instead of the current leads, the
+                              date range is then ignored
+        :param approximate: estimate the counts from the month buckets of
+                            the rollup (see _estimate_query()), in a time
+                            that does not depend on the number of leads,
+                            for dashboards showing it until the exact page
+                            comes back; ignored with ``snapshot_date``
+        :return: columnar payload like get_campaign_stage_matrix(), plus
+                 ``offset``, ``total_count`` (number of matching campaigns),
+                 ``approximate`` and the highlight rules compiled for the
+                 stage columns (see
+                 crm.campaign.analysis.highlight.rule._get_payload()).
+                 Estimates also hold the bounds of the exact values:
+                 ``totals_low``/``totals_high``, ``counts_low``/
+                 ``counts_high`` and ``percentages_low``/``percentages_high``
+        """
+        if sort not in ('total', 'stage', 'name') or (sort == 'stage' and not sort_stage_id):
+            sort = 'total'
+        offset = max(int(offset or 0), 0)
+        limit = min(max(int(limit or DEFAULT_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+
+        with profile(self.env, 'page'):
+            if snapshot_date:
+                # False when there is no snapshot that old: nothing to count
+                snapshot_date = self.env['crm.campaign.analysis.snapshot']._resolve_snapshot_date(snapshot_date) or False
+                date_from = date_to = None
+                approximate = False
+            cache = get_cache(self.env.cr.dbname)
+            key = self._get_cache_key(date_from, date_to, 'page', offset, limit, sort,
+                                      sort_stage_id, bool(descending), search or None, str(snapshot_date),
+                                      bool(approximate))
+            generation = self._get_data_generation()
+            result = cache.get(key, generation)
+            record_cache(result is not None)
+            if result is None:
+                result = self._compute_stage_page(date_from, date_to, offset, limit, sort,
+                                                  sort_stage_id, descending, search, snapshot_date,
+                                                  approximate)
+                self._cache_result(cache, key, generation, result)
+            result = self._compact_payload(result) if compact else dict(result)
+            # Added after the cache: the rules change independently of the data
+            result.update(self.env['crm.campaign.analysis.highlight.rule']._get_payload(result['stage_names']))
+            return result
+
+    @api.model
+    def _compute_stage_page(self, date_from, date_to, offset, limit, sort, sort_stage_id, descending, search,
+                            snapshot_date=None, approximate=False):
+        with phase('stages'):
+            stage_ids, stage_names = self._get_stages()
+        stage_index = {stage_id: index for index, stage_id in enumerate(stage_ids)}
+
+        if snapshot_date is not None:
+            count_query, count_params = self.env['crm.campaign.analysis.snapshot']._snapshot_query(
+                snapshot_date, self._get_access_scope())
+        elif approximate:
+            estimate_query, count_params = self.env['crm.campaign.analysis.rollup']._estimate_query(
+                date_from, date_to, self._get_access_scope())
+            count_query = "SELECT campaign_id, stage_id, lead_count FROM (" + estimate_query + ") e"
+        else:
+            count_query, count_params = self.env['crm.campaign.analysis.rollup']._count_query(
+                date_from, date_to, self._get_access_scope())
+        search_condition = ""
+        search_params = []
+        if search:
+            search_condition = "AND c.name ILIKE %s"
+            escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            search_params.append('%%%s%%' % escaped)
+
+        direction = 'DESC' if descending else 'ASC'
+        sort_expression = {
+            'total': "total_leads %s" % direction,
+            'stage': "sort_count * 100.0 / total_leads %s" % direction,
+            'name': "campaign_name %s" % direction,
+        }[sort]
+
+        with phase('sql'):
+            # Rank the campaigns once, then only expand the stage cells of the
+            # requested page
+            self.env.cr.execute("""
+                WITH cells AS (
+                    SELECT
+                        c.id AS campaign_id,
+                        c.name AS campaign_name,
+                        NULLIF(l.stage_id, 0) AS stage_id,
+                        SUM(l.lead_count) AS lead_count
+                    FROM utm_campaign c
+                    JOIN (""" + count_query + """) l ON l.campaign_id = c.id
+                    WHERE c.active = True
+                    """ + search_condition + """
+                    GROUP BY c.id, c.name, l.stage_id
+                    HAVING SUM(l.lead_count) > 0
+                ),
+                campaigns AS (
+                    SELECT
+                        campaign_id,
+                        campaign_name,
+                        SUM(lead_count) AS total_leads,
+                        COALESCE(SUM(lead_count) FILTER (WHERE stage_id = %s), 0) AS sort_count
+                    FROM cells
+                    GROUP BY campaign_id, campaign_name
+                ),
+                page AS (
+                    SELECT *, row_number() OVER (ORDER BY """ + sort_expression + """, campaign_name, campaign_id) AS position
+                    FROM campaigns
+                    ORDER BY position
+                    LIMIT %s OFFSET %s
+                )
+                SELECT n.total_count, p.campaign_id, p.campaign_name, p.total_leads, cells.stage_id, cells.lead_count
+                FROM (SELECT COUNT(*) AS total_count FROM campaigns) n
+                LEFT JOIN (page p JOIN cells ON cells.campaign_id = p.campaign_id) ON True
+                ORDER BY p.position
+            """, count_params + search_params + [sort_stage_id or 0, limit, offset])
+            rows = self.env.cr.fetchall()
+
+        campaign_ids, campaign_names, totals, counts, percentages = [], [], [], [], []
+        total_count = 0
+        record_rows(len(rows))
+        for total_count, campaign_id, campaign_name, total_leads, stage_id, lead_count in rows:
+            if campaign_id is None:
+                # Empty page, only the campaign count came back
+                continue
+            if not campaign_ids or campaign_ids[-1] != campaign_id:
+                campaign_ids.append(campaign_id)
+                campaign_names.append(campaign_name)
+                totals.append(int(total_leads))
+                counts.append([0] * len(stage_ids))
+                percentages.append([0.0] * len(stage_ids))
+            index = stage_index.get(stage_id)
+            if index is not None:
+                counts[-1][index] = int(lead_count)
+                percentages[-1][index] = int(lead_count) * 100.0 / int(total_leads)
+
+        result = {
+            'offset': offset,
+            'total_count': total_count,
+            'campaign_ids': campaign_ids,
+            'campaign_names': campaign_names,
+            'totals': totals,
+            'stage_ids': stage_ids,
+            'stage_names': stage_names,
+            'counts': counts,
+            'percentages': percentages,
+            'approximate': bool(approximate),
+        }
+        if approximate:
+            result.update(self._compute_estimate_bounds(date_from, date_to, campaign_ids, stage_ids))
+        return result
+
+    @api.model
+    def _compute_estimate_bounds(self, date_from, date_to, campaign_ids, stage_ids):
+        """
+        Bounds of the exact values of the campaigns of an estimated page.
+        The count of a stage only grows with the leads of the partial months
+        while its percentage also shrinks with the leads of the other
+        stages, so a percentage is lowest with the fewest leads in its stage
+        and the most in the others, and the other way round.
+        :return: dict of the ``totals_low``/``totals_high`` lists and the
+                 ``counts_low``/``counts_high``/``percentages_low``/
+                 ``percentages_high`` matrices of get_campaign_stage_page()
+        """
+        stage_index = {stage_id: index for index, stage_id in enumerate(stage_ids)}
+        row_index = {campaign_id: row for row, campaign_id in enumerate(campaign_ids)}
+        counts_low = [[0] * len(stage_ids) for _campaign in campaign_ids]
+        counts_high = [[0] * len(stage_ids) for _campaign in campaign_ids]
+        totals_low = [0] * len(campaign_ids)
+        totals_high = [0] * len(campaign_ids)
+        if campaign_ids:
+            query, params = self.env['crm.campaign.analysis.rollup']._estimate_query(
+                date_from, date_to, self._get_access_scope(), campaign_ids)
+            with phase('sql'):
+                self.env.cr.execute(query, params)
+                rows = self.env.cr.fetchall()
+            for campaign_id, stage_id, _lead_count, low_count, high_count in rows:
+                row = row_index[campaign_id]
+                totals_low[row] += int(low_count)
+                totals_high[row] += int(high_count)
+                index = stage_index.get(stage_id)
+                if index is not None:
+                    counts_low[row][index] = int(low_count)
+                    counts_high[row][index] = int(high_count)
+
+        percentages_low, percentages_high = [], []
+        for row, (row_low, row_high) in enumerate(zip(counts_low, counts_high)):
+            percentages_low.append([
+                low * 100.0 / (low + totals_high[row] - high) if low else 0.0
+                for low, high in zip(row_low, row_high)
+            ])
+            percentages_high.append([
+                high * 100.0 / (high + totals_low[row] - low) if high else 0.0
+                for low, high in zip(row_low, row_high)
+            ])
+        return {
+            'totals_low': totals_low,
+            'totals_high': totals_high,
+            'counts_low': counts_low,
+            'counts_high': counts_high,
+            'percentages_low': percentages_low,
+            'percentages_high': percentages_high,
+        }
+
+    @api.model
+    def get_campaign_stage_trend(self, date_from=None, date_to=None, grain='week', campaign_ids=None):
+        """
+        Get weekly or monthly lead count series per campaign and stage,
+        computed from the rollup buckets in a single query
+        :param grain: 'week' or 'month'
+        :param campaign_ids: optional list of campaigns, e.g. the rows shown
+        :return: dict with ``grain``, ``periods`` (bucket start dates),
+                 parallel lists ``campaign_ids``/``campaign_names``,
+                 ``stage_ids``/``stage_names``, ``counts`` and
+                 ``percentages`` (campaign x stage x period) and ``totals``
+                 (campaign x period)
+        """
+        if grain not in TREND_GRAINS:
+            grain = TREND_GRAINS[0]
+        campaign_ids = sorted(set(campaign_ids)) if campaign_ids else None
+
+        with profile(self.env, 'trend'):
+            cache = get_cache(self.env.cr.dbname)
+            key = self._get_cache_key(date_from, date_to, 'trend', grain,
+                                      tuple(campaign_ids) if campaign_ids else None)
+            generation = self._get_data_generation()
+            result = cache.get(key, generation)
+            record_cache(result is not None)
+            if result is None:
+                result = self._compute_stage_trend(date_from, date_to, grain, campaign_ids)
+                self._cache_result(cache, key, generation, result)
+            return result
+
+    @api.model
+    def _compute_stage_trend(self, date_from, date_to, grain, campaign_ids):
+        with phase('stages'):
+            stage_ids, stage_names = self._get_stages()
+        stage_index = {stage_id: index for index, stage_id in enumerate(stage_ids)}
+
+        trend_query, params, periods = self.env['crm.campaign.analysis.rollup']._trend_query(
+            date_from, date_to, grain, self._get_access_scope(), campaign_ids)
+        period_index = {period: index for index, period in enumerate(periods)}
+
+        with phase('sql'):
+            self.env.cr.execute("""
+                SELECT c.id, c.name, t.period, NULLIF(t.stage_id, 0), SUM(t.lead_count)
+                FROM (""" + trend_query + """) t
+                JOIN utm_campaign c ON c.id = t.campaign_id
+                WHERE c.active = True
+                GROUP BY c.id, c.name, t.period, t.stage_id
+                HAVING SUM(t.lead_count) > 0
+                ORDER BY c.name, c.id
+            """, params)
+            rows = self.env.cr.fetchall()
+        record_rows(len(rows))
+
+        with phase('reshape'):
+            result_ids, names, counts, totals = [], [], [], []
+            for campaign_id, campaign_name, period, stage_id, lead_count in rows:
+                if not result_ids or result_ids[-1] != campaign_id:
+                    result_ids.append(campaign_id)
+                    names.append(campaign_name)
+                    counts.append([[0] * len(periods) for _stage in stage_ids])
+                    totals.append([0] * len(periods))
+                column = period_index[period]
+                totals[-1][column] += int(lead_count)
+                index = stage_index.get(stage_id)
+                if index is not None:
+                    counts[-1][index][column] = int(lead_count)
+
+            percentages = [
+                [
+                    [count * 100.0 / period_totals[column] if period_totals[column] else 0.0
+                     for column, count in enumerate(series)]
+                    for series in campaign_counts
+                ]
+                for campaign_counts, period_totals in zip(counts, totals)
+            ]
+
+        return {
+            'grain': grain,
+            'periods': [fields.Date.to_string(period) for period in periods],
+            'campaign_ids': result_ids,
+            'campaign_names': names,
+            'stage_ids': stage_ids,
+            'stage_names': stage_names,
+            'counts': counts,
+            'percentages': percentages,
+            'totals': totals,
+        }
+
+    @api.model
+    def get_campaign_stage_comparison(self, ranges, campaign_ids=None):
+        """
+        Compare the campaign analysis of several creation date ranges, e.g.
+        this month, last month and the same month last year, counted in a
+        single query (see crm.campaign.analysis.rollup._multi_count_query())
+        :param ranges: list of [date_from, date_to] pairs, the first one is
+                       the reference of the deltas
+        :param campaign_ids: optional list of campaigns to compare
+        :return: dict with ``ranges``, parallel lists ``campaign_ids``/
+                 ``campaign_names`` (campaigns with leads in any range, in
+                 name order), ``stage_ids``/``stage_names``, ``totals``,
+                 ``counts`` and ``percentages`` with one aligned list or
+                 matrix per range, and ``total_deltas``/``count_deltas``/
+                 ``percentage_deltas`` with one list or matrix per range
+                 after the first (range - first range, percentage points)
+        """
+        if not ranges:
+            raise UserError(_("Select at least one date range to compare."))
+        if len(ranges) > MAX_COMPARISON_RANGES:
+            raise UserError(_("At most %s date ranges can be compared at once.", MAX_COMPARISON_RANGES))
+        ranges = [
+            (str(fields.Datetime.to_datetime(date_from)) if date_from else None,
+             str(fields.Datetime.to_datetime(date_to)) if date_to else None)
+            for date_from, date_to in ranges
+        ]
+        campaign_ids = sorted(set(campaign_ids)) if campaign_ids else None
+
+        with profile(self.env, 'comparison'):
+            cache = get_cache(self.env.cr.dbname)
+            key = self._get_cache_key(None, None, 'comparison', tuple(ranges),
+                                      tuple(campaign_ids) if campaign_ids else None)
+            generation = self._get_data_generation()
+            result = cache.get(key, generation)
+            record_cache(result is not None)
+            if result is None:
+                result = self._compute_stage_comparison(ranges, campaign_ids)
+                self._cache_result(cache, key, generation, result)
+            return result
+
+    @api.model
+    def _compute_stage_comparison(self, ranges, campaign_ids):
+        with phase('stages'):
+            stage_ids, stage_names = self._get_stages()
+        stage_index = {stage_id: index for index, stage_id in enumerate(stage_ids)}
+
+        count_query, params = self.env['crm.campaign.analysis.rollup']._multi_count_query(
+            ranges, self._get_access_scope(), campaign_ids)
+        columns = ["count_%s" % index for index in range(len(ranges))]
+
+        with phase('sql'):
+            self.env.cr.execute("""
+                SELECT c.id, c.name, NULLIF(m.stage_id, 0), """ + ", ".join("m." + column for column in columns) + """
+                FROM (""" + count_query + """) m
+                JOIN utm_campaign c ON c.id = m.campaign_id
+                WHERE c.active = True
+                AND (""" + " OR ".join("m.%s > 0" % column for column in columns) + """)
+                ORDER BY c.name, c.id
+            """, params)
+            rows = self.env.cr.fetchall()
+        record_rows(len(rows))
+
+        with phase('reshape'):
+            result_ids, names = [], []
+            totals = [[] for _range in ranges]
+            counts = [[] for _range in ranges]
+            for campaign_id, campaign_name, stage_id, *range_counts in rows:
+                if not result_ids or result_ids[-1] != campaign_id:
+                    result_ids.append(campaign_id)
+                    names.append(campaign_name)
+                    for range_totals, range_matrix in zip(totals, counts):
+                        range_totals.append(0)
+                        range_matrix.append([0] * len(stage_ids))
+                index = stage_index.get(stage_id)
+                for range_totals, range_matrix, lead_count in zip(totals, counts, range_counts):
+                    range_totals[-1] += int(lead_count)
+                    if index is not None:
+                        range_matrix[-1][index] = int(lead_count)
+
+            percentages = [
+                [
+                    [count * 100.0 / total if total else 0.0 for count in row_counts]
+                    for row_counts, total in zip(range_matrix, range_totals)
+                ]
+                for range_matrix, range_totals in zip(counts, totals)
+            ]
+
+            return {
+                'ranges': [list(date_range) for date_range in ranges],
+                'campaign_ids': result_ids,
+                'campaign_names': names,
+                'stage_ids': stage_ids,
+                'stage_names': stage_names,
+                'totals': totals,
+                'counts': counts,
+                'percentages': percentages,
+                'total_deltas': [
+                    [b - a for a, b in zip(totals[0], range_totals)]
+                    for range_totals in totals[1:]
+                ],
+                'count_deltas': [
+                    [[b - a for a, b in zip(row_first, row_range)] for row_first, row_range in zip(counts[0], range_matrix)]
+                    for range_matrix in counts[1:]
+                ],
+                'percentage_deltas': [
+                    [[b - a for a, b in zip(row_first, row_range)] for row_first, row_range in zip(percentages[0], range_matrix)]
+                    for range_matrix in percentages[1:]
+                ],
+            }
+
+    @api.model
+    def get_campaign_stage_analysis(self, date_from=None, date_to=None):
+        """
+        Get campaign analysis data with stage distribution
+        :param date_from: optional filter for leads created from this date
+        :param date_to: optional filter for leads created until this date
+        :return: dict with campaign data and stage distribution
+        """
+        with profile(self.env, 'analysis'):
+            matrix = self.get_campaign_stage_matrix(date_from, date_to)
+            with phase('reshape'):
+                return self._nest_stage_matrix(matrix)
+
+    @api.model
+    def _nest_stage_matrix(self, matrix):
+        """Nested dict shape of get_campaign_stage_analysis()"""
+        stage_ids = matrix['stage_ids']
+
         campaigns = {}
-        stages = {}
-        
-        # Fill stages dictionary
-        for stage in stages_result:
-            stages[stage['id']] = stage['name']
-        
-        # Fill campaigns dictionary with basic data
-        for campaign in campaigns_result:
-            campaign_id = campaign['campaign_id']
+        for row, campaign_id in enumerate(matrix['campaign_ids']):
+            counts = matrix['counts'][row]
+            percentages = matrix['percentages'][row]
             campaigns[campaign_id] = {
-                'name': campaign['campaign_name'],
-                'total_leads': campaign['total_leads'],
-                'stages': {}
+                'name': matrix['campaign_names'][row],
+                'total_leads': matrix['totals'][row],
+                'stages': {
+                    stage_id: {
+                        'lead_count': counts[col],
+                        'percentage': percentages[col],
+                    }
+                    for col, stage_id in enumerate(stage_ids) if counts[col]
+                },
             }
-        
-        # Add stage counts and percentages
-        for result in stage_results:
-            campaign_id = result['campaign_id']
-            stage_id = result['stage_id']
-            if campaign_id in campaigns and stage_id in stages:
-                lead_count = result['lead_count']
-                total = result['total_leads']
-                percentage = result['percentage']
-                
-                campaigns[campaign_id]['stages'][stage_id] = {
-                    'lead_count': lead_count,
-                    'percentage': percentage
-                }
-                
+
         return {
             'campaigns': campaigns,
-            'stages': stages
+            'stages': dict(zip(stage_ids, matrix['stage_names'])),
         }
 
+    @api.model
+    def _get_parallel_workers(self):
+        """Number of concurrent shards of the analysis, 0 or 1 for serial"""
+        value = self.env['ir.config_parameter'].sudo().get_param('crm_campaign_analysis.parallel_workers', 0)
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    @api.model
+    def _get_max_staleness(self):
+        """Maximum age of the materialized view, in minutes"""
+        value = self.env['ir.config_parameter'].sudo().get_param(
+            'crm_campaign_analysis.max_staleness_minutes', DEFAULT_MAX_STALENESS)
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return DEFAULT_MAX_STALENESS
+
+    @api.model
+    def _get_view_age(self):
+        """Seconds elapsed since the last refresh of the view, None if unknown"""
+        self._cr.execute("""
+            SELECT EXTRACT(EPOCH FROM (now() at time zone 'UTC') - refreshed_at)
+            FROM crm_campaign_analysis_refresh
+            WHERE view_name = %s
+        """, (self._table,))
+        row = self._cr.fetchone()
+        return row[0] if row else None
+
+    @api.model
+    def _is_view_stale(self):
+        age = self._get_view_age()
+        return age is None or age >= self._get_max_staleness() * 60
+
+    @api.model
+    def _refresh_view(self):
+        """
+        Refresh the materialized view without blocking its readers.
+        Concurrent requests from several workers are coalesced with an
+        advisory lock: only the first one refreshes, the others return
+        immediately since the data they asked for is being rebuilt.
+        :return: True if this call refreshed the view, False otherwise
+        """
+        self._cr.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (self._table,))
+        if not self._cr.fetchone()[0]:
+            _logger.info("Refresh of %s already in progress, skipping", self._table)
+            return False
+
+        with phase('refresh'):
+            try:
+                with self._cr.savepoint():
+                    self._cr.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY %s" % self._table)
+            except Exception as e:
+                # CONCURRENTLY needs a populated view and its unique id index
+                _logger.warning("Concurrent refresh of %s failed, falling back to a plain refresh: %s",
+                                self._table, str(e))
+                self._cr.execute("REFRESH MATERIALIZED VIEW %s" % self._table)
+
+        self._cr.execute("""
+            UPDATE crm_campaign_analysis_refresh
+            SET refreshed_at = now() at time zone 'UTC'
+            WHERE view_name = %s
+        """, (self._table,))
+        return True
+
+    @api.model
+    def _schedule_refresh(self, force=False):
+        """
+        Ask the refresh cron to run as soon as possible when the view is
+        older than the allowed staleness. Never refreshes synchronously.
+        Reads of a stale view are frequent: the cron is only triggered
+        when no trigger of it is already due, so they do not add one
+        ir.cron.trigger row each until the cron runs.
+        """
+        if not force and not self._is_view_stale():
+            return False
+        cron = self.env.ref('crm_campaign_analysis.ir_cron_refresh_campaign_analysis', raise_if_not_found=False)
+        if cron:
+            pending = self.env['ir.cron.trigger'].sudo().search_count([
+                ('cron_id', '=', cron.id),
+                ('call_at', '<=', fields.Datetime.now()),
+            ], limit=1)
+            if not pending:
+                cron.sudo()._trigger()
+        return True
+
+    @api.model
+    def _cron_refresh_materialized_view(self):
+        """Scheduled action: refresh the view once it exceeds the allowed staleness"""
+        with profile(self.env, 'refresh'):
+            # Companies created since the last run get their rollup partition
+            self.env['crm.campaign.analysis.rollup']._ensure_company_partitions()
+            grain = self._get_report_grain()
+            if self._get_view_grain() != grain:
+                # The configured grain changed, the view has to be rebuilt
+                with phase('rebuild'):
+                    self._create_view(grain)
+                self._cr.execute("""
+                    UPDATE crm_campaign_analysis_refresh
+                    SET refreshed_at = now() at time zone 'UTC'
+                    WHERE view_name = %s
+                """, (self._table,))
+            elif self._is_view_stale():
+                self._refresh_view()
+
     @api.model
     def refresh_materialized_view(self):
         """
@@ -209,8 +1075,10 @@ class CrmCampaignAnalysisReport(models.Model):
         Can be called from a server action if needed.
         """
         try:
-            self._cr.execute("REFRESH MATERIALIZED VIEW %s" % self._table)
-            message = 'The campaign analysis data has been refreshed.'
+            if self._refresh_view():
+                message = 'The campaign analysis data has been refreshed.'
+            else:
+                message = 'A refresh of the campaign analysis data is already running.'
             title = 'Refresh Complete'
         except Exception as e:
             message = f'Failed to refresh data: {str(e)}'
@@ -230,20 +1098,60 @@ class CrmCampaignAnalysisReport(models.Model):
 
     @api.model
     def search_read(self, domain=None, fields=None, offset=0, limit=None, order=None):
-        # Check if we have date filters in context
-        ctx = self.env.context
-        date_from = ctx.get('date_from')
-        date_to = ctx.get('date_to')
-        
-        # Get the refresh timestamp from context
-        refresh_timestamp = ctx.get('pivot_refresh_timestamp')
-        
-        if date_from or date_to or refresh_timestamp:
-            try:
-                # Force a refresh of the materialized view before searching
-                self._cr.execute("REFRESH MATERIALIZED VIEW %s" % self._table)
-            except Exception as e:
-                _logger.warning("Failed to refresh materialized view: %s", str(e))
-        
-        # Continue with normal search_read
+        # An explicit refresh request from the pivot schedules an immediate
+        # background refresh, otherwise only a stale view does
+        self._schedule_refresh(force=bool(self.env.context.get('pivot_refresh_timestamp')))
         return super(CrmCampaignAnalysisReport, self).search_read(domain, fields, offset, limit, order)
+
+    @api.model
+    def read_group(self, domain, fields, groupby, offset=0, limit=None, orderby=False, lazy=True):
+        self._schedule_refresh(force=bool(self.env.context.get('pivot_refresh_timestamp')))
+
+        with_percentage = any(spec.split(':')[0] == 'percentage' for spec in fields)
+        if with_percentage and not any(spec.split(':')[0] == 'lead_count' for spec in fields):
+            fields = list(fields) + ['lead_count']
+        result = super(CrmCampaignAnalysisReport, self).read_group(
+            domain, fields, groupby, offset=offset, limit=limit, orderby=orderby, lazy=lazy)
+        if with_percentage and result:
+            self._set_weighted_percentages(domain, groupby, result, lazy)
+        return result
+
+    def _set_weighted_percentages(self, domain, groupby, groups, lazy):
+        """
+        Replace the aggregated percentage of each group by the weighted
+        ratio of its lead count to the lead count of the enclosing group
+        without the stage dimension (e.g. the campaign total of the same
+        bucket), instead of an average of per-row percentages. The totals
+        ignore the stage conditions of the domain: with a stage filter the
+        percentages stay shares of the campaign, not of the filtered stages.
+        """
+        groupby = [groupby] if isinstance(groupby, str) else list(groupby)
+        if lazy:
+            groupby = groupby[:1]
+        parent_groupby = [spec for spec in groupby if spec.split(':')[0] != 'stage_id']
+
+        totals = super(CrmCampaignAnalysisReport, self).read_group(
+            self._without_stage_conditions(domain), ['lead_count'], parent_groupby, lazy=False)
+        denominators = {
+            tuple(total[spec] for spec in parent_groupby): total['lead_count'] or 0
+            for total in totals
+        }
+        for group in groups:
+            denominator = denominators.get(tuple(group[spec] for spec in parent_groupby))
+            group['percentage'] = (group['lead_count'] or 0) * 100.0 / denominator if denominator else 0.0
+
+    @api.model
+    def _without_stage_conditions(self, domain):
+        """The domain with every condition on the stage replaced by TRUE"""
+        def is_stage_leaf(token):
+            return expression.is_leaf(token) and str(token[0]).split('.')[0] == 'stage_id'
+
+        result = []
+        tokens = iter(expression.distribute_not(expression.normalize_domain(domain or [])))
+        for token in tokens:
+            if token == expression.NOT_OPERATOR:
+                negated = next(tokens)
+                result.extend([expression.TRUE_LEAF] if is_stage_leaf(negated) else [token, negated])
+            else:
+                result.append(expression.TRUE_LEAF if is_stage_leaf(token) else token)
+        return result
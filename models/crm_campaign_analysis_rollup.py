@@ -0,0 +1,796 @@
+from odoo import _, api, fields, models, sql_db
+from odoo.exceptions import AccessError
+from datetime import date, datetime, time, timedelta
+import json
+import logging
+
+from .campaign_analysis_parallel import run_shards, split_range
+
+_logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the rollup table changes: init() rebuilds it
+ROLLUP_VERSION = '3'
+
+# Rollup grains, coarsest first
+GRAINS = ('month', 'week', 'day')
+
+# Keeps the caller's SQL valid when there is nothing to count
+EMPTY_TREND_QUERY = (
+    "SELECT NULL::date AS period, NULL::integer AS campaign_id, 0 AS stage_id, 0 AS lead_count WHERE false"
+)
+
+# Same, for the callers of _estimate_query()
+EMPTY_ESTIMATE_QUERY = (
+    "SELECT NULL::integer AS campaign_id, 0 AS stage_id, 0 AS lead_count, 0 AS low_count, 0 AS high_count "
+    "WHERE false"
+)
+
+# Shards per worker of a parallel rebuild, smaller shards balance better
+SHARDS_PER_WORKER = 4
+
+# Partial covering index on crm_lead for the queries that still read leads
+# (boundary days of a range and the backfill). create_date leads because
+# those queries only filter on a creation range.
+LEAD_INDEX = 'crm_lead_campaign_analysis_idx'
+LEAD_INDEX_DEFINITION = (
+    "ON crm_lead (create_date) INCLUDE (campaign_id, stage_id, company_id, team_id, user_id) "
+    "WHERE active AND campaign_id IS NOT NULL"
+)
+# Bump whenever LEAD_INDEX_DEFINITION changes: the index is rebuilt
+LEAD_INDEX_VERSION = '2'
+
+# Columns of crm_lead the rollup is keyed on besides campaign and stage,
+# stored as 0 when empty
+SCOPE_COLUMNS = ('company_id', 'team_id', 'user_id')
+
+# Primary key of the rollup table, in the order of _key_values_sql()
+ROLLUP_KEY = 'company_id, grain, period, campaign_id, stage_id, team_id, user_id'
+
+
+class CrmCampaignAnalysisRollup(models.AbstractModel):
+    """
+    Delta-maintained lead counts per (campaign, stage, period).
+
+    The rollup lives in a plain table kept up to date by triggers on
+    crm_lead, so its maintenance cost is proportional to the leads that
+    change instead of to the size of crm_lead. Every lead is counted once
+    per grain (day, week and month bucket of its creation date). Only
+    active leads with a campaign are counted; leads without a stage are
+    stored with stage_id 0.
+
+    Counts are also keyed on the company, sales team and salesperson of
+    the leads (0 when empty) so that access restrictions are applied in
+    SQL, see _count_query(). The table is partitioned by company: a user
+    of one company only reads the partition of that company.
+    """
+    _name = 'crm.campaign.analysis.rollup'
+    _description = 'CRM Campaign Analysis Rollup'
+
+    _rollup_table = 'crm_campaign_analysis_rollup'
+
+    def init(self):
+        cr = self.env.cr
+        cr.execute("SELECT obj_description(to_regclass(%s), 'pg_class')", (self._rollup_table,))
+        version = cr.fetchone()[0]
+
+        if version != ROLLUP_VERSION:
+            # Missing or outdated layout, dependent views are recreated by
+            # the report model afterwards
+            cr.execute("DROP TABLE IF EXISTS %s CASCADE" % self._rollup_table)
+            cr.execute("""
+                CREATE TABLE %(table)s (
+                    company_id integer NOT NULL DEFAULT 0,
+                    grain varchar NOT NULL,
+                    period date NOT NULL,
+                    campaign_id integer NOT NULL,
+                    stage_id integer NOT NULL DEFAULT 0,
+                    team_id integer NOT NULL DEFAULT 0,
+                    user_id integer NOT NULL DEFAULT 0,
+                    lead_count integer NOT NULL DEFAULT 0,
+                    PRIMARY KEY (company_id, grain, period, campaign_id, stage_id, team_id, user_id)
+                ) PARTITION BY LIST (company_id);
+                CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT;
+            """ % {'table': self._rollup_table})
+            cr.execute("COMMENT ON TABLE %s IS '%s'" % (self._rollup_table, ROLLUP_VERSION))
+
+        self._ensure_company_partitions()
+        self._create_triggers()
+
+        # The triggers keep the table in sync from now on, only a freshly
+        # created table needs the one-off full scan
+        if version != ROLLUP_VERSION:
+            self._backfill()
+
+        self._ensure_lead_index()
+
+    def _key_values_sql(self, alias):
+        """Rollup key of a lead row, in the order of ROLLUP_KEY"""
+        return (
+            "COALESCE(%(alias)s.company_id, 0), g.grain, g.period, %(alias)s.campaign_id, "
+            "COALESCE(%(alias)s.stage_id, 0), COALESCE(%(alias)s.team_id, 0), COALESCE(%(alias)s.user_id, 0)"
+        ) % {'alias': alias}
+
+    def _ensure_company_partitions(self):
+        """
+        Give every company a partition of its own, plus one for the leads
+        without company (0). Counts of a company created after the last
+        call land in the default partition until then; they are moved when
+        its partition is attached.
+        """
+        cr = self.env.cr
+        table = self._rollup_table
+        cr.execute("""
+            SELECT c.id FROM (SELECT 0 AS id UNION ALL SELECT id FROM res_company) c
+            WHERE to_regclass(%s || c.id) IS NULL
+            ORDER BY c.id
+        """, ('%s_c' % table,))
+        for (company_id,) in cr.fetchall():
+            values = {'table': table, 'company_id': int(company_id)}
+            cr.execute("""
+                CREATE TABLE %(table)s_c%(company_id)s (LIKE %(table)s INCLUDING DEFAULTS);
+                WITH moved AS (
+                    DELETE FROM %(table)s_default WHERE company_id = %(company_id)s RETURNING *
+                )
+                INSERT INTO %(table)s_c%(company_id)s SELECT * FROM moved;
+                ALTER TABLE %(table)s ATTACH PARTITION %(table)s_c%(company_id)s FOR VALUES IN (%(company_id)s);
+            """ % values)
+            _logger.info("Created partition %s_c%s", table, company_id)
+
+    def _periods_sql(self, alias, column='create_date'):
+        """LATERAL expansion of a lead creation date into one bucket per grain"""
+        return """
+            CROSS JOIN LATERAL (VALUES
+                ('day', %(alias)s.%(column)s::date),
+                ('week', date_trunc('week', %(alias)s.%(column)s)::date),
+                ('month', date_trunc('month', %(alias)s.%(column)s)::date)
+            ) AS g(grain, period)
+        """ % {'alias': alias, 'column': column}
+
+    def _create_triggers(self):
+        cr = self.env.cr
+        table = self._rollup_table
+        values = {'table': table, 'key': ROLLUP_KEY, 'values': self._key_values_sql('l')}
+
+        # Statement level triggers aggregate a whole batch of inserted or
+        # deleted leads into one upsert per (grain, period, campaign, stage)
+        cr.execute("""
+            CREATE OR REPLACE FUNCTION %(table)s_stmt() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO %(table)s AS r (%(key)s, lead_count)
+                    SELECT %(values)s, COUNT(*)
+                    FROM new_rows l
+                    %(new_periods)s
+                    WHERE l.campaign_id IS NOT NULL AND l.active
+                    GROUP BY 1, 2, 3, 4, 5, 6, 7
+                    ORDER BY 1, 2, 3, 4, 5, 6, 7
+                    ON CONFLICT (%(key)s)
+                    DO UPDATE SET lead_count = r.lead_count + EXCLUDED.lead_count;
+                ELSE
+                    INSERT INTO %(table)s AS r (%(key)s, lead_count)
+                    SELECT %(values)s, -COUNT(*)
+                    FROM old_rows l
+                    %(old_periods)s
+                    WHERE l.campaign_id IS NOT NULL AND l.active
+                    GROUP BY 1, 2, 3, 4, 5, 6, 7
+                    ORDER BY 1, 2, 3, 4, 5, 6, 7
+                    ON CONFLICT (%(key)s)
+                    DO UPDATE SET lead_count = r.lead_count + EXCLUDED.lead_count;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """ % dict(values, new_periods=self._periods_sql('l'), old_periods=self._periods_sql('l')))
+
+        # Move one lead from its old to its new key in a single upsert. The
+        # -1 and +1 rows are merged first (week and month buckets often stay
+        # the same) and written in key order, so two concurrent updates lock
+        # the rollup rows in the same order instead of deadlocking on each
+        # other's pair. The lead rows are passed whole so that the key
+        # columns are read like in _stmt()
+        cr.execute("""
+            DROP FUNCTION IF EXISTS %(table)s_apply(integer, integer, timestamp, integer);
+            DROP FUNCTION IF EXISTS %(table)s_apply(crm_lead, integer);
+        """ % values)
+        cr.execute("""
+            CREATE OR REPLACE FUNCTION %(table)s_move(p_old crm_lead, p_new crm_lead) RETURNS void AS $$
+                INSERT INTO %(table)s AS r (%(key)s, lead_count)
+                SELECT %(key)s, SUM(delta)
+                FROM (
+                    SELECT %(values)s, -1
+                    FROM (SELECT (p_old).*) l
+                    %(periods)s
+                    WHERE l.campaign_id IS NOT NULL AND l.active
+                    UNION ALL
+                    SELECT %(values)s, 1
+                    FROM (SELECT (p_new).*) l
+                    %(periods)s
+                    WHERE l.campaign_id IS NOT NULL AND l.active
+                ) AS d (%(key)s, delta)
+                GROUP BY %(key)s
+                HAVING SUM(delta) <> 0
+                ORDER BY %(key)s
+                ON CONFLICT (%(key)s)
+                DO UPDATE SET lead_count = r.lead_count + EXCLUDED.lead_count;
+            $$ LANGUAGE sql
+        """ % dict(values, periods=self._periods_sql('l')))
+
+        # Updates are handled per row so that the WHEN clause can skip the
+        # (very common) writes that do not touch the rollup key
+        cr.execute("""
+            CREATE OR REPLACE FUNCTION %(table)s_row() RETURNS trigger AS $$
+            BEGIN
+                PERFORM %(table)s_move(OLD, NEW);
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """ % values)
+
+        cr.execute("""
+            DROP TRIGGER IF EXISTS %(table)s_ins ON crm_lead;
+            CREATE TRIGGER %(table)s_ins
+                AFTER INSERT ON crm_lead
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION %(table)s_stmt();
+
+            DROP TRIGGER IF EXISTS %(table)s_del ON crm_lead;
+            CREATE TRIGGER %(table)s_del
+                AFTER DELETE ON crm_lead
+                REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION %(table)s_stmt();
+
+            DROP TRIGGER IF EXISTS %(table)s_upd ON crm_lead;
+            CREATE TRIGGER %(table)s_upd
+                AFTER UPDATE OF campaign_id, stage_id, active, create_date, company_id, team_id, user_id ON crm_lead
+                FOR EACH ROW
+                WHEN (OLD.campaign_id IS DISTINCT FROM NEW.campaign_id
+                      OR OLD.stage_id IS DISTINCT FROM NEW.stage_id
+                      OR OLD.active IS DISTINCT FROM NEW.active
+                      OR OLD.create_date::date IS DISTINCT FROM NEW.create_date::date
+                      OR OLD.company_id IS DISTINCT FROM NEW.company_id
+                      OR OLD.team_id IS DISTINCT FROM NEW.team_id
+                      OR OLD.user_id IS DISTINCT FROM NEW.user_id)
+                EXECUTE FUNCTION %(table)s_row();
+        """ % values)
+
+    def _backfill(self):
+        """Populate the rollup from crm_lead in a single aggregate scan"""
+        self.env.cr.execute("""
+            INSERT INTO %s (%s, lead_count)
+            SELECT %s, COUNT(*)
+            FROM crm_lead l
+            %s
+            WHERE l.campaign_id IS NOT NULL AND l.active
+            GROUP BY 1, 2, 3, 4, 5, 6, 7
+        """ % (self._rollup_table, ROLLUP_KEY, self._key_values_sql('l'), self._periods_sql('l')))
+
+    def _backfill_parallel(self, workers):
+        """
+        Populate the rollup from crm_lead with one aggregate per lead id
+        range, run concurrently on separate connections. Each shard's
+        counts are added to the rollup as soon as it completes, as the same
+        bucket may be counted by several shards.
+        """
+        cr = self.env.cr
+        cr.execute("SELECT MIN(id), MAX(id) FROM crm_lead")
+        low, high = cr.fetchone()
+        if low is None:
+            return
+
+        query = """
+            SELECT %s, COUNT(*)
+            FROM crm_lead l
+            %s
+            WHERE l.campaign_id IS NOT NULL AND l.active
+            AND l.id BETWEEN %%s AND %%s
+            GROUP BY 1, 2, 3, 4, 5, 6, 7
+        """ % (self._key_values_sql('l'), self._periods_sql('l'))
+        shards = [(query, [start, end]) for start, end in split_range(low, high, workers * SHARDS_PER_WORKER)]
+
+        # The shards only read crm_lead, the pending truncation of the
+        # rollup does not concern them
+        for index, rows in run_shards(cr, shards, workers, read_own_writes=False):
+            if not rows:
+                continue
+            cr.execute("""
+                INSERT INTO %s AS r (%s, lead_count)
+                SELECT * FROM unnest(%%s::int[], %%s::varchar[], %%s::date[], %%s::int[], %%s::int[], %%s::int[],
+                                     %%s::int[], %%s::int[])
+                ON CONFLICT (%s) DO UPDATE SET lead_count = r.lead_count + EXCLUDED.lead_count
+            """ % (self._rollup_table, ROLLUP_KEY, ROLLUP_KEY), [list(column) for column in zip(*rows)])
+            _logger.debug("Rollup shard %s done (%s buckets)", index, len(rows))
+
+    @api.model
+    def _rebuild_rollup(self, workers=None):
+        """
+        Recompute the whole rollup from crm_lead.
+        Only needed to recover from writes that bypassed the triggers
+        (e.g. a restore with triggers disabled), from a shell. It blocks
+        every lead write and analysis while it runs, so it is neither
+        exposed over RPC nor available to other users than administrators.
+        :param workers: number of concurrent shards, defaults to the
+                        crm_campaign_analysis.parallel_workers parameter
+        """
+        if not self.env.is_superuser() and not self.env.is_system():
+            raise AccessError(_("Only administrators can rebuild the campaign analysis rollup."))
+        if workers is None:
+            workers = self.env['crm.campaign.analysis.report']._get_parallel_workers()
+        self.env.cr.execute("LOCK TABLE %s IN EXCLUSIVE MODE" % self._rollup_table)
+        self.env.cr.execute("TRUNCATE %s" % self._rollup_table)
+        if workers > 1:
+            self._backfill_parallel(workers)
+        else:
+            self._backfill()
+        _logger.info("Rebuilt %s from crm_lead", self._rollup_table)
+
+    @api.model
+    def _drop_rollup(self):
+        """Remove the triggers, functions and table (used on uninstall)"""
+        table = self._rollup_table
+        self.env.cr.execute("""
+            DROP TRIGGER IF EXISTS %(table)s_ins ON crm_lead;
+            DROP TRIGGER IF EXISTS %(table)s_del ON crm_lead;
+            DROP TRIGGER IF EXISTS %(table)s_upd ON crm_lead;
+            DROP FUNCTION IF EXISTS %(table)s_stmt();
+            DROP FUNCTION IF EXISTS %(table)s_row();
+            DROP FUNCTION IF EXISTS %(table)s_apply(integer, integer, timestamp, integer);
+            DROP FUNCTION IF EXISTS %(table)s_apply(crm_lead, integer);
+            DROP FUNCTION IF EXISTS %(table)s_move(crm_lead, crm_lead);
+            DROP TABLE IF EXISTS %(table)s CASCADE;
+            DROP INDEX IF EXISTS %(index)s;
+        """ % {'table': table, 'index': LEAD_INDEX})
+
+    # ------------------------------------------------------------------
+    # crm_lead index
+    # ------------------------------------------------------------------
+
+    def _get_lead_index_state(self, cr=None):
+        """
+        'missing', 'invalid' (interrupted concurrent build), 'outdated'
+        (built from another LEAD_INDEX_DEFINITION) or 'valid'
+        """
+        cr = cr or self.env.cr
+        cr.execute("""
+            SELECT i.indisvalid, obj_description(c.oid, 'pg_class')
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s
+        """, (LEAD_INDEX,))
+        row = cr.fetchone()
+        if not row:
+            return 'missing'
+        if not row[0]:
+            return 'invalid'
+        return 'valid' if row[1] == LEAD_INDEX_VERSION else 'outdated'
+
+    def _ensure_lead_index(self):
+        """
+        Build the crm_lead index once the install/upgrade transaction is
+        committed. CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        block, and does not block lead writes while it scans the table.
+        """
+        if self._get_lead_index_state() == 'valid':
+            return
+        dbname = self.env.cr.dbname
+        self.env.cr.postcommit.add(lambda: self._build_lead_index(dbname))
+
+    @api.model
+    def _build_lead_index(self, dbname):
+        """Create the crm_lead index concurrently on an autocommit cursor"""
+        try:
+            with sql_db.db_connect(dbname).cursor() as cr:
+                cr._cnx.autocommit = True
+                state = self._get_lead_index_state(cr)
+                if state == 'valid':
+                    return
+                if state in ('invalid', 'outdated'):
+                    # A failed concurrent build leaves an invalid index that
+                    # is maintained on writes but never used, start over
+                    cr.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % LEAD_INDEX)
+                cr.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS %s %s" % (LEAD_INDEX, LEAD_INDEX_DEFINITION))
+                cr.execute("COMMENT ON INDEX %s IS '%s'" % (LEAD_INDEX, LEAD_INDEX_VERSION))
+                _logger.info("Created index %s", LEAD_INDEX)
+        except Exception:
+            # Retried on the next module update, the analysis is still
+            # correct without the index
+            _logger.exception("Could not create index %s", LEAD_INDEX)
+
+    @api.model
+    def _check_lead_index_plan(self, date_from=None, date_to=None):
+        """
+        EXPLAIN the crm_lead part of the analysis query for the given
+        partial range (the last day up to now by default) and report
+        whether it is answered by an index-only scan on the lead index.
+        Meant for the benchmark and the tests, the plan is not exposed
+        over RPC.
+        """
+        if not date_to:
+            date_to = fields.Datetime.now()
+        if not date_from:
+            date_from = date_to - timedelta(days=1)
+        self.env.cr.execute("""
+            EXPLAIN (FORMAT JSON)
+            SELECT campaign_id, COALESCE(stage_id, 0) AS stage_id, COUNT(*) AS lead_count
+            FROM crm_lead
+            WHERE campaign_id IS NOT NULL AND active
+            AND create_date BETWEEN %s AND %s
+            GROUP BY 1, 2
+        """, (date_from, date_to))
+        plan = self.env.cr.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        scans = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Relation Name') == 'crm_lead' or node.get('Index Name'):
+                scans.append({'node_type': node['Node Type'], 'index': node.get('Index Name')})
+            nodes.extend(node.get('Plans', []))
+
+        index_only = any(
+            scan['node_type'] == 'Index Only Scan' and scan['index'] == LEAD_INDEX for scan in scans
+        )
+        if not index_only:
+            _logger.warning("Campaign analysis lead query does not use an index-only scan on %s: %s", LEAD_INDEX, scans)
+        return {
+            'index': LEAD_INDEX,
+            'state': self._get_lead_index_state(),
+            'index_only': index_only,
+            'scans': scans,
+            'plan': plan,
+        }
+
+    # ------------------------------------------------------------------
+    # Date range decomposition
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _period_start(self, day, grain):
+        """First day of the week or month bucket containing ``day``"""
+        if grain == 'week':
+            return day - timedelta(days=day.weekday())
+        return day.replace(day=1)
+
+    @api.model
+    def _next_period(self, start, grain):
+        if grain == 'week':
+            return start + timedelta(days=7)
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+    @api.model
+    def _trend_query(self, date_from=None, date_to=None, grain='week', scope=None, campaign_ids=None):
+        """
+        Build a query returning (period, campaign_id, stage_id, lead_count)
+        rows for the week or month buckets overlapping the range. Buckets
+        entirely within the range are read as is, the partial first and
+        last ones are counted like any other range (see _count_query).
+        Rows are not aggregated, stage_id is 0 for leads without a stage.
+        :return: tuple (query, params, periods) where periods is the list
+                 of bucket start dates, in order
+        """
+        date_from = fields.Datetime.to_datetime(date_from) if date_from else None
+        date_to = fields.Datetime.to_datetime(date_to) if date_to else None
+        if not date_from or not date_to:
+            first_day, last_day = self._get_period_bounds()
+            if not first_day:
+                return EMPTY_TREND_QUERY, [], []
+            date_from = date_from or datetime.combine(first_day, time.min)
+            date_to = date_to or datetime.combine(last_day, time.max)
+        # Callers express "until the end of the day" with 23:59:59[.999999]
+        full_to = datetime.combine(date_to.date(), time.max) if date_to.time() >= time(23, 59, 59) else date_to
+
+        periods, full_periods = [], []
+        parts, params = [], []
+        start = self._period_start(date_from.date(), grain)
+        while start <= date_to.date():
+            end = self._next_period(start, grain)
+            period_from = datetime.combine(start, time.min)
+            period_to = datetime.combine(end - timedelta(days=1), time.max)
+            periods.append(start)
+            if date_from <= period_from and period_to <= full_to:
+                full_periods.append(start)
+            else:
+                count_query, count_params = self._count_query(
+                    max(date_from, period_from), min(date_to, period_to), scope, campaign_ids)
+                parts.append("SELECT %s::date AS period, campaign_id, stage_id, lead_count FROM (" + count_query + ") p")
+                params.extend([start] + count_params)
+            start = end
+
+        if full_periods:
+            if campaign_ids is not None:
+                scope = dict(scope or {}, campaign_ids=list(campaign_ids))
+            scope_conditions, scope_params = self._scope_conditions(scope)
+            parts.insert(0, """
+                SELECT period, campaign_id, stage_id, lead_count
+                FROM %s
+                WHERE grain = %%s AND period = ANY(%%s)
+            """ % self._rollup_table + "".join(" AND " + condition for condition in scope_conditions))
+            params = [grain, full_periods] + scope_params + params
+
+        if not parts:
+            return EMPTY_TREND_QUERY, [], periods
+        return " UNION ALL ".join(parts), params, periods
+
+    @api.model
+    def _estimate_query(self, date_from=None, date_to=None, scope=None, campaign_ids=None):
+        """
+        Build a query estimating the leads created within the range from the
+        month buckets alone, without reading crm_lead nor any day bucket:
+        its cost only depends on the number of months of the range. Leads
+        of a partially covered month are assumed evenly spread over the
+        month and counted in proportion to the covered time.
+        Rows are aggregated per (campaign_id, stage_id, lead_count,
+        low_count, high_count): ``lead_count`` is the rounded estimate and
+        the exact count is between ``low_count`` (whole months only) and
+        ``high_count`` (every overlapping month). stage_id is 0 for leads
+        without a stage.
+        :return: tuple (query, params)
+        """
+        date_from = fields.Datetime.to_datetime(date_from) if date_from else None
+        date_to = fields.Datetime.to_datetime(date_to) if date_to else None
+        if not date_from or not date_to:
+            first_day, last_day = self._get_period_bounds()
+            if not first_day:
+                return EMPTY_ESTIMATE_QUERY, []
+            date_from = date_from or datetime.combine(first_day, time.min)
+            date_to = date_to or datetime.combine(last_day, time.max)
+        # Callers express "until the end of the day" with 23:59:59[.999999]
+        if date_to.time() >= time(23, 59, 59):
+            date_to = datetime.combine(date_to.date() + timedelta(days=1), time.min)
+
+        periods, weights = [], []
+        start = self._period_start(date_from.date(), 'month')
+        while datetime.combine(start, time.min) < date_to:
+            end = self._next_period(start, 'month')
+            period_from = datetime.combine(start, time.min)
+            period_to = datetime.combine(end, time.min)
+            covered = min(date_to, period_to) - max(date_from, period_from)
+            if covered.total_seconds() > 0:
+                periods.append(start)
+                weights.append(covered.total_seconds() / (period_to - period_from).total_seconds())
+            start = end
+        if not periods:
+            return EMPTY_ESTIMATE_QUERY, []
+
+        if campaign_ids is not None:
+            scope = dict(scope or {}, campaign_ids=list(campaign_ids))
+        scope_conditions, scope_params = self._scope_conditions(scope, alias='r')
+        query = """
+            SELECT
+                r.campaign_id,
+                r.stage_id,
+                ROUND(SUM(r.lead_count * w.weight))::integer AS lead_count,
+                COALESCE(SUM(r.lead_count) FILTER (WHERE w.weight = 1), 0) AS low_count,
+                SUM(r.lead_count) AS high_count
+            FROM %s r
+            JOIN unnest(%%s::date[], %%s::float8[]) AS w (period, weight) ON w.period = r.period
+            WHERE r.grain = 'month' AND r.period = ANY(%%s)
+        """ % self._rollup_table + "".join(" AND " + condition for condition in scope_conditions) + """
+            GROUP BY r.campaign_id, r.stage_id
+        """
+        return query, [periods, weights, periods] + scope_params
+
+    @api.model
+    def _get_period_bounds(self):
+        """First and last day present in the rollup, (None, None) when empty"""
+        self.env.cr.execute("""
+            SELECT MIN(period), MAX(period) FROM %s WHERE grain = 'day'
+        """ % self._rollup_table)
+        return self.env.cr.fetchone()
+
+    @api.model
+    def _split_range(self, date_from=None, date_to=None):
+        """
+        Split a creation datetime range into whole rollup buckets and the
+        partial boundary days that have to be counted from crm_lead.
+        :return: tuple (periods, raw_ranges) where periods maps each grain
+                 to the list of bucket start dates covering the whole days of
+                 the range, and raw_ranges is a list of (start, end) datetime
+                 pairs (both inclusive) for the partial days
+        """
+        periods = {grain: [] for grain in GRAINS}
+        raw_ranges = []
+
+        date_from = fields.Datetime.to_datetime(date_from) if date_from else None
+        date_to = fields.Datetime.to_datetime(date_to) if date_to else None
+        if not date_from or not date_to:
+            first_day, last_day = self._get_period_bounds()
+            if not first_day:
+                return periods, raw_ranges
+            date_from = date_from or datetime.combine(first_day, time.min)
+            date_to = date_to or datetime.combine(last_day, time.max)
+        if date_from > date_to:
+            return periods, raw_ranges
+
+        start = date_from.date()
+        end = date_to.date()
+        # Callers express "until the end of the day" with 23:59:59[.999999]
+        end_is_full = date_to.time() >= time(23, 59, 59)
+
+        if date_from.time() != time.min:
+            if start == end:
+                return periods, [(date_from, date_to)]
+            raw_ranges.append((date_from, datetime.combine(start, time.max)))
+            start += timedelta(days=1)
+        if not end_is_full:
+            if start <= end:
+                raw_ranges.append((max(date_from, datetime.combine(end, time.min)), date_to))
+            end -= timedelta(days=1)
+
+        day = start
+        while day <= end:
+            next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+            if day.day == 1 and next_month - timedelta(days=1) <= end:
+                periods['month'].append(day)
+                day = next_month
+                continue
+            week_end = day + timedelta(days=6)
+            # Never let a week swallow the start of a month that would
+            # otherwise be covered by a single month bucket
+            month_fits = (next_month.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1) <= end
+            if day.weekday() == 0 and week_end <= end and (week_end < next_month or not month_fits):
+                periods['week'].append(day)
+                day = week_end + timedelta(days=1)
+                continue
+            periods['day'].append(day)
+            day += timedelta(days=1)
+
+        return periods, raw_ranges
+
+    @api.model
+    def _scope_conditions(self, scope, raw=False, alias=None):
+        """
+        SQL conditions restricting the counted leads to an access scope
+        :param scope: dict with optional ``company_ids``, ``team_ids``,
+                      ``user_ids`` and ``campaign_ids`` lists (0 standing
+                      for empty), a missing or None entry means no
+                      restriction on that column
+        :param raw: conditions on crm_lead instead of the rollup table
+        :param alias: optional alias of the table in the query
+        :return: tuple (conditions, params)
+        """
+        conditions, params = [], []
+        for column in SCOPE_COLUMNS + ('campaign_id',):
+            ids = (scope or {}).get(column + 's')
+            if ids is not None:
+                if alias:
+                    column = '%s.%s' % (alias, column)
+                expression = "COALESCE(%s, 0)" % column if raw else column
+                conditions.append("%s = ANY(%%s)" % expression)
+                params.append(list(ids))
+        return conditions, params
+
+    @api.model
+    def _count_query(self, date_from=None, date_to=None, scope=None, campaign_ids=None):
+        """
+        Build a query returning (campaign_id, stage_id, lead_count) rows for
+        the leads created within the range. Whole days are summed from the
+        rollup buckets, only partial boundary days are read from crm_lead.
+        Rows are not aggregated: the same (campaign, stage) may appear
+        several times and stage_id is 0 for leads without a stage.
+        :param scope: access restrictions, see _scope_conditions(); the
+                      company restriction prunes the other partitions
+        :param campaign_ids: optional list of campaigns to count (a shard)
+        :return: tuple (query, params)
+        """
+        periods, raw_ranges = self._split_range(date_from, date_to)
+        if campaign_ids is not None:
+            scope = dict(scope or {}, campaign_ids=list(campaign_ids))
+
+        parts = []
+        params = []
+        bucket_conditions = []
+        bucket_params = []
+        for grain in GRAINS:
+            if periods[grain]:
+                bucket_conditions.append("(grain = %s AND period = ANY(%s))")
+                bucket_params.extend([grain, periods[grain]])
+        if bucket_conditions:
+            scope_conditions, scope_params = self._scope_conditions(scope)
+            parts.append("""
+                SELECT campaign_id, stage_id, lead_count
+                FROM %s
+                WHERE (%s)
+            """ % (self._rollup_table, " OR ".join(bucket_conditions))
+                + "".join(" AND " + condition for condition in scope_conditions))
+            params.extend(bucket_params + scope_params)
+
+        if raw_ranges:
+            scope_conditions, scope_params = self._scope_conditions(scope, raw=True)
+            parts.append("""
+                SELECT campaign_id, COALESCE(stage_id, 0) AS stage_id, COUNT(*) AS lead_count
+                FROM crm_lead
+                WHERE campaign_id IS NOT NULL AND active
+                AND (%s)
+            """ % " OR ".join(["create_date BETWEEN %s AND %s"] * len(raw_ranges))
+                + "".join(" AND " + condition for condition in scope_conditions)
+                + " GROUP BY 1, 2")
+            for range_start, range_end in raw_ranges:
+                params.extend([range_start, range_end])
+            params.extend(scope_params)
+
+        if not parts:
+            # Nothing to count, keep the caller's SQL valid
+            return "SELECT NULL::integer AS campaign_id, 0 AS stage_id, 0 AS lead_count WHERE false", []
+        return " UNION ALL ".join(parts), params
+
+    @api.model
+    def _multi_count_query(self, ranges, scope=None, campaign_ids=None):
+        """
+        Build a query counting the leads of several creation ranges at once.
+        Each range is split like in _count_query(), then every rollup bucket
+        and boundary lead of any range is read once and counted in the
+        ranges it belongs to with FILTER clauses.
+        :param ranges: list of (date_from, date_to) pairs
+        :param scope: access restrictions, see _scope_conditions()
+        :param campaign_ids: optional list of campaigns to count
+        :return: tuple (query, params), the query returns aggregated
+                 (campaign_id, stage_id, count_0, ..., count_<n-1>) rows, one
+                 count per range; stage_id is 0 for leads without a stage
+        """
+        splits = [self._split_range(date_from, date_to) for date_from, date_to in ranges]
+        if campaign_ids is not None:
+            scope = dict(scope or {}, campaign_ids=list(campaign_ids))
+
+        parts = []
+        params = []
+        all_periods = {grain: set() for grain in GRAINS}
+        filters, filter_params = [], []
+        for periods, _raw_ranges in splits:
+            conditions = []
+            for grain in GRAINS:
+                if periods[grain]:
+                    conditions.append("(grain = %s AND period = ANY(%s))")
+                    filter_params.extend([grain, periods[grain]])
+                    all_periods[grain].update(periods[grain])
+            filters.append(" OR ".join(conditions) or "false")
+        if any(all_periods.values()):
+            bucket_conditions, bucket_params = [], []
+            for grain in GRAINS:
+                if all_periods[grain]:
+                    bucket_conditions.append("(grain = %s AND period = ANY(%s))")
+                    bucket_params.extend([grain, sorted(all_periods[grain])])
+            scope_conditions, scope_params = self._scope_conditions(scope)
+            parts.append("SELECT campaign_id, stage_id, " + ", ".join(
+                "COALESCE(SUM(lead_count) FILTER (WHERE %s), 0) AS count_%s" % (condition, index)
+                for index, condition in enumerate(filters)
+            ) + """
+                FROM %s
+                WHERE (%s)
+            """ % (self._rollup_table, " OR ".join(bucket_conditions))
+                + "".join(" AND " + condition for condition in scope_conditions)
+                + " GROUP BY 1, 2")
+            params.extend(filter_params + bucket_params + scope_params)
+
+        raw_ranges = [range_ for _periods, split_ranges in splits for range_ in split_ranges]
+        if raw_ranges:
+            filters, filter_params = [], []
+            for _periods, split_ranges in splits:
+                filters.append(" OR ".join(["create_date BETWEEN %s AND %s"] * len(split_ranges)) or "false")
+                for range_start, range_end in split_ranges:
+                    filter_params.extend([range_start, range_end])
+            scope_conditions, scope_params = self._scope_conditions(scope, raw=True)
+            parts.append("SELECT campaign_id, COALESCE(stage_id, 0) AS stage_id, " + ", ".join(
+                "COUNT(*) FILTER (WHERE %s) AS count_%s" % (condition, index)
+                for index, condition in enumerate(filters)
+            ) + """
+                FROM crm_lead
+                WHERE campaign_id IS NOT NULL AND active
+                AND (%s)
+            """ % " OR ".join(["create_date BETWEEN %s AND %s"] * len(raw_ranges))
+                + "".join(" AND " + condition for condition in scope_conditions)
+                + " GROUP BY 1, 2")
+            params.extend(filter_params)
+            for range_start, range_end in raw_ranges:
+                params.extend([range_start, range_end])
+            params.extend(scope_params)
+
+        if not parts:
+            # Nothing to count, keep the caller's SQL valid
+            return "SELECT NULL::integer AS campaign_id, 0 AS stage_id, %s WHERE false" % ", ".join(
+                "0 AS count_%s" % index for index in range(len(ranges))), []
+        return "SELECT campaign_id, stage_id, %s FROM (%s) p GROUP BY 1, 2" % (
+            ", ".join("SUM(count_%s) AS count_%s" % (index, index) for index in range(len(ranges))),
+            " UNION ALL ".join(parts),
+        ), params
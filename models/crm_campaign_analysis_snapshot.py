@@ -0,0 +1,346 @@
+from odoo import api, fields, models, sql_db
+from datetime import date
+from dateutil.relativedelta import relativedelta
+import logging
+import re
+
+from .campaign_analysis_cache import get_cache
+from .campaign_analysis_profiler import phase, profile, record_cache, record_rows
+
+_logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the snapshot table changes: init() rebuilds it
+SNAPSHOT_VERSION = '1'
+
+# Months of snapshots kept, older monthly partitions are detached and dropped
+DEFAULT_RETENTION_MONTHS = 24
+
+# Monthly partitions are named <table>_pYYYYMM
+PARTITION_SUFFIX = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+class CrmCampaignAnalysisSnapshot(models.AbstractModel):
+    """
+    Daily snapshots of the campaign x stage lead counts.
+
+    A scheduled action copies the current distribution of the leads
+    (summed from the monthly rollup buckets, so it never reads crm_lead)
+    into a table partitioned by month of the snapshot date. Past
+    distributions are then read from a single partition instead of being
+    reconstructed from the stage history. Like the rollup, counts are keyed
+    on company, sales team and salesperson so that the access scope of the
+    user applies. Partitions older than the retention are detached and
+    dropped.
+    """
+    _name = 'crm.campaign.analysis.snapshot'
+    _description = 'CRM Campaign Analysis Snapshot'
+
+    _snapshot_table = 'crm_campaign_analysis_snapshot'
+
+    def init(self):
+        cr = self.env.cr
+        table = self._snapshot_table
+        cr.execute("SELECT obj_description(to_regclass(%s), 'pg_class')", (table,))
+        if cr.fetchone()[0] == SNAPSHOT_VERSION:
+            return
+
+        cr.execute("DROP TABLE IF EXISTS %s CASCADE" % table)
+        cr.execute("""
+            CREATE TABLE %(table)s (
+                snapshot_date date NOT NULL,
+                company_id integer NOT NULL DEFAULT 0,
+                campaign_id integer NOT NULL,
+                stage_id integer NOT NULL DEFAULT 0,
+                team_id integer NOT NULL DEFAULT 0,
+                user_id integer NOT NULL DEFAULT 0,
+                lead_count integer NOT NULL,
+                PRIMARY KEY (snapshot_date, company_id, campaign_id, stage_id, team_id, user_id)
+            ) PARTITION BY RANGE (snapshot_date);
+            COMMENT ON TABLE %(table)s IS '%(version)s';
+        """ % {'table': table, 'version': SNAPSHOT_VERSION})
+        self._take_snapshot()
+
+    @api.model
+    def _drop_snapshots(self):
+        """Remove the snapshot table and its partitions (used on uninstall)"""
+        self.env.cr.execute("DROP TABLE IF EXISTS %s CASCADE" % self._snapshot_table)
+
+    # ------------------------------------------------------------------
+    # Partitions
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _get_partitions(self):
+        """Monthly partitions as a {first day of the month: table name} dict"""
+        self.env.cr.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        """, (self._snapshot_table,))
+        partitions = {}
+        for name, in self.env.cr.fetchall():
+            match = PARTITION_SUFFIX.search(name)
+            if match:
+                partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+        return partitions
+
+    @api.model
+    def _ensure_partition(self, day):
+        """Create the partition of the month of ``day`` if missing"""
+        month = day.replace(day=1)
+        if month in self._get_partitions():
+            return
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS %s_p%s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)
+        """ % (self._snapshot_table, month.strftime('%Y%m'), self._snapshot_table),
+            (month, month + relativedelta(months=1)))
+
+    @api.model
+    def _get_retention_months(self):
+        value = self.env['ir.config_parameter'].sudo().get_param(
+            'crm_campaign_analysis.snapshot_retention_months', DEFAULT_RETENTION_MONTHS)
+        try:
+            return max(int(value), 1)
+        except (TypeError, ValueError):
+            return DEFAULT_RETENTION_MONTHS
+
+    @api.model
+    def _gc_partitions(self, today=None):
+        """
+        Detach and drop the partitions older than the retention, once the
+        current transaction is committed (see _drop_partitions())
+        """
+        today = today or fields.Date.today()
+        limit = today.replace(day=1) - relativedelta(months=self._get_retention_months())
+        names = [name for month, name in sorted(self._get_partitions().items()) if month < limit]
+        if names:
+            dbname = self.env.cr.dbname
+            self.env.cr.postcommit.add(lambda: self._drop_partitions(dbname, names))
+
+    @api.model
+    def _drop_partitions(self, dbname, names):
+        """
+        Detach and drop partitions on an autocommit cursor. DETACH PARTITION
+        CONCURRENTLY (PostgreSQL 14+) cannot run in a transaction block; it
+        only takes a SHARE UPDATE EXCLUSIVE lock on the parent, so snapshot
+        reads go on. A plain DETACH takes an ACCESS EXCLUSIVE lock on the
+        parent, which blocks the readers for the short time of the detach.
+
+        A concurrent detach that failed or was interrupted leaves its
+        partition pending detach, and only DETACH ... FINALIZE completes
+        it: such partitions (all expired ones, only this method detaches
+        partitions) are finalized and dropped first. Every partition is
+        handled on its own so that a failing one does not keep the others;
+        it is retried by the next scheduled snapshot.
+        """
+        table = self._snapshot_table
+        try:
+            with sql_db.db_connect(dbname).cursor() as cr:
+                cr._cnx.autocommit = True
+                concurrently = cr._cnx.server_version >= 140000
+                pending = []
+                if concurrently:
+                    cr.execute("""
+                        SELECT c.relname
+                        FROM pg_inherits i
+                        JOIN pg_class c ON c.oid = i.inhrelid
+                        WHERE i.inhparent = to_regclass(%s) AND i.inhdetachpending
+                        ORDER BY c.relname
+                    """, (table,))
+                    pending = [name for name, in cr.fetchall()]
+                for name in pending + [name for name in names if name not in pending]:
+                    try:
+                        if name in pending:
+                            cr.execute("ALTER TABLE %s DETACH PARTITION %s FINALIZE" % (table, name))
+                        else:
+                            cr.execute("ALTER TABLE %s DETACH PARTITION %s%s" % (
+                                table, name, " CONCURRENTLY" if concurrently else ""))
+                        cr.execute("DROP TABLE %s" % name)
+                        _logger.info("Dropped campaign analysis snapshot partition %s", name)
+                    except Exception:
+                        _logger.exception("Could not drop the expired campaign analysis snapshot partition %s", name)
+        except Exception:
+            # Retried by the next scheduled snapshot
+            _logger.exception("Could not drop the expired campaign analysis snapshots")
+
+    # ------------------------------------------------------------------
+    # Snapshots
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _take_snapshot(self, snapshot_date=None):
+        """
+        Store the current distribution of the leads as the snapshot of
+        ``snapshot_date`` (today by default), replacing a previous one
+        :return: number of rows stored
+        """
+        cr = self.env.cr
+        snapshot_date = snapshot_date or fields.Date.today()
+        self._ensure_partition(snapshot_date)
+        cr.execute("DELETE FROM %s WHERE snapshot_date = %%s" % self._snapshot_table, (snapshot_date,))
+        cr.execute("""
+            INSERT INTO %(snapshot)s (snapshot_date, company_id, campaign_id, stage_id, team_id, user_id, lead_count)
+            SELECT %%s, company_id, campaign_id, stage_id, team_id, user_id, SUM(lead_count)
+            FROM %(rollup)s
+            WHERE grain = 'month'
+            GROUP BY company_id, campaign_id, stage_id, team_id, user_id
+            HAVING SUM(lead_count) > 0
+        """ % {
+            'snapshot': self._snapshot_table,
+            'rollup': self.env['crm.campaign.analysis.rollup']._rollup_table,
+        }, (snapshot_date,))
+        _logger.info("Campaign analysis snapshot of %s: %s rows", snapshot_date, cr.rowcount)
+        # A snapshot taken again replaces the rows of its day: the cached
+        # results read from the previous ones are invalidated
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        return cr.rowcount
+
+    @api.model
+    def _cron_take_snapshot(self):
+        """Scheduled action: snapshot of the day, then retention"""
+        self._take_snapshot()
+        self._gc_partitions()
+
+    @api.model
+    def get_snapshot_dates(self):
+        """Dates with a snapshot, most recent first"""
+        self.env.cr.execute("SELECT DISTINCT snapshot_date FROM %s ORDER BY 1 DESC" % self._snapshot_table)
+        return [fields.Date.to_string(row[0]) for row in self.env.cr.fetchall()]
+
+    @api.model
+    def _resolve_snapshot_date(self, snapshot_date):
+        """Latest snapshot date on or before ``snapshot_date``, None if there is none"""
+        self.env.cr.execute(
+            "SELECT MAX(snapshot_date) FROM %s WHERE snapshot_date <= %%s" % self._snapshot_table,
+            (fields.Date.to_date(snapshot_date),))
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _snapshot_query(self, snapshot_date, scope=None):
+        """
+        Build a query returning (campaign_id, stage_id, lead_count) rows of
+        a snapshot, like crm.campaign.analysis.rollup._count_query()
+        :param snapshot_date: exact date of the snapshot, see _resolve_snapshot_date(),
+                              False for no snapshot
+        :param scope: access restrictions, see _scope_conditions() of the rollup
+        :return: tuple (query, params)
+        """
+        if not snapshot_date:
+            return "SELECT NULL::integer AS campaign_id, 0 AS stage_id, 0 AS lead_count WHERE false", []
+        conditions, params = self.env['crm.campaign.analysis.rollup']._scope_conditions(scope)
+        # A literal date lets the planner prune the other monthly partitions
+        query = """
+            SELECT campaign_id, stage_id, lead_count
+            FROM %s
+            WHERE snapshot_date = %%s
+        """ % self._snapshot_table + "".join(" AND " + condition for condition in conditions)
+        return query, [snapshot_date] + params
+
+    @api.model
+    def get_snapshot_matrix(self, snapshot_date):
+        """
+        Campaign analysis of a past day, from its snapshot
+        :param snapshot_date: day of the analysis, the latest snapshot taken
+                              on or before it is used
+        :return: columnar payload like get_campaign_stage_matrix() of the
+                 report, plus the ``snapshot_date`` actually used (False
+                 and no campaign when there is no snapshot that old)
+        """
+        with profile(self.env, 'snapshot'):
+            report_model = self.env['crm.campaign.analysis.report']
+            resolved = self._resolve_snapshot_date(snapshot_date)
+            cache = get_cache(self.env.cr.dbname)
+            key = report_model._get_cache_key(None, None, 'snapshot', str(resolved))
+            generation = report_model._get_data_generation()
+            result = cache.get(key, generation)
+            record_cache(result is not None)
+            if result is None:
+                result = self._compute_snapshot_matrix(resolved)
+                report_model._cache_result(cache, key, generation, result)
+            return result
+
+    @api.model
+    def _compute_snapshot_matrix(self, snapshot_date):
+        report_model = self.env['crm.campaign.analysis.report']
+        with phase('stages'):
+            stage_ids, stage_names = report_model._get_stages()
+
+        rows = []
+        if snapshot_date:
+            query, params = report_model._stage_distribution_query(
+                count_query=self._snapshot_query(snapshot_date, report_model._get_access_scope()))
+            with phase('sql'):
+                self.env.cr.execute(query, params)
+                rows = self.env.cr.fetchall()
+        record_rows(len(rows))
+
+        campaign_ids, campaign_names, totals, counts, percentages = [], [], [], [], []
+        for campaign_id, campaign_name, total, row_counts, row_percentages in report_model._group_campaign_rows(
+                rows, stage_ids):
+            campaign_ids.append(campaign_id)
+            campaign_names.append(campaign_name)
+            totals.append(total)
+            counts.append(row_counts)
+            percentages.append(row_percentages)
+
+        return {
+            'snapshot_date': fields.Date.to_string(snapshot_date) if snapshot_date else False,
+            'campaign_ids': campaign_ids,
+            'campaign_names': campaign_names,
+            'totals': totals,
+            'stage_ids': stage_ids,
+            'stage_names': stage_names,
+            'counts': counts,
+            'percentages': percentages,
+        }
+
+    @api.model
+    def compare_snapshots(self, date_from, date_to):
+        """
+        Compare the campaign analysis of two days, from their snapshots
+        :return: dict with ``snapshot_dates`` (the two snapshot dates used),
+                 parallel lists ``campaign_ids``/``campaign_names`` (campaigns
+                 of either snapshot, in name order), ``stage_ids``/
+                 ``stage_names``, ``totals``, ``counts`` and ``percentages``
+                 as pairs (before, after) of the matrices of each snapshot,
+                 and the ``count_deltas``/``percentage_deltas`` matrices
+                 (after - before, percentage points)
+        """
+        with profile(self.env, 'snapshot_compare'):
+            before = self.get_snapshot_matrix(date_from)
+            after = self.get_snapshot_matrix(date_to)
+
+            with phase('reshape'):
+                names = dict(zip(before['campaign_ids'], before['campaign_names']))
+                names.update(zip(after['campaign_ids'], after['campaign_names']))
+                campaign_ids = sorted(names, key=lambda campaign_id: (names[campaign_id] or '', campaign_id))
+                empty = [0] * len(before['stage_ids'])
+                aligned = []
+                for matrix in (before, after):
+                    rows = {campaign_id: row for row, campaign_id in enumerate(matrix['campaign_ids'])}
+                    aligned.append((
+                        [matrix['totals'][rows[c]] if c in rows else 0 for c in campaign_ids],
+                        [matrix['counts'][rows[c]] if c in rows else empty for c in campaign_ids],
+                        [matrix['percentages'][rows[c]] if c in rows else [0.0] * len(empty) for c in campaign_ids],
+                    ))
+                (totals_before, counts_before, percentages_before), (totals_after, counts_after, percentages_after) = aligned
+
+                return {
+                    'snapshot_dates': [before['snapshot_date'], after['snapshot_date']],
+                    'campaign_ids': campaign_ids,
+                    'campaign_names': [names[campaign_id] for campaign_id in campaign_ids],
+                    'stage_ids': after['stage_ids'],
+                    'stage_names': after['stage_names'],
+                    'totals': [totals_before, totals_after],
+                    'counts': [counts_before, counts_after],
+                    'percentages': [percentages_before, percentages_after],
+                    'count_deltas': [
+                        [b - a for a, b in zip(row_before, row_after)]
+                        for row_before, row_after in zip(counts_before, counts_after)
+                    ],
+                    'percentage_deltas': [
+                        [b - a for a, b in zip(row_before, row_after)]
+                        for row_before, row_after in zip(percentages_before, percentages_after)
+                    ],
+                }
@@ -0,0 +1,121 @@
+from odoo import api, fields, models
+from collections import Counter
+
+# Notification type of the lead count deltas sent to open dashboards
+DELTA_NOTIFICATION = 'crm_campaign_analysis/delta'
+
+# Fields of crm.lead changing the campaign analysis cell a lead counts in
+DELTA_FIELDS = {'campaign_id', 'stage_id', 'active', 'company_id', 'team_id', 'user_id'}
+
+# Fields of crm.lead read by the analyses, see the generation triggers
+GENERATION_FIELDS = DELTA_FIELDS | {'create_date'}
+
+
+class CrmLead(models.Model):
+    _inherit = 'crm.lead'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        leads = super().create(vals_list)
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        leads._campaign_analysis_add_deltas(Counter(leads._campaign_analysis_keys()))
+        return leads
+
+    def write(self, vals):
+        # Key fields also change through the recomputation of stored fields
+        # (e.g. the stage from the sales team), not only when written
+        if not self._campaign_analysis_depends().intersection(vals):
+            return super().write(vals)
+        before = Counter(self._campaign_analysis_keys())
+        result = super().write(vals)
+        after = Counter(self._campaign_analysis_keys())
+        after.subtract(before)
+        if GENERATION_FIELDS.intersection(vals) or any(after.values()):
+            self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        self._campaign_analysis_add_deltas(after)
+        return result
+
+    def unlink(self):
+        deltas = Counter()
+        deltas.subtract(self._campaign_analysis_keys())
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        result = super().unlink()
+        self._campaign_analysis_add_deltas(deltas)
+        return result
+
+    @api.model
+    def _campaign_analysis_depends(self):
+        """
+        Fields whose write may change the analysis cell of a lead: the
+        fields read by the analyses and, recursively, the fields their
+        stored computed ones depend on
+        """
+        names = set()
+        todo = list(GENERATION_FIELDS)
+        while todo:
+            name = todo.pop()
+            if name in names or name not in self._fields:
+                continue
+            names.add(name)
+            field = self._fields[name]
+            if field.compute and field.store:
+                todo.extend(path.split('.')[0] for path in self.pool.field_depends[field])
+        return names
+
+    def _campaign_analysis_keys(self):
+        """
+        Analysis cell of each counted lead, as (company, campaign, stage,
+        sales team, salesperson, creation date) with 0 for empty values
+        """
+        return [
+            (lead.company_id.id or 0, lead.campaign_id.id, lead.stage_id.id or 0,
+             lead.team_id.id or 0, lead.user_id.id or 0, fields.Datetime.to_string(lead.create_date))
+            for lead in self.sudo()
+            if lead.active and lead.campaign_id
+        ]
+
+    def _campaign_analysis_add_deltas(self, deltas):
+        """Accumulate the deltas of the transaction, published once before commit"""
+        deltas = Counter({key: delta for key, delta in deltas.items() if delta})
+        if not deltas:
+            return
+        data = self.env.cr.precommit.data
+        pending = data.get('crm_campaign_analysis.deltas')
+        if pending is None:
+            pending = data['crm_campaign_analysis.deltas'] = Counter()
+            self.env.cr.precommit.add(self._campaign_analysis_publish_deltas)
+        pending.update(deltas)
+
+    @api.model
+    def _campaign_analysis_publish_deltas(self):
+        """
+        Send the net deltas of the transaction to the open dashboards: to
+        the channel of the company of the leads, listened to by the users
+        seeing all the leads of the company (see ir.websocket), and to the
+        salespersons restricted to their own leads. Such salespersons do not
+        get the deltas of unassigned leads, which they see on reload.
+        Each delta is a [company_id, campaign_id, stage_id, team_id,
+        user_id, create_date, delta] list; messages are delivered when the
+        transaction commits.
+        """
+        pending = self.env.cr.precommit.data.pop('crm_campaign_analysis.deltas', Counter())
+        by_company = {}
+        by_user = {}
+        for (company_id, campaign_id, stage_id, team_id, user_id, create_date), delta in pending.items():
+            if not delta:
+                continue
+            row = [company_id, campaign_id, stage_id, team_id, user_id, create_date, delta]
+            by_company.setdefault(company_id, []).append(row)
+            if user_id:
+                by_user.setdefault(user_id, []).append(row)
+
+        bus = self.env['bus.bus'].sudo()
+        companies = self.env['res.company'].sudo()
+        for company_id, rows in by_company.items():
+            # Leads without a company are visible in every company
+            targets = companies.browse(company_id) if company_id else companies.search([])
+            for company in targets:
+                bus._sendone(company, DELTA_NOTIFICATION, {'deltas': rows})
+        for user in self.env['res.users'].sudo().browse(list(by_user)).exists():
+            if not user.has_group('sales_team.group_sale_salesman_all_leads'):
+                bus._sendone(user.partner_id, DELTA_NOTIFICATION, {'deltas': by_user[user.id]})
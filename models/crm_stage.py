@@ -0,0 +1,18 @@
+from odoo import api, models
+
+
+class CrmStage(models.Model):
+    _inherit = 'crm.stage'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        return super().unlink()
@@ -0,0 +1,12 @@
+from odoo import models
+
+
+class IrWebsocket(models.AbstractModel):
+    _inherit = 'ir.websocket'
+
+    def _build_bus_channel_list(self, channels):
+        # Lead count deltas of the campaign analysis are sent to the company
+        # channels, only subscribed by users seeing all the leads
+        if self.env.uid and self.env.user.has_group('sales_team.group_sale_salesman_all_leads'):
+            channels = list(channels) + list(self.env.user.company_ids)
+        return super()._build_bus_channel_list(channels)
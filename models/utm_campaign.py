@@ -0,0 +1,22 @@
+from odoo import api, models
+
+# Fields of utm.campaign read by the analyses, see the generation triggers
+GENERATION_FIELDS = {'name', 'active'}
+
+
+class UtmCampaign(models.Model):
+    _inherit = 'utm.campaign'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if GENERATION_FIELDS.intersection(vals):
+            self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env['crm.campaign.analysis.report']._bump_generation_after_commit()
+        return super().unlink()
@@ -1,6 +1,8 @@
 from odoo import models, fields, api
 from datetime import datetime
 
+from ..models.campaign_analysis_profiler import phase, profile
+
 
 class CampaignAnalysisHTMLReport(models.AbstractModel):
     _name = 'report.crm_campaign_analysis.campaign_analysis_report_template'
@@ -9,6 +11,11 @@ class CampaignAnalysisHTMLReport(models.AbstractModel):
     @api.model
     def _get_report_values(self, docids, data=None):
         """Prepare data for the HTML report template"""
+        with profile(self.env, 'html_report'):
+            return self._prepare_report_values(data)
+
+    @api.model
+    def _prepare_report_values(self, data=None):
         # Get the date range from context or data
         ctx = self.env.context
         date_from = ctx.get('date_from') or (data and data.get('date_from'))
@@ -22,8 +29,14 @@ class CampaignAnalysisHTMLReport(models.AbstractModel):
             
         # Get the report data
         report_model = self.env['crm.campaign.analysis.report']
-        data_dict = report_model.get_campaign_stage_analysis(date_from, date_to)
+        with phase('analysis'):
+            data_dict = report_model.get_campaign_stage_analysis(date_from, date_to)
         
+        with phase('template_values'):
+            return self._template_values(data_dict, date_from, date_to)
+
+    @api.model
+    def _template_values(self, data_dict, date_from, date_to):
         # Extract campaigns and stages for the template
         campaigns = list(data_dict.get('campaigns', {}).keys())
         campaign_names = {campaign_id: data_dict['campaigns'][campaign_id]['name'] 
@@ -44,7 +57,7 @@ class CampaignAnalysisHTMLReport(models.AbstractModel):
                 stage_info = data_dict['campaigns'][campaign_id]['stages'].get(stage_id, {})
                 campaign_data[campaign_id][stage_id] = stage_info
         
-        return {
+        values = {
             'date_from': date_from,
             'date_to': date_to,
             'campaigns': campaigns,
@@ -54,3 +67,5 @@ class CampaignAnalysisHTMLReport(models.AbstractModel):
             'campaign_data': campaign_data,
             'isinstance': isinstance,  # Needed for type checking in template
         }
+        values.update(self.env['crm.campaign.analysis.highlight.rule']._get_template_values(stage_names))
+        return values
@@ -23,9 +23,6 @@ class CrmCampaignAnalysisWizard(models.TransientModel):
         date_from = datetime.combine(self.date_from, datetime.min.time()) if self.date_from else None
         date_to = datetime.combine(self.date_to, datetime.max.time()) if self.date_to else None
         
-        # Force refresh the materialized view to ensure data is up-to-date
-        self.env['crm.campaign.analysis.report'].refresh_materialized_view()
-        
         # Prepare context for the report
         ctx = self.env.context.copy()
         ctx.update({
@@ -1,9 +1,35 @@
 from odoo import models, fields, api
-import base64
+from werkzeug.urls import url_encode
 import io
 import csv
+import logging
+import os
+import tempfile
+import time
 import xlsxwriter
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+
+from odoo.tools.pdf import merge_pdf
+
+from ..models.campaign_analysis_profiler import phase, profile, record_rows
+from ..models.crm_campaign_analysis_highlight_rule import stage_label
+from ..models.crm_campaign_analysis_report import FETCH_SIZE
+
+_logger = logging.getLogger(__name__)
+
+# Size of the chunks yielded by the streaming CSV export
+CSV_CHUNK_SIZE = 64 * 1024
+
+# Minimum delay, in seconds, between two progress updates of an export job
+PROGRESS_INTERVAL = 1.0
+
+# Campaign rows per wkhtmltopdf run of the PDF export
+PDF_CHUNK_SIZE = 500
+
+EXPORT_MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf',
+}
 
 
 class ReportExportWizard(models.TransientModel):
@@ -16,86 +42,83 @@ class ReportExportWizard(models.TransientModel):
         ('pdf', 'PDF')
     ], string='Export Type', default='xlsx', required=True)
     
-    data = fields.Binary('File', readonly=True)
+    include_counts = fields.Boolean('Include Lead Counts',
+                                    help="Add the number of leads of each stage next to its percentage (CSV only)")
+    date_from = fields.Datetime('From', readonly=True)
+    date_to = fields.Datetime('To', readonly=True)
+    attachment_id = fields.Many2one('ir.attachment', string='Attachment', readonly=True)
+    data = fields.Binary('File', related='attachment_id.datas', readonly=True)
     filename = fields.Char('Filename', readonly=True)
     state = fields.Selection([
         ('choose', 'choose'),
-        ('done', 'done')
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'done'),
+        ('failed', 'Failed')
     ], string='State', default='choose')
+    progress = fields.Integer('Progress', readonly=True)
+    started_at = fields.Datetime('Started On', readonly=True)
+    finished_at = fields.Datetime('Finished On', readonly=True)
+    duration = fields.Float('Duration (s)', readonly=True, digits=(16, 2))
+    error_message = fields.Text('Error', readonly=True)
+
+    def unlink(self):
+        # Generated files are only reachable through their export job
+        self.sudo().attachment_id.unlink()
+        return super(ReportExportWizard, self).unlink()
     
     def action_export(self):
         self.ensure_one()
         
         # Get context information passed from the wizard
         ctx = self.env.context
-        
-        # Check if date_from and date_to are passed as strings (from URL parameters)
-        date_from = ctx.get('date_from')
-        date_to = ctx.get('date_to')
-        
-        # Convert string dates to datetime if needed
-        if date_from and isinstance(date_from, str):
-            try:
-                date_from = datetime.strptime(date_from, '%Y-%m-%d')
-            except ValueError:
-                date_from = datetime.now() - timedelta(days=30)
-        
-        if date_to and isinstance(date_to, str):
-            try:
-                date_to = datetime.strptime(date_to, '%Y-%m-%d')
-            except ValueError:
-                date_to = datetime.now()
-                
-        # Force refresh the materialized view
-        self.env['crm.campaign.analysis.report'].refresh_materialized_view()
-        
-        # Get report data
-        report_model = self.env['crm.campaign.analysis.report']
-        data = report_model.get_campaign_stage_analysis(date_from, date_to)
-        
         if self.export_type == 'csv':
-            return self._export_csv(data)
-        elif self.export_type == 'xlsx':
-            return self._export_xlsx(data)
-        elif self.export_type == 'pdf':
-            return self._export_pdf(data)
-            
-    def _export_csv(self, data):
-        # Initialize string IO and csv writer
-        output = io.StringIO()
-        writer = csv.writer(output)
+            # Streamed by a controller, no need to load the analysis here
+            return self._export_csv(ctx.get('date_from'), ctx.get('date_to'))
         
-        # Write headers
-        headers = ['Campaign']
-        for stage_id, stage_name in data.get('stages', {}).items():
-            # Handle potential dictionary format from translation
-            if isinstance(stage_name, dict):
-                # Use the first value in the dict or a default value if empty
-                name_value = next(iter(stage_name.values()), "Unknown")
-            else:
-                name_value = stage_name
-                
-            headers.append(f"{name_value} (%)")
-        headers.append('Total Leads')
-        writer.writerow(headers)
-        
-        # Write data rows
-        for campaign_id, campaign_data in data.get('campaigns', {}).items():
-            row = [campaign_data['name']]
-            for stage_id, stage_name in data.get('stages', {}).items():
-                stage_info = campaign_data['stages'].get(stage_id, {'percentage': 0.0, 'lead_count': 0})
-                row.append(f"{stage_info['percentage']:.2f}%")
-            row.append(campaign_data['total_leads'])
-            writer.writerow(row)
-            
-        # Set file name and data
-        filename = f'campaign_analysis_{fields.Date.today().strftime("%Y%m%d")}.csv'
+        try:
+            date_from, date_to = self._normalize_range(ctx.get('date_from'), ctx.get('date_to'))
+        except ValueError:
+            date_from, date_to = self._normalize_range(datetime.now() - timedelta(days=30), datetime.now())
+
+        # XLSX and PDF files are generated by a background job, the wizard
+        # only tracks its progress
         self.write({
-            'data': base64.b64encode(output.getvalue().encode('utf-8')),
-            'filename': filename,
-            'state': 'done'
+            'date_from': date_from,
+            'date_to': date_to,
+            'state': 'queued',
+            'progress': 0,
+            'error_message': False,
         })
-        
+        self.env.ref('crm_campaign_analysis.ir_cron_campaign_analysis_export_jobs').sudo()._trigger()
+        return self._action_reopen()
+
+    @api.model
+    def _normalize_range(self, date_from=None, date_to=None):
+        """
+        Creation datetime range of an export, shared by every format: the
+        From and To days are included whole, up to 23:59:59 on the To day.
+        :param date_from: 'YYYY-MM-DD' string, date or datetime (only its
+                          day is used), missing for no bound
+        :param date_to: same
+        :return: tuple (date_from, date_to) of datetimes or None
+        :raise ValueError: on a malformed date string
+        """
+        def day(value):
+            if isinstance(value, str):
+                return datetime.strptime(value[:10], '%Y-%m-%d').date()
+            return value.date() if isinstance(value, datetime) else value
+
+        return (
+            datetime.combine(day(date_from), datetime.min.time()) if date_from else None,
+            datetime.combine(day(date_to), datetime.max.time()) if date_to else None,
+        )
+
+    def action_refresh(self):
+        self.ensure_one()
+        return self._action_reopen()
+
+    def _action_reopen(self):
         return {
             'type': 'ir.actions.act_window',
             'res_model': self._name,
@@ -104,11 +127,186 @@ class ReportExportWizard(models.TransientModel):
             'target': 'new',
             'context': self.env.context,
         }
-        
-    def _export_xlsx(self, data):
+
+    @api.model
+    def _cron_process_export_jobs(self, limit=10):
+        """Scheduled action: run the queued export jobs, oldest first"""
+        jobs = self.search([('state', '=', 'queued')], order='id', limit=limit)
+        for job in jobs:
+            # Generate the file with the access rights of the requester
+            job.with_user(job.create_uid)._run_export_job()
+        if len(jobs) == limit:
+            self.env.ref('crm_campaign_analysis.ir_cron_campaign_analysis_export_jobs')._trigger()
+
+    def _run_export_job(self):
+        self.ensure_one()
+        started = time.monotonic()
+        self.write({'state': 'running', 'started_at': fields.Datetime.now(), 'progress': 0})
+        self.env.cr.commit()
+
+        try:
+            with profile(self.env, 'export_%s' % self.export_type):
+                if self.export_type == 'xlsx':
+                    content = self._export_xlsx(self.date_from, self.date_to)
+                else:
+                    content = self._export_pdf(self.date_from, self.date_to)
+
+            filename = f'campaign_analysis_{fields.Date.today().strftime("%Y%m%d")}.{self.export_type}'
+            attachment = self.env['ir.attachment'].create({
+                'name': filename,
+                'raw': content,
+                'mimetype': EXPORT_MIMETYPES[self.export_type],
+                'res_model': self._name,
+                'res_id': self.id,
+            })
+            duration = time.monotonic() - started
+            self.write({
+                'attachment_id': attachment.id,
+                'filename': filename,
+                'state': 'done',
+                'progress': 100,
+                'finished_at': fields.Datetime.now(),
+                'duration': duration,
+            })
+            self.env.cr.commit()
+            _logger.info("Campaign analysis export %s (%s) done in %.2fs", self.id, self.export_type, duration)
+            self._notify_requester('Export Ready', f'{filename} is ready for download.', 'success')
+        except Exception as e:
+            self.env.cr.rollback()
+            _logger.exception("Campaign analysis export %s (%s) failed", self.id, self.export_type)
+            self.write({
+                'state': 'failed',
+                'finished_at': fields.Datetime.now(),
+                'duration': time.monotonic() - started,
+                'error_message': str(e),
+            })
+            self.env.cr.commit()
+            self._notify_requester('Export Failed', f'The campaign analysis export failed: {e}', 'danger')
+
+    def _notify_requester(self, title, message, notification_type):
+        self.env['bus.bus']._sendone(self.create_uid.partner_id, 'simple_notification', {
+            'title': title,
+            'message': message,
+            'type': notification_type,
+            'sticky': notification_type == 'danger',
+        })
+
+    def _progress_updater(self):
+        """
+        Return a ``callback(done, total)`` storing the job progress. It uses
+        its own cursor so that the progress is visible while the job's
+        transaction is still running, and writes at most once per
+        PROGRESS_INTERVAL.
+        """
+        last_update = [time.monotonic()]
+
+        def update(done, total):
+            now = time.monotonic()
+            if not total or now - last_update[0] < PROGRESS_INTERVAL:
+                return
+            last_update[0] = now
+            with self.pool.cursor() as cr:
+                cr.execute("UPDATE %s SET progress = %%s WHERE id = %%s" % self._table,
+                           (min(int(done * 100 / total), 99), self.id))
+
+        return update
+
+    def _export_csv(self, date_from=None, date_to=None):
+        # CSV files are streamed by a controller straight from the database,
+        # without building the file or a base64 copy of it in memory. The
+        # controller normalizes the range like _normalize_range()
+        params = {}
+        for key, value in (('date_from', date_from), ('date_to', date_to)):
+            if value:
+                params[key] = fields.Date.to_string(value) if isinstance(value, date) else value
+        if self.include_counts:
+            params['counts'] = 1
+
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/crm/campaign/analysis/export/csv?%s' % url_encode(params),
+            'target': 'self',
+        }
+
+    @api.model
+    def _iter_csv(self, date_from=None, date_to=None, include_counts=False):
+        """
+        Generate the CSV export as utf-8 encoded chunks. Campaign rows are
+        read from a server-side cursor and written as they arrive, so memory
+        use does not depend on the number of campaigns.
+        :param include_counts: add a lead count column after each stage percentage
+        """
+        report_model = self.env['crm.campaign.analysis.report']
+        stage_ids, stage_names = report_model._get_stages()
+
+        output = io.StringIO()
+        writer = csv.writer(output)
+
+        def flush():
+            chunk = output.getvalue()
+            output.seek(0)
+            output.truncate()
+            return chunk.encode('utf-8')
+
+        # Write headers
+        headers = ['Campaign']
+        for stage_name in stage_names:
+            name_value = stage_label(stage_name)
+            headers.append(f"{name_value} (%)")
+            if include_counts:
+                headers.append(f"{name_value} (Leads)")
+        headers.append('Total Leads')
+        writer.writerow(headers)
+        yield flush()
+
+        # Write data rows
+        cursor = self.env.cr._cnx.cursor('crm_campaign_analysis_csv_export')
+        cursor.itersize = FETCH_SIZE
+        try:
+            for campaign_id, campaign_name, total_leads, counts, percentages in report_model._iter_campaign_rows(
+                    cursor, stage_ids, date_from, date_to):
+                row = [campaign_name]
+                for lead_count, percentage in zip(counts, percentages):
+                    row.append(f"{percentage:.2f}%")
+                    if include_counts:
+                        row.append(lead_count)
+                row.append(total_leads)
+                writer.writerow(row)
+                record_rows(1)
+                if output.tell() >= CSV_CHUNK_SIZE:
+                    yield flush()
+            yield flush()
+        finally:
+            cursor.close()
+
+    def _export_xlsx(self, date_from=None, date_to=None):
+        """Generate the XLSX export and return its content"""
+        report_model = self.env['crm.campaign.analysis.report']
+        stage_ids, stage_names = report_model._get_stages()
+        progress = self._progress_updater()
+
+        # constant_memory flushes every row to the temporary file as soon
+        # as the next one starts, so rows must be written in order
+        fd, path = tempfile.mkstemp(prefix='campaign_analysis_', suffix='.xlsx')
+        os.close(fd)
+        try:
+            with phase('xlsx'):
+                self._write_xlsx(path, stage_ids, stage_names, date_from, date_to, progress)
+            with open(path, 'rb') as xlsx_file:
+                return xlsx_file.read()
+        finally:
+            os.unlink(path)
+
+    def _write_xlsx(self, path, stage_ids, stage_names, date_from=None, date_to=None, progress=None):
+        """
+        Write the XLSX export to ``path`` with flat memory use
+        :param progress: optional ``callback(done, total)`` called per campaign row
+        """
+        report_model = self.env['crm.campaign.analysis.report']
+        total_campaigns = report_model._count_campaigns(date_from, date_to) if progress else 0
+
         # Create a new workbook and worksheet
-        output = io.BytesIO()
-        workbook = xlsxwriter.Workbook(output)
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
         worksheet = workbook.add_worksheet('Campaign Analysis')
         
         # Define styles
@@ -141,128 +339,112 @@ class ReportExportWizard(models.TransientModel):
         text_format = workbook.add_format({
             'border': 1
         })
+
+        # Adjust column widths
+        worksheet.set_column(0, 0, 30)
+        worksheet.set_column(1, len(stage_ids) + 1, 15)
         
         # Write headers
         worksheet.write(0, 0, 'Campaign', header_format)
         col = 1
-        
-        # Write stage headers - ensure we're using string values for stage names
-        for stage_id, stage_name in data.get('stages', {}).items():
-            # Handle potential dictionary format from translation
-            if isinstance(stage_name, dict):
-                # Use the first value in the dict or a default value if empty
-                name_value = next(iter(stage_name.values()), "Unknown")
-            else:
-                name_value = stage_name
-                
-            worksheet.write(0, col, f"{name_value} (%)", header_format)
+        for stage_name in stage_names:
+            worksheet.write(0, col, f"{stage_label(stage_name)} (%)", header_format)
             col += 1
-            
         worksheet.write(0, col, 'Total Leads', header_format)
-        
+
+        # Resolve the highlight rules once per stage column
+        highlight_model = self.env['crm.campaign.analysis.highlight.rule']
+        bounds = highlight_model._compile(stage_names)
+
         # Write data rows
         row = 1
-        for campaign_id, campaign_data in data.get('campaigns', {}).items():
-            worksheet.write(row, 0, campaign_data['name'], text_format)
-            col = 1
-            
-            for stage_id, stage_name in data.get('stages', {}).items():
-                stage_info = campaign_data['stages'].get(stage_id, {'percentage': 0.0, 'lead_count': 0})
-                percentage_value = stage_info['percentage'] / 100
-                
-                # Get clean stage name for condition checking
-                if isinstance(stage_name, dict):
-                    name_value = next(iter(stage_name.values()), "Unknown")
-                else:
-                    name_value = stage_name
-                
-                # Apply conditional formatting based on rules
-                use_red_format = False
-                
-                # Condition 1: Highlight JUNK > 20%
-                if "JUNK" in name_value and percentage_value > 0.2:
-                    use_red_format = True
-                
-                # Condition 2: Highlight Not Connected (NC) > 20%
-                if ("Not Connected" in name_value or "NC" in name_value) and percentage_value > 0.2:
-                    use_red_format = True
-                
-                # Condition 3: Highlight Admission (A) < 5%
-                if ("Admission" in name_value or name_value == "A") and percentage_value < 0.05:
-                    use_red_format = True
-                
-                # Condition 4: Highlight Hot Prospect (HP) and Future Prospect (FP) < 5%
-                if ("Hot Prospect" in name_value or name_value == "HP" or 
-                    "Future Prospect" in name_value or name_value == "FP") and percentage_value < 0.05:
-                    use_red_format = True
-                
-                # Write cell with appropriate format
-                cell_format = red_percentage_format if use_red_format else percentage_format
-                worksheet.write(row, col, percentage_value, cell_format)
-                col += 1
-                
-            worksheet.write(row, col, campaign_data['total_leads'], number_format)
-            row += 1
-        
-        # Adjust column widths
-        worksheet.set_column(0, 0, 30)
-        worksheet.set_column(1, col, 15)
+        cursor = self.env.cr._cnx.cursor('crm_campaign_analysis_xlsx_export')
+        cursor.itersize = FETCH_SIZE
+        try:
+            for campaign_id, campaign_name, total_leads, counts, percentages in report_model._iter_campaign_rows(
+                    cursor, stage_ids, date_from, date_to):
+                worksheet.write_string(row, 0, campaign_name or '', text_format)
+                col = 1
+                for percentage, (low, high) in zip(percentages, bounds):
+                    cell_format = percentage_format if low <= percentage <= high else red_percentage_format
+                    worksheet.write_number(row, col, percentage / 100, cell_format)
+                    col += 1
+                worksheet.write_number(row, col, total_leads, number_format)
+                row += 1
+                record_rows(1)
+                if progress:
+                    progress(row - 1, total_campaigns)
+        finally:
+            cursor.close()
         
         # Add a legend for the highlighting
         legend_row = row + 3
         legend_title_format = workbook.add_format({'bold': True})
         worksheet.write(legend_row, 0, "Highlighted Conditions (Red):", legend_title_format)
-        worksheet.write(legend_row + 1, 0, "• JUNK > 20%")
-        worksheet.write(legend_row + 2, 0, "• Not Connected (NC) > 20%")
-        worksheet.write(legend_row + 3, 0, "• Admission (A) < 5%")
-        worksheet.write(legend_row + 4, 0, "• Hot Prospect (HP) and Future Prospect (FP) < 5%")
+        for index, legend in enumerate(highlight_model._get_legend(), 1):
+            worksheet.write(legend_row + index, 0, "• " + legend)
         
         # Close workbook
         workbook.close()
         
-        # Set file name and data
-        filename = f'campaign_analysis_{fields.Date.today().strftime("%Y%m%d")}.xlsx'
-        self.write({
-            'data': base64.b64encode(output.getvalue()),
-            'filename': filename,
-            'state': 'done'
-        })
-        
-        return {
-            'type': 'ir.actions.act_window',
-            'res_model': self._name,
-            'view_mode': 'form',
-            'res_id': self.id,
-            'target': 'new',
-            'context': self.env.context,
-        }
-        
-    def _export_pdf(self, data):
-        # For PDF, we'll use Odoo's report system
-        # Set context to include data for report template
-        ctx = dict(self.env.context)
-        ctx.update({
-            'campaign_analysis_data': data,
-            'date_from': ctx.get('date_from'),
-            'date_to': ctx.get('date_to'),
-        })
-        
+    def _export_pdf(self, date_from=None, date_to=None):
+        """Render the PDF export and return its content"""
+        with phase('analysis'):
+            matrix = self.env['crm.campaign.analysis.report'].get_campaign_stage_matrix(date_from, date_to)
+        with phase('pdf'):
+            content, _timings = self._render_pdf(matrix, date_from, date_to, self._progress_updater())
+        return content
+
+    def _render_pdf(self, matrix, date_from=None, date_to=None, progress=None):
+        """
+        Render the PDF of a columnar payload (see get_campaign_stage_matrix())
+        in chunks of PDF_CHUNK_SIZE campaign rows, each one a separate
+        wkhtmltopdf run, and merge them. This bounds the memory of
+        wkhtmltopdf, which grows with the size of the HTML document.
+        :param progress: optional ``callback(done, total)`` called per chunk
+        :return: tuple (pdf content, list of per chunk dicts with ``rows``
+                 and the rendering ``duration`` in seconds)
+        """
         report = self.env.ref('crm_campaign_analysis.action_report_campaign_analysis')
-        pdf = report.with_context(ctx)._render_qweb_pdf(self.ids)[0]
-        
-        # Set file name and data
-        filename = f'campaign_analysis_{fields.Date.today().strftime("%Y%m%d")}.pdf'
-        self.write({
-            'data': base64.b64encode(pdf),
-            'filename': filename,
-            'state': 'done'
-        })
-        
-        return {
-            'type': 'ir.actions.act_window',
-            'res_model': self._name,
-            'view_mode': 'form',
-            'res_id': self.id,
-            'target': 'new',
-            'context': self.env.context,
-        }
+        stage_labels = [stage_label(stage_name) for stage_name in matrix['stage_names']]
+        bounds = self.env['crm.campaign.analysis.highlight.rule']._compile(matrix['stage_names'])
+        row_count = len(matrix['campaign_ids'])
+        # An empty analysis still renders one (empty) page
+        starts = range(0, row_count, PDF_CHUNK_SIZE) or [0]
+
+        pdfs = []
+        timings = []
+        for chunk_index, start in enumerate(starts):
+            values = self._pdf_chunk_values(matrix, start, start + PDF_CHUNK_SIZE, stage_labels, bounds)
+            values.update({
+                'date_from': date_from,
+                'date_to': date_to,
+                'chunk_index': chunk_index,
+                'chunk_count': len(starts),
+            })
+            with phase('pdf_chunk'):
+                started = time.perf_counter()
+                pdfs.append(report._render_qweb_pdf(report.report_name, [], data=values)[0])
+            timings.append({'rows': len(values['rows']), 'duration': time.perf_counter() - started})
+            _logger.info("Campaign analysis PDF chunk %s/%s (%s rows) rendered in %.2fs",
+                         chunk_index + 1, len(starts), len(values['rows']), timings[-1]['duration'])
+            if progress:
+                progress(chunk_index + 1, len(starts))
+
+        return (merge_pdf(pdfs) if len(pdfs) > 1 else pdfs[0]), timings
+
+    @api.model
+    def _pdf_chunk_values(self, matrix, start, end, stage_labels, bounds):
+        """Template values of the campaign rows [start, end) of a columnar payload"""
+        rows = []
+        for row in range(start, min(end, len(matrix['campaign_ids']))):
+            rows.append((
+                matrix['campaign_names'][row],
+                [
+                    (round(percentage, 2), percentage < low or percentage > high)
+                    for percentage, (low, high) in zip(matrix['percentages'][row], bounds)
+                ],
+                matrix['totals'][row],
+            ))
+        record_rows(len(rows))
+        return {'stage_labels': stage_labels, 'rows': rows}
@@ -2,7 +2,8 @@ odoo.define('crm_campaign_analysis.basic_dashboard', [
     'web.core',
     'web.Widget', 
     'web.AbstractAction',
-    'web.rpc'
+    'web.rpc',
+    'crm_campaign_analysis.virtual_table'
 ], function (require) {
     "use strict";
 
@@ -10,6 +11,7 @@ odoo.define('crm_campaign_analysis.basic_dashboard', [
     var Widget = require('web.Widget');
     var AbstractAction = require('web.AbstractAction');
     var rpc = require('web.rpc');
+    var VirtualTable = require('crm_campaign_analysis.virtual_table');
 
     var CampaignAnalysisBasicDashboard = AbstractAction.extend({
         template: 'CampaignAnalysisBasicDashboard',
@@ -29,87 +31,28 @@ odoo.define('crm_campaign_analysis.basic_dashboard', [
 
         _renderView: function() {
             var self = this;
-            return rpc.query({
-                model: 'crm.campaign.analysis.report',
-                method: 'get_campaign_stage_analysis',
-                args: [
-                    this.context.date_from || false, 
-                    this.context.date_to || false
-                ],
+            // Whole days, like the main dashboard and the exports: the
+            // context holds dates ('YYYY-MM-DD')
+            var dateFrom = this.context.date_from ? String(this.context.date_from).slice(0, 10) + ' 00:00:00' : false;
+            var dateTo = this.context.date_to ? String(this.context.date_to).slice(0, 10) + ' 23:59:59' : false;
+            var table = new VirtualTable(this, {
+                dateFrom: dateFrom,
+                dateTo: dateTo,
                 context: this.context,
-            }).then(function(data) {
-                if (!data || !data.campaigns || Object.keys(data.campaigns).length === 0) {
+            });
+            return table.appendTo(this.$el).then(function () {
+                if (table.isEmpty()) {
+                    table.destroy();
                     self.$el.html('<div class="alert alert-info">No data available for the selected date range.</div>');
                     return;
                 }
-
-                var $table = $('<table class="table table-bordered table-striped">');
-                var $thead = $('<thead>');
-                var $headerRow = $('<tr>');
-                
-                $headerRow.append($('<th>').text('Campaign'));
-                
-                // Add stage headers
-                for (var stageId in data.stages) {
-                    var stageName = data.stages[stageId];
-                    if (typeof stageName === 'object' && stageName !== null) {
-                        // If it's a translation dict, get the first value
-                        stageName = Object.values(stageName)[0] || 'Unknown';
-                    }
-                    $headerRow.append($('<th>').text(stageName + ' (%)'));
-                }
-                
-                $headerRow.append($('<th>').text('Total Leads'));
-                $thead.append($headerRow);
-                $table.append($thead);
-                
-                var $tbody = $('<tbody>');
-                
-                // Add campaign data rows
-                for (var campaignId in data.campaigns) {
-                    var campaign = data.campaigns[campaignId];
-                    var $row = $('<tr>');
-                    
-                    $row.append($('<td>').text(campaign.name));
-                    
-                    // Add stage percentages
-                    for (var stageId in data.stages) {
-                        var stageInfo = campaign.stages[stageId] || {percentage: 0.0};
-                        var $cell = $('<td>').text(stageInfo.percentage.toFixed(2) + '%');
-                        
-                        // Apply highlighting
-                        var stageName = String(data.stages[stageId] || '').toUpperCase();
-                        if (typeof data.stages[stageId] === 'object') {
-                            stageName = String(Object.values(data.stages[stageId])[0] || '').toUpperCase();
-                        }
-                        
-                        if ((stageName.includes('JUNK') && stageInfo.percentage > 20) ||
-                            ((stageName.includes('NOT CONNECTED') || stageName === 'NC') && stageInfo.percentage > 20) ||
-                            ((stageName.includes('ADMISSION') || stageName === 'A') && stageInfo.percentage < 5) ||
-                            ((stageName.includes('HOT PROSPECT') || stageName === 'HP' || 
-                              stageName.includes('FUTURE PROSPECT') || stageName === 'FP')) && stageInfo.percentage < 5) {
-                            $cell.css('background-color', '#ffcccb').css('color', '#721c24');
-                        }
-                        
-                        $row.append($cell);
-                    }
-                    
-                    $row.append($('<td>').text(campaign.total_leads));
-                    $tbody.append($row);
-                }
-                
-                $table.append($tbody);
-                self.$el.html($table);
                 
                 // Add highlighting legend
                 var $legend = $('<div class="mt-3">').append(
                     $('<h5>').text('Highlighting Rules:'),
-                    $('<ul>').append(
-                        $('<li>').text('Red: JUNK > 20%'),
-                        $('<li>').text('Red: Not Connected (NC) > 20%'),
-                        $('<li>').text('Red: Admission (A) < 5%'),
-                        $('<li>').text('Red: Hot Prospect (HP) or Future Prospect (FP) < 5%')
-                    )
+                    $('<ul>').append(table.getHighlightLegend().map(function (legend) {
+                        return $('<li>').text('Red: ' + legend);
+                    }))
                 );
                 
                 self.$el.append($legend);
@@ -1,4 +1,4 @@
-odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'web.Widget', 'web.rpc', 'web.AbstractAction', 'web.field_utils'], function (require) {
+odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'web.Widget', 'web.rpc', 'web.AbstractAction', 'web.field_utils', 'crm_campaign_analysis.virtual_table'], function (require) {
     "use strict";
 
     var core = require('web.core');
@@ -6,6 +6,7 @@ odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'w
     var rpc = require('web.rpc');
     var AbstractAction = require('web.AbstractAction');
     var field_utils = require('web.field_utils');
+    var VirtualTable = require('crm_campaign_analysis.virtual_table');
     var QWeb = core.qweb;
     var _t = core._t;
 
@@ -14,6 +15,7 @@ odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'w
         events: {
             'click .o_campaign_analysis_refresh': '_onRefresh',
             'change .date-filter-input': '_onDateFilterChange',
+            'input .o_campaign_search_input': '_onSearchInput',
             'click .export-btn': '_onExportClick',
         },
         
@@ -24,7 +26,14 @@ odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'w
             this._super.apply(this, arguments);
             this.action = action;
             this.context = action.context || {};
-            this.campaignData = null;
+            this.table = null;
+            this.search = '';
+            // Access scope of the user, filters the deltas sent on the bus
+            this.scope = null;
+            this._onBusNotification = this._onBusNotification.bind(this);
+            // Day of the snapshot shown instead of the current leads, if any
+            this.snapshotDate = false;
+            this._onSearchInput = _.debounce(this._onSearchInput.bind(this), 300);
             
             // Initialize dates from context or default to last 30 days
             var today = new Date();
@@ -45,103 +54,104 @@ odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'w
                 self.$('.date-from-input').val(self.dateFrom);
                 self.$('.date-to-input').val(self.dateTo);
                 
-                return self._fetchData();
+                self.call('bus_service', 'addEventListener', 'notification', self._onBusNotification);
+                return Promise.all([self._fetchData(), rpc.query({
+                    model: 'crm.campaign.analysis.report',
+                    method: 'get_live_update_scope',
+                    args: [],
+                    context: self.context,
+                }).then(function (scope) {
+                    self.scope = scope;
+                })]);
             });
         },
+
+        /**
+         * @override
+         */
+        destroy: function () {
+            this.call('bus_service', 'removeEventListener', 'notification', this._onBusNotification);
+            this._super.apply(this, arguments);
+        },
         
         /**
-         * Fetch the campaign analysis data
+         * Load the campaign analysis table, the rows themselves are fetched
+         * page by page by the virtual table while scrolling
          * @private
          * @returns {Promise}
          */
         _fetchData: function () {
             var self = this;
-            
-            // Show loading state
-            this.$('.o_campaign_analysis_content').empty().append(
-                $('<div>').addClass('text-center p-5')
-                    .append($('<i>').addClass('fa fa-spinner fa-spin fa-2x'))
-                    .append($('<div>').addClass('mt-2').text(_t('Loading data...')))
-            );
+            var $content = this.$('.o_campaign_analysis_content');
             
             // Convert dates to datetime format for the server
             var dateFrom = this.dateFrom ? this.dateFrom + ' 00:00:00' : false;
             var dateTo = this.dateTo ? this.dateTo + ' 23:59:59' : false;
             
-            // First refresh the materialized view explicitly
-            return rpc.query({
-                model: 'crm.campaign.analysis.report',
-                method: 'refresh_materialized_view',
-                args: [],
-                context: this.context,
-            }).then(function() {
-                // Then fetch the data
-                return rpc.query({
-                    model: 'crm.campaign.analysis.report',
-                    method: 'get_campaign_stage_analysis',
-                    args: [
-                        dateFrom, 
-                        dateTo
-                    ],
-                    context: self.context,
+            var promise;
+            if (this.table) {
+                promise = this.table.update({
+                    dateFrom: dateFrom,
+                    dateTo: dateTo,
+                    snapshotDate: this.snapshotDate,
+                    search: this.search,
+                });
+            } else {
+                $content.empty().append($(QWeb.render('CampaignAnalysisTableTemplate', {})));
+                this.table = new VirtualTable(this, {
+                    dateFrom: dateFrom,
+                    dateTo: dateTo,
+                    context: this.context,
+                    snapshotDate: this.snapshotDate,
+                    trendGrain: 'week',
+                    approximate: true,
                 });
-            }).then(function (result) {
-                self.campaignData = result;
-                return self._renderContent();
+                promise = this.table.appendTo($content.find('.o_campaign_analysis_table'));
+            }
+            $content.find('.o_campaign_analysis_range').text(this.snapshotDate ?
+                _t('snapshot of ') + this.snapshotDate :
+                this.dateFrom + ' ' + _t('to') + ' ' + this.dateTo);
+            this.$('.date-from-input, .date-to-input').prop('disabled', !!this.snapshotDate);
+            
+            return promise.then(function () {
+                $content.find('.o_campaign_analysis_empty').toggleClass('d-none', !self.table.isEmpty());
+                $content.find('.o_campaign_analysis_legend').empty().append(
+                    self.table.getHighlightLegend().map(function (legend) {
+                        return $('<li>').text(_t('Red: ') + legend);
+                    }));
             }).guardedCatch(function(error) {
-                self.$('.o_campaign_analysis_content').empty().append(
-                    $('<div>').addClass('alert alert-danger')
-                        .text(_t('Error loading data: ') + error.message || _t('Unknown error'))
-                );
+                $content.find('.o_campaign_analysis_empty')
+                    .removeClass('d-none alert-info').addClass('alert-danger')
+                    .text(_t('Error loading data: ') + (error.message || _t('Unknown error')));
                 return Promise.reject(error);
             });
         },
         
         /**
-         * Renders the dashboard content
+         * Patch the table with the lead count deltas published when leads
+         * change, instead of re-fetching it
          * @private
-         * @returns {Promise}
+         * @param {CustomEvent} ev detail is the list of bus notifications
          */
-        _renderContent: function () {
-            this.$('.o_campaign_analysis_content').empty();
-            
-            if (!this.campaignData || !this.campaignData.campaigns || !this.campaignData.stages || 
-                Object.keys(this.campaignData.campaigns).length === 0) {
-                this.$('.o_campaign_analysis_content').append($('<div>')
-                    .addClass('alert alert-info')
-                    .text(_t('No data available. Try adjusting your filters.')));
-                return Promise.resolve();
-            }
-            
-            var $content = $(QWeb.render('CampaignAnalysisTableTemplate', {
-                campaigns: this.campaignData.campaigns,
-                stages: this.campaignData.stages,
-                dateFrom: this.dateFrom,
-                dateTo: this.dateTo,
-                formatPercentage: function(value) {
-                    return value.toFixed(2) + '%';
-                },
-                getStageDisplay: function(stage) {
-                    if (typeof stage === 'object' && stage !== null) {
-                        return Object.values(stage)[0] || 'Unknown';
-                    }
-                    return stage;
-                },
-                shouldHighlight: function(stageName, percentage) {
-                    stageName = String(stageName || '').toUpperCase();
-                    if ((stageName.includes('JUNK') && percentage > 20) ||
-                        ((stageName.includes('NOT CONNECTED') || stageName === 'NC') && percentage > 20) ||
-                        ((stageName.includes('ADMISSION') || stageName === 'A') && percentage < 5) ||
-                        ((stageName.includes('HOT PROSPECT') || stageName === 'HP' || 
-                          stageName.includes('FUTURE PROSPECT') || stageName === 'FP') && percentage < 5)) {
-                        return true;
-                    }
-                    return false;
+        _onBusNotification: function (ev) {
+            var deltas = [];
+            ev.detail.forEach(function (notification) {
+                if (notification.type === 'crm_campaign_analysis/delta') {
+                    deltas = deltas.concat(notification.payload.deltas);
                 }
-            }));
-            
-            this.$('.o_campaign_analysis_content').append($content);
-            return Promise.resolve();
+            });
+            if (deltas.length && this.table && this.scope && this.table.applyDeltas(deltas, this.scope)) {
+                this._fetchData();
+            }
+        },
+        
+        /**
+         * Handle campaign name search, debounced in init
+         * @private
+         */
+        _onSearchInput: function (ev) {
+            this.search = $(ev.currentTarget).val();
+            this._fetchData();
         },
         
         /**
@@ -154,6 +164,8 @@ odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'w
                 this.dateFrom = $target.val();
             } else if ($target.hasClass('date-to-input')) {
                 this.dateTo = $target.val();
+            } else if ($target.hasClass('snapshot-date-input')) {
+                this.snapshotDate = $target.val() || false;
             }
             this._fetchData();
         },
@@ -198,6 +210,4 @@ odoo.define('crm_campaign_analysis.campaign_analysis_dashboard', ['web.core', 'w
     core.action_registry.add('campaign_analysis_dashboard', CampaignAnalysisDashboard);
     
     return CampaignAnalysisDashboard;
-
-    return CampaignAnalysisDashboard;
 });
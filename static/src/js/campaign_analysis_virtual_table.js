@@ -0,0 +1,520 @@
+odoo.define('crm_campaign_analysis.virtual_table', ['web.core', 'web.Widget', 'web.rpc'], function (require) {
+    "use strict";
+
+    var core = require('web.core');
+    var Widget = require('web.Widget');
+    var rpc = require('web.rpc');
+    var _t = core._t;
+
+    // Must match the row height set in campaign_analysis_dashboard.css
+    var ROW_HEIGHT = 36;
+    var PAGE_SIZE = 100;
+    // Rows rendered above and below the visible area
+    var BUFFER_ROWS = 20;
+    // Size of the trend sparklines, in pixels
+    var SPARKLINE_WIDTH = 80;
+    var SPARKLINE_HEIGHT = 20;
+    // Time the exact first page may take, in milliseconds, before the
+    // estimate is shown in its place
+    var ESTIMATE_DELAY = 200;
+
+    /**
+     * Campaign x stage table that only renders the visible rows and fetches
+     * them page by page from get_campaign_stage_page while scrolling.
+     * Sorting and searching are done server side.
+     */
+    var VirtualTable = Widget.extend({
+        className: 'o_campaign_analysis_virtual_table',
+        events: {
+            'click th[data-sort]': '_onSortClick',
+        },
+
+        /**
+         * @override
+         * @param {Object} options
+         * @param {string} [options.dateFrom]
+         * @param {string} [options.dateTo]
+         * @param {Object} [options.context]
+         * @param {string} [options.snapshotDate] show the daily snapshot of
+         *        this day (or the latest before) instead of the current leads
+         * @param {string} [options.trendGrain] 'week' or 'month' to add a
+         *        sparkline of the campaign totals, fetched once per page
+         * @param {boolean} [options.approximate] show an estimate of the
+         *        first page when the exact one is slow to come back
+         */
+        init: function (parent, options) {
+            this._super.apply(this, arguments);
+            options = options || {};
+            this.dateFrom = options.dateFrom || false;
+            this.dateTo = options.dateTo || false;
+            this.context = options.context || {};
+            this.snapshotDate = options.snapshotDate || false;
+            this.trendGrain = options.trendGrain || false;
+            this.approximate = options.approximate || false;
+            this.search = '';
+            this.sort = 'total';
+            this.sortStageId = false;
+            this.descending = true;
+            this._reset();
+        },
+
+        /**
+         * @override
+         */
+        start: function () {
+            var self = this;
+            this.$header = $('<table class="table table-bordered mb-0"><thead/></table>');
+            this.$viewport = $('<div class="o_virtual_viewport">');
+            this.$spacer = $('<div class="o_virtual_spacer">');
+            this.$rows = $('<table class="table table-bordered table-hover o_virtual_rows"><tbody/></table>');
+            this.$viewport.append(this.$spacer, this.$rows);
+            this.$el.append(this.$header, this.$viewport);
+            this.$viewport.on('scroll', function () {
+                if (!self._scrollScheduled) {
+                    self._scrollScheduled = true;
+                    window.requestAnimationFrame(function () {
+                        self._scrollScheduled = false;
+                        self._renderRows();
+                    });
+                }
+            });
+            return this._super.apply(this, arguments).then(function () {
+                return self.reload();
+            });
+        },
+
+        //--------------------------------------------------------------------------
+        // Public
+        //--------------------------------------------------------------------------
+
+        /**
+         * Change the filters and reload from the first page
+         * @param {Object} values dateFrom, dateTo, snapshotDate and/or search
+         * @returns {Promise}
+         */
+        update: function (values) {
+            _.extend(this, _.pick(values, 'dateFrom', 'dateTo', 'snapshotDate', 'search'));
+            return this.reload();
+        },
+
+        /**
+         * @returns {Promise}
+         */
+        reload: function () {
+            var self = this;
+            this._reset();
+            this.$viewport.scrollTop(0);
+            var exact = this._fetchPage(0);
+            var shown = exact;
+            if (this.approximate && !this.snapshotDate) {
+                var token = this.token;
+                var delay = new Promise(function (resolve) {
+                    setTimeout(resolve, ESTIMATE_DELAY);
+                });
+                // Whichever comes first: the exact page, or the estimate once
+                // the exact page missed its delay
+                shown = Promise.race([exact, Promise.all([this._fetchEstimate(), delay])]);
+                exact.then(function () {
+                    if (token === self.token && self.estimate) {
+                        self.estimate = null;
+                        self._renderHeader();
+                        self._renderRows();
+                    }
+                });
+            }
+            return shown.then(function () {
+                self._renderHeader();
+                self._renderRows();
+            });
+        },
+
+        /**
+         * @returns {boolean} true when the current filters match no campaign
+         */
+        isEmpty: function () {
+            return this.totalCount === 0;
+        },
+
+        /**
+         * @returns {string[]} highlight rules, e.g. "JUNK > 20%"
+         */
+        getHighlightLegend: function () {
+            return this.highlightLegend;
+        },
+
+        /**
+         * Patch the loaded rows with lead count deltas sent on the bus
+         * @param {Array[]} deltas [companyId, campaignId, stageId, teamId,
+         *        userId, createDate, delta] lists
+         * @param {Object} scope company_ids, team_ids and user_ids of the
+         *        user, null meaning unrestricted
+         * @returns {boolean} true when a delta could not be applied to the
+         *          loaded rows and the table should be reloaded
+         */
+        applyDeltas: function (deltas, scope) {
+            var self = this;
+            if (this.snapshotDate) {
+                return false;
+            }
+            var inScope = function (ids, id) {
+                return !ids || ids.indexOf(id) !== -1;
+            };
+            var pages = _.filter(this.pages, function (page) {
+                // Pages still being fetched are promises
+                return page && page.campaign_ids;
+            });
+            var allLoaded = _.reduce(pages, function (count, page) {
+                return count + page.campaign_ids.length;
+            }, 0) === this.totalCount;
+            var reload = false;
+            var patched = false;
+            deltas.forEach(function (values) {
+                var stageId = values[2];
+                var createDate = values[5];
+                var delta = values[6];
+                if (!inScope(scope.company_ids, values[0]) || !inScope(scope.team_ids, values[3]) ||
+                        !inScope(scope.user_ids, values[4]) ||
+                        (self.dateFrom && createDate < self.dateFrom) || (self.dateTo && createDate > self.dateTo)) {
+                    return;
+                }
+                // Leads without stage only count in the totals
+                var col = self.stageIds.indexOf(stageId);
+                if (col === -1 && stageId) {
+                    reload = true;
+                    return;
+                }
+                var found = false;
+                pages.forEach(function (page) {
+                    var row = page.campaign_ids.indexOf(values[1]);
+                    if (row !== -1) {
+                        found = true;
+                        page.totals[row] += delta;
+                        if (col !== -1) {
+                            page.counts[row * self.stageIds.length + col] += delta;
+                        }
+                    }
+                });
+                patched = patched || found;
+                // A campaign missing from a fully loaded table is a new one,
+                // otherwise it is in a page fetched later
+                reload = reload || (!found && allLoaded);
+            });
+            if (patched && !reload) {
+                this._renderRows();
+            }
+            return reload;
+        },
+
+        //--------------------------------------------------------------------------
+        // Private
+        //--------------------------------------------------------------------------
+
+        _reset: function () {
+            // Pages already fetched (payload) or being fetched (promise)
+            this.pages = {};
+            // Estimate of the first page, shown until the exact one is loaded
+            this.estimate = null;
+            this.totalCount = null;
+            this.stageIds = [];
+            this.stageNames = [];
+            // Compiled highlight rules per stage column, null for no bound
+            this.highlightLow = [];
+            this.highlightHigh = [];
+            this.highlightLegend = [];
+            // Invalidates the responses of the requests sent before a reset
+            this.token = (this.token || 0) + 1;
+        },
+
+        /**
+         * @private
+         * @param {integer} page
+         * @returns {Promise}
+         */
+        _fetchPage: function (page) {
+            var self = this;
+            if (this.pages[page]) {
+                return Promise.resolve(this.pages[page]);
+            }
+            var token = this.token;
+            var promise = rpc.query({
+                model: 'crm.campaign.analysis.report',
+                method: 'get_campaign_stage_page',
+                args: [this.dateFrom, this.dateTo],
+                kwargs: {
+                    offset: page * PAGE_SIZE,
+                    limit: PAGE_SIZE,
+                    sort: this.sort,
+                    sort_stage_id: this.sortStageId,
+                    descending: this.descending,
+                    search: this.search || false,
+                    snapshot_date: this.snapshotDate || false,
+                    // Flat counts, percentages are derived in _renderRow
+                    compact: true,
+                },
+                context: this.context,
+            }).then(function (result) {
+                return self._fetchTrends(result);
+            }).then(function (result) {
+                if (token !== self.token) {
+                    return result;
+                }
+                self.pages[page] = result;
+                self._setColumns(result);
+                return result;
+            }).catch(function (error) {
+                // Forget the failed request so that the page is fetched
+                // again the next time it is scrolled into view
+                if (self.pages[page] === promise) {
+                    delete self.pages[page];
+                }
+                return Promise.reject(error);
+            });
+            this.pages[page] = promise;
+            return promise;
+        },
+
+        /**
+         * Fetch the estimate of the first page, kept unless the exact page
+         * is loaded meanwhile. Never rejects: the table then simply waits
+         * for the exact page.
+         * @private
+         * @returns {Promise}
+         */
+        _fetchEstimate: function () {
+            var self = this;
+            var token = this.token;
+            return rpc.query({
+                model: 'crm.campaign.analysis.report',
+                method: 'get_campaign_stage_page',
+                args: [this.dateFrom, this.dateTo],
+                kwargs: {
+                    offset: 0,
+                    limit: PAGE_SIZE,
+                    sort: this.sort,
+                    sort_stage_id: this.sortStageId,
+                    descending: this.descending,
+                    search: this.search || false,
+                    compact: true,
+                    approximate: true,
+                },
+                context: this.context,
+            }).then(function (result) {
+                var page = self.pages[0];
+                if (token === self.token && (!page || typeof page.then === 'function')) {
+                    result.trends = {};
+                    self.estimate = result;
+                    self._setColumns(result);
+                }
+            }).guardedCatch(function () {});
+        },
+
+        /**
+         * @private
+         * @param {Object} result page payload
+         */
+        _setColumns: function (result) {
+            this.totalCount = result.total_count;
+            this.stageIds = result.stage_ids;
+            this.stageNames = result.stage_names.map(this._stageLabel);
+            this.highlightLow = result.highlight_low;
+            this.highlightHigh = result.highlight_high;
+            this.highlightLegend = result.highlight_legend;
+        },
+
+        /**
+         * Add the trend series of the campaigns of a page, in one call
+         * @private
+         * @param {Object} page
+         * @returns {Promise<Object>} the page
+         */
+        _fetchTrends: function (page) {
+            page.trends = {};
+            if (!this.trendGrain || !page.campaign_ids.length) {
+                return Promise.resolve(page);
+            }
+            return rpc.query({
+                model: 'crm.campaign.analysis.report',
+                method: 'get_campaign_stage_trend',
+                args: [this.dateFrom, this.dateTo],
+                kwargs: {
+                    grain: this.trendGrain,
+                    campaign_ids: page.campaign_ids,
+                },
+                context: this.context,
+            }).then(function (trend) {
+                trend.campaign_ids.forEach(function (campaignId, row) {
+                    page.trends[campaignId] = trend.totals[row];
+                });
+                return page;
+            });
+        },
+
+        /**
+         * @private
+         * @param {number[]} values
+         * @returns {jQuery} inline svg polyline of the values
+         */
+        _renderSparkline: function (values) {
+            var $svg = $(document.createElementNS('http://www.w3.org/2000/svg', 'svg'))
+                .attr({width: SPARKLINE_WIDTH, height: SPARKLINE_HEIGHT});
+            if (!values || values.length < 2) {
+                return $svg;
+            }
+            var max = Math.max.apply(null, values) || 1;
+            var step = (SPARKLINE_WIDTH - 2) / (values.length - 1);
+            var points = values.map(function (value, index) {
+                var x = 1 + index * step;
+                var y = SPARKLINE_HEIGHT - 1 - value / max * (SPARKLINE_HEIGHT - 2);
+                return x.toFixed(1) + ',' + y.toFixed(1);
+            });
+            var polyline = document.createElementNS('http://www.w3.org/2000/svg', 'polyline');
+            $(polyline).attr({points: points.join(' '), fill: 'none', stroke: 'currentColor', 'stroke-width': 1.5});
+            return $svg.append(polyline);
+        },
+
+        /**
+         * Bounds of the exact percentage of an estimated cell: lowest with
+         * the fewest leads in the stage and the most in the other stages,
+         * and the other way round (see _compute_estimate_bounds)
+         * @private
+         * @param {Object} page estimated page
+         * @param {integer} row
+         * @param {integer} index index of the cell in the flat counts
+         * @returns {number[]} [low, high] percentages
+         */
+        _percentageBounds: function (page, row, index) {
+            var low = page.counts_low[index];
+            var high = page.counts_high[index];
+            return [
+                low ? low * 100 / (low + page.totals_high[row] - high) : 0,
+                high ? high * 100 / (high + page.totals_low[row] - low) : 0,
+            ];
+        },
+
+        _stageLabel: function (stageName) {
+            if (typeof stageName === 'object' && stageName !== null) {
+                // If it's a translation dict, get the first value
+                return Object.values(stageName)[0] || 'Unknown';
+            }
+            return stageName;
+        },
+
+        _sortIndicator: function (sort, stageId) {
+            if (this.sort !== sort || (sort === 'stage' && this.sortStageId !== stageId)) {
+                return '';
+            }
+            return this.descending ? ' ▼' : ' ▲';
+        },
+
+        _renderHeader: function () {
+            var self = this;
+            var $row = $('<tr>');
+            $row.append($('<th data-sort="name">').text(_t('Campaign') + this._sortIndicator('name')));
+            this.stageIds.forEach(function (stageId, col) {
+                $row.append($('<th data-sort="stage">').attr('data-stage-id', stageId)
+                    .text(self.stageNames[col] + ' (%)' + self._sortIndicator('stage', stageId)));
+            });
+            $row.append($('<th data-sort="total">').text(_t('Total Leads') + this._sortIndicator('total')));
+            if (this.trendGrain) {
+                $row.append($('<th class="o_campaign_sparkline">').text(_t('Trend')));
+            }
+            this.$header.find('thead').empty().append($row);
+        },
+
+        /**
+         * Render the rows intersecting the viewport, fetching the pages
+         * that are not loaded yet
+         * @private
+         */
+        _renderRows: function () {
+            var self = this;
+            var total = this.totalCount || 0;
+            this.$spacer.css('height', total * ROW_HEIGHT);
+
+            var scrollTop = this.$viewport.scrollTop();
+            var first = Math.max(Math.floor(scrollTop / ROW_HEIGHT) - BUFFER_ROWS, 0);
+            var last = Math.min(first + Math.ceil(this.$viewport.height() / ROW_HEIGHT) + 2 * BUFFER_ROWS, total - 1);
+
+            var $tbody = $('<tbody>');
+            var missing = [];
+            for (var index = first; index <= last; index++) {
+                var pageIndex = Math.floor(index / PAGE_SIZE);
+                var page = this.pages[pageIndex];
+                if ((!page || typeof page.then === 'function') && pageIndex === 0 && this.estimate) {
+                    page = this.estimate;
+                }
+                if (!page || typeof page.then === 'function') {
+                    if (!_.contains(missing, pageIndex)) {
+                        missing.push(pageIndex);
+                    }
+                    $tbody.append($('<tr class="o_virtual_placeholder">').append(
+                        $('<td>').attr('colspan', this.stageIds.length + (this.trendGrain ? 3 : 2)).html('&nbsp;')));
+                    continue;
+                }
+                $tbody.append(this._renderRow(page, index - pageIndex * PAGE_SIZE));
+            }
+            this.$rows.css('top', first * ROW_HEIGHT);
+            this.$rows.find('tbody').replaceWith($tbody);
+
+            missing.forEach(function (pageIndex) {
+                self._fetchPage(pageIndex).then(function () {
+                    self._renderRows();
+                });
+            });
+        },
+
+        _renderRow: function (page, row) {
+            var self = this;
+            var $row = $('<tr>');
+            var total = page.totals[row];
+            var offset = row * this.stageIds.length;
+            $row.append($('<td>').text(page.campaign_names[row]));
+            this.stageIds.forEach(function (stageId, col) {
+                var percentage = total ? page.counts[offset + col] * 100 / total : 0;
+                var low = self.highlightLow[col];
+                var high = self.highlightHigh[col];
+                var $cell = $('<td>').text(percentage.toFixed(2) + '%');
+                if (page.approximate) {
+                    var bounds = self._percentageBounds(page, row, offset + col);
+                    $cell.text('≈ ' + $cell.text()).addClass('o_campaign_analysis_estimate')
+                        .attr('title', bounds[0].toFixed(2) + '% – ' + bounds[1].toFixed(2) + '%');
+                }
+                if ((low !== null && percentage < low) || (high !== null && percentage > high)) {
+                    $cell.addClass('bg-danger');
+                }
+                $row.append($cell);
+            });
+            if (page.approximate) {
+                $row.append($('<td class="o_campaign_analysis_estimate">').text('≈ ' + total)
+                    .attr('title', page.totals_low[row] + ' – ' + page.totals_high[row]));
+            } else {
+                $row.append($('<td>').text(total));
+            }
+            if (this.trendGrain) {
+                $row.append($('<td class="o_campaign_sparkline">').append(
+                    this._renderSparkline(page.trends[page.campaign_ids[row]])));
+            }
+            return $row;
+        },
+
+        //--------------------------------------------------------------------------
+        // Handlers
+        //--------------------------------------------------------------------------
+
+        _onSortClick: function (ev) {
+            var $th = $(ev.currentTarget);
+            var sort = $th.data('sort');
+            var stageId = sort === 'stage' ? $th.data('stage-id') : false;
+            if (this.sort === sort && this.sortStageId === stageId) {
+                this.descending = !this.descending;
+            } else {
+                this.sort = sort;
+                this.sortStageId = stageId;
+                this.descending = sort !== 'name';
+            }
+            this.reload();
+        },
+    });
+
+    return VirtualTable;
+});
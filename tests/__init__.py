@@ -0,0 +1,4 @@
+from . import test_lead_index
+from . import test_parallel
+from . import test_rollup_ranges
+from . import test_report
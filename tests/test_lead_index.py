@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import TransactionCase, tagged
+
+from ..models.crm_campaign_analysis_rollup import LEAD_INDEX, LEAD_INDEX_DEFINITION
+
+
+@tagged('post_install', '-at_install')
+class TestLeadIndex(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rollup_model = cls.env['crm.campaign.analysis.rollup']
+        if rollup_model._get_lead_index_state() != 'valid':
+            # Normally built concurrently after the install commits
+            cls.env.cr.execute("DROP INDEX IF EXISTS %s" % LEAD_INDEX)
+            cls.env.cr.execute("CREATE INDEX %s %s" % (LEAD_INDEX, LEAD_INDEX_DEFINITION))
+
+        campaign = cls.env['utm.campaign'].create({'name': 'Index campaign'})
+        cls.env.flush_all()
+        # About 20 leads a day over three years: a one day range is selective
+        cls.env.cr.execute("""
+            INSERT INTO crm_lead (name, type, active, campaign_id, company_id, create_date, write_date)
+            SELECT 'Index lead ' || n, 'opportunity', True, %s, %s,
+                   %s - n * interval '72 minutes', %s - n * interval '72 minutes'
+            FROM generate_series(1, 20000) n
+        """, (campaign.id, cls.env.company.id, fields.Datetime.now(), fields.Datetime.now()))
+        cls.env.cr.execute("ANALYZE crm_lead")
+
+    def test_lead_range_uses_index_only_scan(self):
+        now = fields.Datetime.now()
+        result = self.env['crm.campaign.analysis.rollup']._check_lead_index_plan(now - timedelta(days=1), now)
+        self.assertTrue(result['index_only'], result['scans'])
+        self.assertIn(LEAD_INDEX, [scan['index'] for scan in result['scans']])
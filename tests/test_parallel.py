@@ -0,0 +1,30 @@
+from odoo.tests import TransactionCase, tagged
+
+from ..models.campaign_analysis_parallel import has_pending_writes, run_shards, split_evenly, split_range
+
+
+@tagged('post_install', '-at_install')
+class TestParallel(TransactionCase):
+
+    def test_split(self):
+        self.assertEqual(split_evenly(list(range(5)), 2), [[0, 1, 2], [3, 4]])
+        self.assertEqual(split_evenly([1], 4), [[1]])
+        self.assertEqual(split_range(1, 10, 3), [(1, 3), (4, 6), (7, 10)])
+        self.assertEqual(split_range(5, 5, 4), [(5, 5)])
+
+    def test_run_shards_concurrent(self):
+        # The test runs within a savepoint: the snapshot of the shards must
+        # not be exported from the test transaction
+        queries = [("SELECT generate_series(%s, %s)", [low, high]) for low, high in split_range(1, 100, 4)]
+        results = dict(run_shards(self.env.cr, queries, 2, read_own_writes=False))
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+        self.assertEqual([value for index in sorted(results) for value, in results[index]], list(range(1, 101)))
+
+    def test_run_shards_pending_writes(self):
+        campaign = self.env['utm.campaign'].create({'name': 'Shard campaign'})
+        self.env.flush_all()
+        self.assertTrue(has_pending_writes(self.env.cr))
+        query = ("SELECT COUNT(*) FROM utm_campaign WHERE id = %s", [campaign.id])
+        # Uncommitted writes are only visible to the calling transaction
+        results = dict(run_shards(self.env.cr, [query, query], 2))
+        self.assertEqual(results, {0: [(1,)], 1: [(1,)]})
@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import TransactionCase, tagged
+
+
+@tagged('post_install', '-at_install')
+class TestReport(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.report_model = cls.env['crm.campaign.analysis.report']
+        cls.campaign = cls.env['utm.campaign'].create({'name': 'Report campaign'})
+        cls.stage_new = cls.env['crm.stage'].create({'name': 'Report stage new'})
+        cls.stage_won = cls.env['crm.stage'].create({'name': 'Report stage won'})
+        cls.env['crm.lead'].create([{
+            'name': 'Report lead %s' % index,
+            'type': 'opportunity',
+            'campaign_id': cls.campaign.id,
+            'stage_id': (cls.stage_won if index % 4 == 0 else cls.stage_new).id,
+        } for index in range(8)])
+        cls.env.flush_all()
+        cls.report_model._refresh_view()
+
+    def test_pivot_weighted_percentage(self):
+        groups = self.report_model.read_group(
+            [('campaign_id', '=', self.campaign.id)], ['percentage', 'lead_count'],
+            ['campaign_id', 'stage_id'], lazy=False)
+        percentages = {group['stage_id'][0]: group['percentage'] for group in groups}
+        self.assertEqual(percentages, {self.stage_new.id: 75.0, self.stage_won.id: 25.0})
+
+    def test_pivot_percentage_with_stage_filter(self):
+        # The stage filter restricts the groups, not the campaign totals
+        for domain in ([('stage_id', '=', self.stage_won.id)],
+                       ['!', ('stage_id', '!=', self.stage_won.id)],
+                       [('stage_id.name', '=', 'Report stage won')]):
+            groups = self.report_model.read_group(
+                [('campaign_id', '=', self.campaign.id)] + domain, ['percentage'],
+                ['campaign_id', 'stage_id'], lazy=False)
+            self.assertEqual([(group['stage_id'][0], group['percentage']) for group in groups],
+                             [(self.stage_won.id, 25.0)], domain)
+
+    def test_html_report(self):
+        today = fields.Date.today()
+        wizard = self.env['crm.campaign.analysis.wizard'].create({
+            'date_from': today - timedelta(days=1),
+            'date_to': today,
+        })
+        html, _report_type = self.env['ir.actions.report'].with_context(
+            date_from=wizard.date_from, date_to=wizard.date_to,
+        )._render_qweb_html('crm_campaign_analysis.action_campaign_analysis_html_report', wizard.ids)
+        self.assertIn(b'Report campaign', html)
+        self.assertIn(b'Report stage won', html)
@@ -0,0 +1,98 @@
+from collections import Counter
+from datetime import datetime
+
+from odoo.tests import TransactionCase, tagged
+
+RANGES = [
+    # Partial start and end days, crossing two month boundaries
+    (datetime(2021, 1, 10, 13, 30), datetime(2021, 3, 5, 8, 15)),
+    # Whole days crossing a month boundary, ending at the end of a day
+    (datetime(2021, 1, 25), datetime(2021, 2, 7, 23, 59, 59)),
+    # Whole months
+    (datetime(2021, 2, 1), datetime(2021, 3, 31, 23, 59, 59, 999999)),
+    # Partial start day only, then whole days across a month boundary
+    (datetime(2021, 1, 31, 23, 59, 59), datetime(2021, 2, 28, 23, 59, 59)),
+    # Whole start day, partial end day on the first of a month
+    (datetime(2021, 2, 22), datetime(2021, 3, 1, 0, 0)),
+    # Within a single day
+    (datetime(2021, 2, 14, 6, 0), datetime(2021, 2, 14, 18, 0)),
+]
+
+
+@tagged('post_install', '-at_install')
+class TestRollupRanges(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.rollup_model = cls.env['crm.campaign.analysis.rollup']
+        cls.campaign = cls.env['utm.campaign'].create({'name': 'Range campaign'})
+        cls.stage_a = cls.env['crm.stage'].create({'name': 'Range stage A'})
+        cls.stage_b = cls.env['crm.stage'].create({'name': 'Range stage B'})
+        cls.env.flush_all()
+        # Leads every 197 minutes over three months, spread over the hours of
+        # the day, plus leads right on the day and month boundaries
+        cls.env.cr.execute("""
+            INSERT INTO crm_lead (name, type, active, campaign_id, stage_id, company_id, create_date, write_date)
+            SELECT 'Range lead ' || n, 'opportunity', n %% 11 <> 0, %(campaign)s,
+                   (ARRAY[%(stage_a)s, %(stage_b)s, NULL])[n %% 3 + 1], %(company)s, d, d
+            FROM (
+                SELECT n, timestamp '2021-01-01' + n * interval '197 minutes' AS d
+                FROM generate_series(0, 699) n
+                UNION ALL
+                SELECT 1000 + n, d FROM unnest(ARRAY[
+                    timestamp '2021-01-31 23:59:59', timestamp '2021-02-01 00:00:00',
+                    timestamp '2021-02-28 23:59:59', timestamp '2021-03-01 00:00:00',
+                    timestamp '2021-03-05 08:15:00', timestamp '2021-01-10 13:30:00'
+                ]) WITH ORDINALITY AS b(d, n)
+            ) leads
+        """, {
+            'campaign': cls.campaign.id,
+            'stage_a': cls.stage_a.id,
+            'stage_b': cls.stage_b.id,
+            'company': cls.env.company.id,
+        })
+
+    def _direct_counts(self, date_from, date_to):
+        self.env.cr.execute("""
+            SELECT campaign_id, COALESCE(stage_id, 0), COUNT(*)
+            FROM crm_lead
+            WHERE campaign_id = %s AND active
+            AND create_date BETWEEN %s AND %s
+            GROUP BY 1, 2
+        """, (self.campaign.id, date_from, date_to))
+        return {(campaign_id, stage_id): count for campaign_id, stage_id, count in self.env.cr.fetchall()}
+
+    def _assert_counts(self):
+        expected = [self._direct_counts(date_from, date_to) for date_from, date_to in RANGES]
+        self.assertTrue(all(expected), "Every range should contain seeded leads")
+
+        for (date_from, date_to), direct in zip(RANGES, expected):
+            query, params = self.rollup_model._count_query(date_from, date_to, campaign_ids=[self.campaign.id])
+            self.env.cr.execute(query, params)
+            counts = Counter()
+            for campaign_id, stage_id, count in self.env.cr.fetchall():
+                counts[(campaign_id, stage_id)] += count
+            self.assertEqual(+counts, direct, "_count_query(%s, %s)" % (date_from, date_to))
+
+        query, params = self.rollup_model._multi_count_query(RANGES, campaign_ids=[self.campaign.id])
+        self.env.cr.execute(query, params)
+        rows = self.env.cr.fetchall()
+        for index, ((date_from, date_to), direct) in enumerate(zip(RANGES, expected)):
+            counts = Counter({(row[0], row[1]): row[2 + index] for row in rows})
+            self.assertEqual(+counts, direct, "_multi_count_query range %s (%s, %s)" % (index, date_from, date_to))
+
+    def test_ranges_match_leads(self):
+        self._assert_counts()
+
+    def test_ranges_match_leads_after_updates(self):
+        # Move leads to another stage and across day and month boundaries,
+        # archive and restore some: the update trigger moves their counts
+        self.env.cr.execute("""
+            UPDATE crm_lead
+            SET stage_id = CASE WHEN stage_id = %(stage_a)s THEN %(stage_b)s ELSE %(stage_a)s END,
+                create_date = create_date + interval '11 days 7 hours',
+                active = NOT active
+            WHERE campaign_id = %(campaign)s AND id %% 4 = 0
+        """, {'campaign': self.campaign.id, 'stage_a': self.stage_a.id, 'stage_b': self.stage_b.id})
+        self._assert_counts()